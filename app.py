@@ -1,4 +1,5 @@
 from app import create_app
+from app.celery_app import celery  # noqa: F401 - bind tasks to the configured Celery app
 from app.tasks.gmail import sync_user_gmail
 
 app = create_app()
@@ -6,17 +6,20 @@ from flask import Blueprint, current_app, jsonify, redirect, request, url_for, a
 
 from app.extensions import db
 from app.models import User, GmailToken
+from app.services import metrics
+from app.services.coalesce import cancel_notification, coalesce_window, register_notification
 from app.services.google_oauth import (
 	create_flow,
 	exchange_code_for_tokens,
 	fetch_userinfo,
 	watch_user_gmail,
-	get_history,
-	process_gmail_history
+	invalidate_gmail_clients,
 )
+from app.tasks.gmail import process_history
 
 import base64
 import json
+import time
 
 # Active users storage (In production, use a database)
 bp = Blueprint("oauth", __name__, url_prefix="/oauth2")
@@ -89,8 +92,18 @@ def callback():
 			db.session.rollback()
 			return jsonify({"error": "db_commit_failed"}), 500
 
-		# Create watch service for Pub/Sub
-		watch_user_gmail(token.access_token)
+		# Tokens may have changed; drop any pooled clients for this user
+		invalidate_gmail_clients(user_id=user.id)
+
+		# Create watch service for Pub/Sub; its historyId seeds the sync cursor
+		watch = watch_user_gmail(token.access_token, user_id=user.id)
+		if token.last_history_id is None and watch.get("historyId"):
+			token.last_history_id = int(watch["historyId"])
+			try:
+				db.session.commit()
+			except Exception as db_exc:  # noqa: BLE001
+				current_app.logger.error("History cursor commit failed: %s", db_exc)
+				db.session.rollback()
 
 		return redirect(url_for("ui"))
 	except Exception as exc:  # noqa: BLE001
@@ -122,6 +135,7 @@ def logout_user(user_id):
 		for token in tokens:
 			db.session.delete(token)
 
+		invalidate_gmail_clients(user_id=user.id)
 		db.session.delete(user)
 		db.session.commit()
 		return jsonify({'success': True})
@@ -132,7 +146,13 @@ def logout_user(user_id):
 
 @bp.route("/pubsub/push", methods=["POST"])
 def pubsub_push():
-	envelope = request.get_json()
+	"""Validate a Gmail push notification and hand it to the worker pipeline.
+
+	Only the envelope is checked here; user lookup, the history walk and
+	content fetches run in ``gmail.process_history`` so Pub/Sub gets its
+	acknowledgement within milliseconds.
+	"""
+	envelope = request.get_json(silent=True)
 	if not envelope or "message" not in envelope:
 		abort(400, "Invalid Pub/Sub message")
 
@@ -143,32 +163,41 @@ def pubsub_push():
 	if not data:
 		abort(400, "No data in Pub/Sub message")
 
-	decoded_data = base64.b64decode(data).decode("utf-8")
-	message_data = json.loads(decoded_data)
+	try:
+		message_data = json.loads(base64.b64decode(data).decode("utf-8"))
+	except (ValueError, UnicodeDecodeError):
+		abort(400, "Undecodable Pub/Sub data")
 
 	# Gmail notification contains 'emailAddress' and 'historyId'
 	email = message_data.get("emailAddress")
 	history_id = message_data.get("historyId")
 
-	if not email or not history_id:
+	if not email or not str(history_id).isdigit():
 		abort(400, "Missing emailAddress or historyId")
 
-	# Fetch user's Gmail history
-	user = User.query.filter_by(email=email).first()
-	if not user:
-		abort(400, "not found the user")
-
-	token = GmailToken.query.filter_by(user_id=user.id).first()
-	if not token:
-		abort(400, "Not found the access token")
-	
-	access_token = token.access_token
-	history = get_history(access_token=access_token, start_history_id=history_id)
-
-	print(f"New Gmail history for {email}: {history}")
-	new_messages = process_gmail_history(access_token=access_token, history=history)
-
-	# Pass this to LLM
-
-	# Always respond with 204 for Pub/Sub push
-	return ("", 204)
\ No newline at end of file
+	scheduled = False
+	try:
+		# Bursts for one user collapse into a single sync per coalescing window
+		if not register_notification(email, int(history_id)):
+			metrics.incr("pubsub.push.coalesced")
+			return ("", 204)
+		scheduled = True
+		process_history.apply_async(
+			kwargs={
+				"email": email,
+				"history_id": str(history_id),
+				"published_at": pubsub_message.get("publishTime"),
+				"enqueued_at": time.time(),
+			},
+			countdown=coalesce_window(),
+		)
+	except Exception as exc:  # noqa: BLE001
+		# Non-2xx makes Pub/Sub redeliver once the broker is reachable again
+		current_app.logger.error("Failed to enqueue Gmail history for %s: %s", email, exc)
+		if scheduled:
+			# Otherwise the redelivery would be taken as coalesced and dropped
+			cancel_notification(email)
+		return jsonify({"error": "enqueue_failed"}), 503
+
+	metrics.incr("pubsub.push.enqueued")
+	return ("", 204)
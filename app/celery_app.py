@@ -4,9 +4,25 @@ import logging
 from typing import Any
 
 from celery import Celery
+from celery.signals import celeryd_init, worker_init, worker_process_init
+from kombu import Exchange, Queue
 
 from . import create_app
 
+# Latency-sensitive ingestion never shares a queue with slow LLM calls
+CELERY_QUEUES = ("ingest", "llm", "sync", "maintenance")
+
+TASK_ROUTES = {
+	"gmail.process_history": {"queue": "ingest"},
+	"gmail.sync_user": {"queue": "sync"},
+	"gmail.sync_fleet_chunk": {"queue": "sync"},
+	"llm.requeue_pending": {"queue": "maintenance"},
+	"llm.*": {"queue": "llm"},
+	"gmail.sync_fleet": {"queue": "maintenance"},
+	"gmail.refresh_*": {"queue": "maintenance"},
+	"example.*": {"queue": "maintenance"},
+}
+
 
 def make_celery(flask_config_name: str | None = None) -> Celery:
 	"""Create and configure Celery bound to the Flask app context."""
@@ -19,7 +35,7 @@ def make_celery(flask_config_name: str | None = None) -> Celery:
 		flask_app.import_name,
 		broker=broker_url,
 		backend=result_backend,
-		include=["app.tasks.example"],
+		include=["app.tasks.example", "app.tasks.gmail", "app.tasks.llm"],
 	)
 
 	# Propagate Flask config into Celery namespace if needed
@@ -29,8 +45,57 @@ def make_celery(flask_config_name: str | None = None) -> Celery:
 		accept_content=["json"],
 		task_track_started=True,
 		task_time_limit=60 * 15,
+		task_queues=[
+			# x-max-priority enables priorities on RabbitMQ; Redis uses priority_steps below
+			Queue(name, Exchange(name), routing_key=name, queue_arguments={"x-max-priority": 10} if name == "llm" else None)
+			for name in CELERY_QUEUES
+		],
+		task_default_queue="maintenance",
+		task_routes=TASK_ROUTES,
+		# Ack after the task finishes so a lost worker's tasks are redelivered
+		task_acks_late=True,
+		beat_schedule={
+			# Keep Gmail tokens fresh so no request or notification waits on a refresh
+			"gmail-refresh-expiring-tokens": {
+				"task": "gmail.refresh_expiring_tokens",
+				"schedule": float(flask_app.config.get("GMAIL_TOKEN_REFRESH_INTERVAL", 60)),
+			},
+			# Sync every user not synced within GMAIL_FLEET_MIN_AGE, spread over the workers
+			"gmail-sync-fleet": {
+				"task": "gmail.sync_fleet",
+				"schedule": float(flask_app.config.get("GMAIL_FLEET_SYNC_INTERVAL", 900)),
+			},
+			# Resend held emails whose llm.triage task was lost or gave up
+			"llm-requeue-pending": {
+				"task": "llm.requeue_pending",
+				"schedule": float(flask_app.config.get("LLM_TRIAGE_REQUEUE_INTERVAL", 300)),
+			},
+		},
 	)
 
+	if str(broker_url or "").startswith(("redis", "rediss", "sentinel")):
+		celery.conf.broker_transport_options = {
+			"queue_order_strategy": "priority",
+			"priority_steps": list(range(10)),
+			"sep": ":",
+		}
+
+	profile_name = flask_app.config.get("CELERY_WORKER_PROFILE")
+	profile = None
+	if profile_name:
+		profile = (flask_app.config.get("CELERY_WORKER_PROFILES") or {}).get(profile_name)
+		if profile is None:
+			raise ValueError(f"Unknown CELERY_WORKER_PROFILE {profile_name!r}")
+		celery.conf.worker_prefetch_multiplier = profile.get("prefetch_multiplier", 1)
+		if profile.get("concurrency"):
+			celery.conf.worker_concurrency = profile["concurrency"]
+
+		@celeryd_init.connect(weak=False)
+		def _select_profile_queues(instance: Any = None, options: Any = None, **_: Any) -> None:
+			"""Consume the profile's queues unless ``-Q`` was given."""
+			if instance is not None and not (options or {}).get("queues"):
+				instance.app.amqp.queues.select(profile["queues"])
+
 	# Dev-only eager mode support
 	if flask_app.config.get("CELERY_TASK_ALWAYS_EAGER"):
 		celery.conf.task_always_eager = True
@@ -45,17 +110,50 @@ def make_celery(flask_config_name: str | None = None) -> Celery:
 		def __call__(self, *args: Any, **kwargs: Any):  # type: ignore[override]
 			try:
 				with flask_app.app_context():
-					return TaskBase.__call__(self, *args, **kwargs)
+					return super().__call__(*args, **kwargs)
 			except Exception as exc:  # noqa: BLE001
 				flask_app.logger.error("Celery task error: %s", exc)
 				raise
 
+		def push_request(self, *args: Any, **kwargs: Any) -> None:
+			# Task.__call__ pushes a bare request (args/kwargs only) over the one
+			# the worker or apply() set up; keep its id, retries and is_eager
+			outer = self.request_stack.top
+			if not args and outer is not None:
+				kwargs = {**vars(outer), **kwargs}
+			super().push_request(*args, **kwargs)
+
 	celery.Task = ContextTask  # type: ignore[assignment]
+
+	@worker_process_init.connect(weak=False)
+	def _warm_dedup_filter(**_: Any) -> None:
+		"""Load processed message ids into this worker's Bloom filter."""
+		from .services.dedup import warm_processed_filter
+
+		try:
+			with flask_app.app_context():
+				warm_processed_filter()
+		except Exception as exc:  # noqa: BLE001
+			flask_app.logger.error("Dedup filter warm-up failed: %s", exc)
+
 	return celery
 
 
+@worker_init.connect
+def _preload_gmail_discovery(**_: Any) -> None:
+	"""Parse the bundled discovery document before the pool forks."""
+	from .services.google_oauth import load_gmail_discovery
+
+	try:
+		load_gmail_discovery()
+	except Exception as exc:  # noqa: BLE001
+		logging.getLogger(__name__).error("Gmail discovery preload failed: %s", exc)
+
+
 # Create a default Celery instance for imports and eager mode usage
 celery = make_celery()
 
 # Worker entrypoint: `celery -A app.celery_app.celery worker --loglevel=info`
+# Per-queue workers: `CELERY_WORKER_PROFILE=llm celery -A app.celery_app.celery worker`
+# Scheduler entrypoint: `celery -A app.celery_app.celery beat --loglevel=info`
 
@@ -11,6 +11,19 @@ class BaseConfig:
 	# Celery / Redis
 	CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
 	CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", "redis://localhost:6379/0")
+	# Locks, coalescing and counters shared across processes (redis:// or memory://)
+	SHARED_STATE_URL = os.getenv("SHARED_STATE_URL", CELERY_BROKER_URL)
+	# Worker profile picks queues, prefetch and concurrency at launch (-Q/-c still override)
+	CELERY_WORKER_PROFILE = os.getenv("CELERY_WORKER_PROFILE", "")
+	CELERY_WORKER_PROFILES = {
+		# Short, latency-sensitive Pub/Sub history syncs
+		"ingest": {"queues": ["ingest"], "prefetch_multiplier": 4, "concurrency": 8},
+		# Prefetch 1 so high-priority triage is not stuck behind reserved batches
+		"llm": {"queues": ["llm"], "prefetch_multiplier": 1, "concurrency": 8},
+		"sync": {"queues": ["sync"], "prefetch_multiplier": 2, "concurrency": 8},
+		"maintenance": {"queues": ["maintenance"], "prefetch_multiplier": 1, "concurrency": 2},
+		"all": {"queues": ["ingest", "sync", "llm", "maintenance"], "prefetch_multiplier": 1},
+	}
 
 	# OAuth / Gmail placeholders
 	GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
@@ -21,6 +34,59 @@ class BaseConfig:
 		"https://www.googleapis.com/auth/userinfo.email",
 		"openid",
 	]
+	# Inner calls per Gmail batch HTTP request (API maximum is 100)
+	GMAIL_BATCH_SIZE = int(os.getenv("GMAIL_BATCH_SIZE", "50"))
+	# Per-process Gmail client pool
+	GMAIL_CLIENT_POOL_SIZE = int(os.getenv("GMAIL_CLIENT_POOL_SIZE", "256"))
+	GMAIL_CLIENT_POOL_TTL = int(os.getenv("GMAIL_CLIENT_POOL_TTL", "1800"))
+	GMAIL_HTTP_TIMEOUT = int(os.getenv("GMAIL_HTTP_TIMEOUT", "30"))
+	# Per-process cache of compacted conversations (threads.get)
+	THREAD_CACHE_SIZE = int(os.getenv("THREAD_CACHE_SIZE", "1024"))
+	THREAD_CACHE_TTL = float(os.getenv("THREAD_CACHE_TTL", "3600"))
+	# Async job API: record/result TTL, compression threshold, long-poll cap (s), bulk size
+	JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "3600"))
+	JOB_COMPRESS_MIN_BYTES = int(os.getenv("JOB_COMPRESS_MIN_BYTES", "1024"))
+	# Each long-poll holds a server thread (8 per worker); keep it short and let clients re-poll
+	JOB_LONG_POLL_MAX = float(os.getenv("JOB_LONG_POLL_MAX", "3"))
+	GMAIL_SYNC_BULK_MAX = int(os.getenv("GMAIL_SYNC_BULK_MAX", "1000"))
+	# Decoded body bytes kept per message; attachments are never decoded inline
+	GMAIL_BODY_MAX_BYTES = int(os.getenv("GMAIL_BODY_MAX_BYTES", str(256 * 1024)))
+	# Messages re-listed when the history cursor is missing or expired
+	GMAIL_RESYNC_MAX_MESSAGES = int(os.getenv("GMAIL_RESYNC_MAX_MESSAGES", "100"))
+	# Push notifications per user within this window share one history sync
+	GMAIL_COALESCE_WINDOW_MS = int(os.getenv("GMAIL_COALESCE_WINDOW_MS", "1000"))
+	GMAIL_SYNC_LOCK_TTL = int(os.getenv("GMAIL_SYNC_LOCK_TTL", "300"))
+	# Bloom filter in front of processed_messages lookups
+	DEDUP_BLOOM_ENABLED = os.getenv("DEDUP_BLOOM_ENABLED", "1") == "1"
+	DEDUP_BLOOM_CAPACITY = int(os.getenv("DEDUP_BLOOM_CAPACITY", "1000000"))
+	DEDUP_BLOOM_ERROR_RATE = float(os.getenv("DEDUP_BLOOM_ERROR_RATE", "0.001"))
+	DEDUP_BLOOM_REBUILD_SECONDS = int(os.getenv("DEDUP_BLOOM_REBUILD_SECONDS", "3600"))
+	# Tail period: checks in between skip the DB, but rows other workers wrote since the
+	# last tail read as unseen (a redelivery may be processed twice); 0 = tail every check
+	DEDUP_BLOOM_TAIL_INTERVAL = float(os.getenv("DEDUP_BLOOM_TAIL_INTERVAL", "5"))
+	# Seconds of rows each tail re-reads, covering ids committed out of order
+	DEDUP_BLOOM_TAIL_OVERLAP = float(os.getenv("DEDUP_BLOOM_TAIL_OVERLAP", "120"))
+	# Proactive token refresh (beat job period, look-ahead, spread, inline margin)
+	GMAIL_TOKEN_REFRESH_INTERVAL = int(os.getenv("GMAIL_TOKEN_REFRESH_INTERVAL", "60"))
+	GMAIL_TOKEN_REFRESH_AHEAD = int(os.getenv("GMAIL_TOKEN_REFRESH_AHEAD", "600"))
+	GMAIL_TOKEN_REFRESH_JITTER = int(os.getenv("GMAIL_TOKEN_REFRESH_JITTER", "120"))
+	GMAIL_TOKEN_REFRESH_MARGIN = int(os.getenv("GMAIL_TOKEN_REFRESH_MARGIN", "60"))
+	GMAIL_TOKEN_REFRESH_LOCK_TTL = int(os.getenv("GMAIL_TOKEN_REFRESH_LOCK_TTL", "30"))
+	# Token-bucket rate limits shared via SHARED_STATE_URL; longer waits reschedule the task
+	RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+	RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "10"))
+	# LLM calls made in HTTP requests answer 429 / "*_throttled" after this long instead
+	RATE_LIMIT_HTTP_MAX_WAIT = float(os.getenv("RATE_LIMIT_HTTP_MAX_WAIT", "0"))
+	# Gmail per-user quota (units/second; messages.get = 5, history.list = 2, ...)
+	GMAIL_QUOTA_UNITS_PER_SECOND = float(os.getenv("GMAIL_QUOTA_UNITS_PER_SECOND", "250"))
+	GMAIL_QUOTA_BURST = float(os.getenv("GMAIL_QUOTA_BURST", "250"))
+	# Periodic fleet sync (beat period, skip users synced within MIN_AGE, keyset page, users per task)
+	GMAIL_FLEET_SYNC_INTERVAL = int(os.getenv("GMAIL_FLEET_SYNC_INTERVAL", "900"))
+	GMAIL_FLEET_MIN_AGE = int(os.getenv("GMAIL_FLEET_MIN_AGE", "3600"))
+	GMAIL_FLEET_PAGE_SIZE = int(os.getenv("GMAIL_FLEET_PAGE_SIZE", "1000"))
+	GMAIL_FLEET_CHUNK_SIZE = int(os.getenv("GMAIL_FLEET_CHUNK_SIZE", "25"))
+	# A cycle still unfinished this long after it started is presumed dead; the next beat starts afresh
+	GMAIL_FLEET_CYCLE_TTL = int(os.getenv("GMAIL_FLEET_CYCLE_TTL", str(2 * GMAIL_FLEET_SYNC_INTERVAL)))
 
 	# LLM API Keys
 	OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -28,6 +94,68 @@ class BaseConfig:
 	GROQ_API_KEY = os.environ["GROQ_API_KEY"]
 	GROQ_MODEL_NAME = os.environ["GROQ_MODEL_NAME"]
 
+	# Shared LLM HTTP clients (keep-alive pool and timeouts)
+	LLM_HTTP_TIMEOUT = float(os.getenv("LLM_HTTP_TIMEOUT", "60"))
+	LLM_HTTP_CONNECT_TIMEOUT = float(os.getenv("LLM_HTTP_CONNECT_TIMEOUT", "5"))
+	LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "20"))
+	LLM_HTTP_MAX_KEEPALIVE = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE", "10"))
+	LLM_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY", "30"))
+	LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+	# /llm/*/batch: max prompts per request and concurrent provider calls
+	LLM_BATCH_MAX_ITEMS = int(os.getenv("LLM_BATCH_MAX_ITEMS", "500"))
+	LLM_BATCH_CONCURRENCY = int(os.getenv("LLM_BATCH_CONCURRENCY", "8"))
+	# Email classification stage: provider, per-call timeout (s) and in-flight calls per provider
+	LLM_CLASSIFY_PROVIDER = os.getenv("LLM_CLASSIFY_PROVIDER", "groq")
+	LLM_CLASSIFY_MODEL = os.getenv("LLM_CLASSIFY_MODEL") or None
+	LLM_CLASSIFY_TIMEOUT = float(os.getenv("LLM_CLASSIFY_TIMEOUT", "20"))
+	LLM_CONCURRENCY = {
+		"groq": int(os.getenv("GROQ_CONCURRENCY", "8")),
+		"openai": int(os.getenv("OPENAI_CONCURRENCY", "8")),
+		"anthropic": int(os.getenv("ANTHROPIC_CONCURRENCY", "8")),
+	}
+	# Settle newsletters, automated mail and clear refund requests without an LLM call
+	PREFILTER_ENABLED = os.getenv("PREFILTER_ENABLED", "1") == "1"
+	# Per-process order-number cache for refund matching (hits, then misses)
+	ORDER_CACHE_SIZE = int(os.getenv("ORDER_CACHE_SIZE", "10000"))
+	ORDER_CACHE_TTL = float(os.getenv("ORDER_CACHE_TTL", "300"))
+	ORDER_CACHE_NEGATIVE_TTL = float(os.getenv("ORDER_CACHE_NEGATIVE_TTL", "60"))
+	# Send undecided emails to the llm queue (llm.triage) instead of classifying inline
+	LLM_TRIAGE_ASYNC = os.getenv("LLM_TRIAGE_ASYNC", "1") == "1"
+	LLM_TRIAGE_BATCH_SIZE = int(os.getenv("LLM_TRIAGE_BATCH_SIZE", "20"))
+	# Held emails not triaged within REQUEUE_AFTER seconds are queued again (LLM_TRIAGE_REQUEUE_LIMIT
+	# per beat run, every LLM_TRIAGE_REQUEUE_INTERVAL) and dropped after PENDING_MAX_AGE
+	LLM_TRIAGE_REQUEUE_INTERVAL = float(os.getenv("LLM_TRIAGE_REQUEUE_INTERVAL", "300"))
+	LLM_TRIAGE_REQUEUE_AFTER = float(os.getenv("LLM_TRIAGE_REQUEUE_AFTER", "900"))
+	LLM_TRIAGE_REQUEUE_LIMIT = int(os.getenv("LLM_TRIAGE_REQUEUE_LIMIT", "1000"))
+	LLM_TRIAGE_PENDING_MAX_AGE = float(os.getenv("LLM_TRIAGE_PENDING_MAX_AGE", "86400"))
+	# Email body budget (estimated tokens) after compaction; add model or provider names as keys
+	LLM_BODY_TOKEN_BUDGET = {
+		"default": int(os.getenv("LLM_BODY_TOKEN_BUDGET", "1500")),
+	}
+	# Earlier-conversation budget (estimated tokens) added to the prompt for replies
+	LLM_THREAD_TOKEN_BUDGET = int(os.getenv("LLM_THREAD_TOKEN_BUDGET", "1000"))
+	# Re-asks after a structured reply fails schema validation (after local repair)
+	LLM_STRUCTURED_RETRIES = int(os.getenv("LLM_STRUCTURED_RETRIES", "1"))
+	# Provider requests/tokens per minute; add "provider:model" keys for per-model limits
+	LLM_RATE_LIMITS = {
+		"groq": {"rpm": int(os.getenv("GROQ_RPM", "30")), "tpm": int(os.getenv("GROQ_TPM", "6000"))},
+		"openai": {"rpm": int(os.getenv("OPENAI_RPM", "500")), "tpm": int(os.getenv("OPENAI_TPM", "200000"))},
+		"anthropic": {"rpm": int(os.getenv("ANTHROPIC_RPM", "50")), "tpm": int(os.getenv("ANTHROPIC_TPM", "40000"))},
+	}
+	# Output tokens reserved against TPM per request
+	LLM_RATE_OUTPUT_TOKENS = int(os.getenv("LLM_RATE_OUTPUT_TOKENS", "512"))
+	# Completion cache: memory:// (per process), redis://... or empty to disable
+	LLM_CACHE_URL = os.getenv("LLM_CACHE_URL", CELERY_BROKER_URL)
+	LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "3600"))
+	LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024"))
+	LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+	# Near-duplicate reply reuse for Groq drafts (memory-mapped, needs numpy). Opt-in:
+	# only order-number-like tokens are swapped, so names and addresses would carry over
+	SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "0") == "1"
+	SEMANTIC_CACHE_DIR = os.getenv("SEMANTIC_CACHE_DIR")  # default: <instance>/semantic_cache
+	SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+	SEMANTIC_CACHE_DIM = int(os.getenv("SEMANTIC_CACHE_DIM", "512"))
+
 
 class DevelopmentConfig(BaseConfig):
 	DEBUG = True
@@ -36,6 +164,8 @@ class DevelopmentConfig(BaseConfig):
 	CELERY_TASK_ALWAYS_EAGER = True
 	CELERY_BROKER_URL = "memory://"
 	CELERY_RESULT_BACKEND = "cache+memory://"
+	SHARED_STATE_URL = "memory://"
+	LLM_CACHE_URL = "memory://"
 
 
 class ProductionConfig(BaseConfig):
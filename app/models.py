@@ -31,6 +31,10 @@ class GmailToken(db.Model, TimestampMixin):  # type: ignore[arg-type]
 	token_expiry = db.Column(db.DateTime, nullable=True)
 	token_scope = db.Column(db.Text, nullable=True)
 	token_type = db.Column(db.String(50), nullable=True)
+	# Gmail historyId already synced; incremental history.list starts here
+	last_history_id = db.Column(db.BigInteger, nullable=True)
+	# Last successful sync_user_gmail run; the fleet sync skips recent ones
+	last_synced_at = db.Column(db.DateTime, nullable=True)
 
 
 class ProcessedMessage(db.Model, TimestampMixin):  # type: ignore[arg-type]
@@ -41,6 +45,15 @@ class ProcessedMessage(db.Model, TimestampMixin):  # type: ignore[arg-type]
 	user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
 
 
+class PendingTriage(db.Model, TimestampMixin):  # type: ignore[arg-type]
+	__tablename__ = "pending_triage"
+
+	# Ingested message still waiting on LLM triage; deleted when its verdict is saved
+	gmail_message_id = db.Column(db.String(255), unique=True, nullable=False)
+	user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+	importance = db.Column(db.String(16), nullable=False, default="medium")  # queue priority
+
+
 class Order(db.Model, TimestampMixin):  # type: ignore[arg-type]
 	__tablename__ = "orders"
 
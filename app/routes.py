@@ -1,7 +1,88 @@
-from flask import Flask, render_template, request
+import json
+import math
+from typing import Callable, Iterator, Optional
+
+from celery import group
+from flask import Flask, Response, render_template, request, stream_with_context, url_for
 from .blueprints.oauth import bp as oauth_bp
 from .tasks.gmail import sync_user_gmail
-from .services.llm import safe_openai_complete, safe_anthropic_complete, safe_groq_complete
+from .services.llm import (
+	safe_openai_complete,
+	safe_anthropic_complete,
+	safe_groq_complete,
+	batch_openai_complete,
+	batch_anthropic_complete,
+	batch_groq_complete,
+	stream_openai_complete,
+	stream_anthropic_complete,
+	stream_groq_complete,
+)
+from .services import metrics
+from .services.jobs import (
+	create_group,
+	create_job,
+	get_job,
+	job_etag,
+	job_status,
+	update_job,
+	wait_for_change,
+)
+from .services.classifier import triage_email
+from .services.ratelimit import RateLimited
+
+
+def _wants_stream(payload: dict) -> bool:
+	return payload.get("stream") is True or "text/event-stream" in request.headers.get("Accept", "")
+
+
+def _sse_response(app: Flask, provider: str, chunks: Iterator[str]) -> Response:
+	"""Relay text deltas as server-sent events.
+
+	When the client disconnects the WSGI server closes this generator, which
+	closes ``chunks`` and cancels the upstream provider stream.
+	"""
+	def _events() -> Iterator[str]:
+		try:
+			for chunk in chunks:
+				yield f"data: {json.dumps({'text': chunk})}\n\n"
+			yield "event: done\ndata: {}\n\n"
+		except Exception as exc:  # noqa: BLE001
+			app.logger.error("%s stream error: %s", provider, exc)
+			yield f"event: error\ndata: {json.dumps({'error': f'{provider}_failed'})}\n\n"
+		finally:
+			close = getattr(chunks, "close", None)
+			if close is not None:
+				close()
+
+	return Response(
+		stream_with_context(_events()),
+		mimetype="text/event-stream",
+		headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+	)
+
+
+def _throttled(provider: str, exc: RateLimited) -> tuple[dict, int, dict]:
+	"""429 for a provider bucket that cannot pay for the call right now."""
+	retry_after = max(1, math.ceil(exc.retry_after))
+	return {"error": f"{provider}_throttled", "retry_after": retry_after}, 429, {"Retry-After": str(retry_after)}
+
+
+def _batch_prompts(app: Flask, payload: dict) -> Optional[list[str]]:
+	"""``payload["prompts"]`` if it is a non-empty, bounded list of strings."""
+	prompts = payload.get("prompts")
+	limit = int(app.config.get("LLM_BATCH_MAX_ITEMS", 500))
+	if not isinstance(prompts, list) or not prompts or len(prompts) > limit:
+		return None
+	if not all(isinstance(p, str) and p.strip() for p in prompts):
+		return None
+	return [p.strip() for p in prompts]
+
+
+def _batch_concurrency_arg(payload: dict) -> Optional[int]:
+	try:
+		return int(payload["max_concurrency"]) if payload.get("max_concurrency") else None
+	except (TypeError, ValueError):
+		return None
 
 
 def register_routes(app: Flask) -> None:
@@ -9,24 +90,73 @@ def register_routes(app: Flask) -> None:
 	def health() -> tuple[dict, int]:
 		return {"ok": True}, 200
 
+	@app.get("/metrics")
+	def metrics_snapshot() -> tuple[dict, int]:
+		return metrics.snapshot(), 200
+
 	# Register OAuth blueprint
 	app.register_blueprint(oauth_bp)
 
 	@app.post("/gmail/sync/<int:user_id>")
 	def gmail_sync(user_id: int):
+		job = create_job("gmail.sync_user", user_id=user_id)
+		if not _enqueue(job["id"], lambda: sync_user_gmail.apply_async(args=[user_id], task_id=job["id"])):
+			return {"error": "enqueue_failed"}, 503
+		return _accepted(job["id"])
+
+	@app.post("/gmail/sync")
+	def gmail_sync_bulk():
+		payload = request.get_json(silent=True) or {}
+		user_ids = payload.get("user_ids")
+		limit = int(app.config.get("GMAIL_SYNC_BULK_MAX", 1000))
+		if (
+			not isinstance(user_ids, list) or not user_ids or len(user_ids) > limit
+			or not all(isinstance(uid, int) and not isinstance(uid, bool) for uid in user_ids)
+		):
+			return {"error": "invalid_user_ids"}, 400
+		user_ids = list(dict.fromkeys(user_ids))
+		group_job = create_group("gmail.sync_user", size=len(user_ids))
+		signatures = []
+		for uid in user_ids:
+			child = create_job("gmail.sync_user", user_id=uid, group_id=group_job["id"])
+			signatures.append(sync_user_gmail.si(uid).set(task_id=child["id"]))
+		if not _enqueue(group_job["id"], lambda: group(signatures).apply_async(task_id=group_job["id"])):
+			return {"error": "enqueue_failed"}, 503
+		return _accepted(group_job["id"], group_id=group_job["id"], jobs=[sig.id for sig in signatures])
+
+	@app.get("/jobs/<job_id>")
+	def job_status_view(job_id: str):
 		try:
-			res = sync_user_gmail.delay(user_id)
-			# Eager mode returns result immediately; otherwise return task id
-			if hasattr(res, "get"):
-				try:
-					data = res.get(timeout=30)
-					return data, 200
-				except Exception:  # noqa: BLE001
-					return {"task_id": getattr(res, "id", None)}, 202
-			return {"task_id": getattr(res, "id", None)}, 202
+			wait = max(0.0, min(float(request.args.get("wait", 0)), float(app.config.get("JOB_LONG_POLL_MAX", 3))))
+		except ValueError:
+			return {"error": "invalid_wait"}, 400
+		etag = request.headers.get("If-None-Match")
+		record = wait_for_change(job_id, etag, wait) if wait and etag else job_status(job_id)
+		if record is None:
+			return {"error": "not_found"}, 404
+		current = job_etag(record)
+		headers = {"ETag": current, "Cache-Control": "no-cache"}
+		if etag == current:
+			return "", 304, headers
+		return record, 200, headers
+
+	def _enqueue(job_id: str, send: Callable[[], object]) -> bool:
+		"""Hand a job to Celery; False (job marked failed) if the broker is unavailable."""
+		try:
+			send()
 		except Exception as exc:  # noqa: BLE001
-			app.logger.error("Gmail sync trigger failed: %s", exc)
-			return {"error": "sync_failed"}, 500
+			# Eager mode runs the task inline; its own failure is already recorded
+			record = get_job(job_id)
+			if record is not None and record["state"] != "queued":
+				return True
+			app.logger.error("Job %s could not be enqueued: %s", job_id, exc)
+			update_job(job_id, "failed", error="enqueue_failed")
+			return False
+		return True
+
+	def _accepted(job_id: str, **extra: object) -> tuple[dict, int, dict]:
+		location = url_for("job_status_view", job_id=job_id)
+		return {"job_id": job_id, "status_url": location, **extra}, 202, {"Location": location}
 
 	@app.get("/ui")
 	def ui():
@@ -41,9 +171,15 @@ def register_routes(app: Flask) -> None:
 		try:
 			payload = request.get_json(silent=True) or {}
 			prompt = (payload.get("prompt") or "Say hello briefly.").strip()
+			use_cache = payload.get("cache") is not False
 			model = (payload.get("model") or "gpt-4o-mini").strip()
-			text = safe_openai_complete(prompt, model=model)
+			if _wants_stream(payload):
+				chunks = stream_openai_complete(prompt, model=model, cache=use_cache)
+				return _sse_response(app, "openai", chunks)
+			text = safe_openai_complete(prompt, model=model, cache=use_cache)
 			return {"text": text}, 200
+		except RateLimited as exc:
+			return _throttled("openai", exc)
 		except Exception as exc:  # noqa: BLE001
 			app.logger.error("OpenAI route error: %s", exc)
 			return {"error": "openai_failed"}, 500
@@ -53,9 +189,15 @@ def register_routes(app: Flask) -> None:
 		try:
 			payload = request.get_json(silent=True) or {}
 			prompt = (payload.get("prompt") or "Say hello briefly.").strip()
+			use_cache = payload.get("cache") is not False
 			model = (payload.get("model") or "claude-3-5-sonnet-20240620").strip()
-			text = safe_anthropic_complete(prompt, model=model)
+			if _wants_stream(payload):
+				chunks = stream_anthropic_complete(prompt, model=model, cache=use_cache)
+				return _sse_response(app, "anthropic", chunks)
+			text = safe_anthropic_complete(prompt, model=model, cache=use_cache)
 			return {"text": text}, 200
+		except RateLimited as exc:
+			return _throttled("anthropic", exc)
 		except Exception as exc:  # noqa: BLE001
 			app.logger.error("Anthropic route error: %s", exc)
 			return {"error": "anthropic_failed"}, 500
@@ -65,8 +207,87 @@ def register_routes(app: Flask) -> None:
 		try:
 			payload = request.get_json(silent=True) or {}
 			prompt = (payload.get("prompt") or "Say hello briefly.").strip()
-			text = safe_groq_complete(prompt)
+			use_cache = payload.get("cache") is not False
+			if _wants_stream(payload):
+				chunks = stream_groq_complete(prompt, cache=use_cache)
+				return _sse_response(app, "groq", chunks)
+			text = safe_groq_complete(prompt, cache=use_cache)
 			return {"text": text}, 200
+		except RateLimited as exc:
+			return _throttled("groq", exc)
 		except Exception as exc:  # noqa: BLE001
 			app.logger.error("Groq route error: %s", exc)
 			return {"error": "groq_failed"}, 500
+
+	@app.post("/llm/openai/batch")
+	def llm_openai_batch():
+		try:
+			payload = request.get_json(silent=True) or {}
+			prompts = _batch_prompts(app, payload)
+			if prompts is None:
+				return {"error": "invalid_prompts"}, 400
+			model = (payload.get("model") or "gpt-4o-mini").strip()
+			results = batch_openai_complete(
+				prompts,
+				model=model,
+				max_concurrency=_batch_concurrency_arg(payload),
+				cache=payload.get("cache") is not False,
+			)
+			return {"results": results}, 200
+		except Exception as exc:  # noqa: BLE001
+			app.logger.error("OpenAI batch route error: %s", exc)
+			return {"error": "openai_failed"}, 500
+
+	@app.post("/llm/anthropic/batch")
+	def llm_anthropic_batch():
+		try:
+			payload = request.get_json(silent=True) or {}
+			prompts = _batch_prompts(app, payload)
+			if prompts is None:
+				return {"error": "invalid_prompts"}, 400
+			model = (payload.get("model") or "claude-3-5-sonnet-20240620").strip()
+			results = batch_anthropic_complete(
+				prompts,
+				model=model,
+				max_concurrency=_batch_concurrency_arg(payload),
+				cache=payload.get("cache") is not False,
+			)
+			return {"results": results}, 200
+		except Exception as exc:  # noqa: BLE001
+			app.logger.error("Anthropic batch route error: %s", exc)
+			return {"error": "anthropic_failed"}, 500
+
+	@app.post("/llm/groq/batch")
+	def llm_groq_batch():
+		try:
+			payload = request.get_json(silent=True) or {}
+			prompts = _batch_prompts(app, payload)
+			if prompts is None:
+				return {"error": "invalid_prompts"}, 400
+			results = batch_groq_complete(
+				prompts,
+				max_concurrency=_batch_concurrency_arg(payload),
+				cache=payload.get("cache") is not False,
+			)
+			return {"results": results}, 200
+		except Exception as exc:  # noqa: BLE001
+			app.logger.error("Groq batch route error: %s", exc)
+			return {"error": "groq_failed"}, 500
+
+	@app.post("/llm/triage")
+	def llm_triage():
+		try:
+			payload = request.get_json(silent=True) or {}
+			email = {
+				"subject": payload.get("subject") or "",
+				"from": payload.get("from") or "",
+				"body": payload.get("body") or "",
+			}
+			if not email["body"].strip():
+				return {"error": "missing_body"}, 400
+			return triage_email(email, provider=payload.get("provider"), draft_reply=True), 200
+		except RateLimited as exc:
+			return _throttled("triage", exc)
+		except Exception as exc:  # noqa: BLE001
+			app.logger.error("Triage route error: %s", exc)
+			return {"error": "triage_failed"}, 500
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import hashlib
+import math
+from typing import Iterable
+
+
+class BloomFilter:
+	"""Fixed-size Bloom filter over strings.
+
+	Answers "definitely not added" or "maybe added"; the false-positive rate
+	stays near ``error_rate`` until more than ``capacity`` items are added.
+	"""
+
+	def __init__(self, capacity: int, error_rate: float = 0.001) -> None:
+		capacity = max(1, int(capacity))
+		error_rate = min(max(error_rate, 1e-9), 0.5)
+		self.capacity = capacity
+		self.error_rate = error_rate
+		self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+		self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+		self.count = 0
+		self._bits = bytearray((self.num_bits + 7) // 8)
+
+	def _positions(self, item: str) -> Iterable[int]:
+		# Kirsch-Mitzenmacher double hashing over one 128-bit digest
+		digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+		h1 = int.from_bytes(digest[:8], "little")
+		h2 = int.from_bytes(digest[8:], "little") | 1
+		num_bits = self.num_bits
+		return ((h1 + i * h2) % num_bits for i in range(self.num_hashes))
+
+	def add(self, item: str) -> None:
+		bits = self._bits
+		for pos in self._positions(item):
+			bits[pos >> 3] |= 1 << (pos & 7)
+		self.count += 1
+
+	def update(self, items: Iterable[str]) -> None:
+		for item in items:
+			self.add(item)
+
+	def __contains__(self, item: str) -> bool:
+		bits = self._bits
+		return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+	@property
+	def saturated(self) -> bool:
+		return self.count > self.capacity
@@ -0,0 +1,248 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parseaddr
+from typing import Any, Optional
+
+from flask import current_app
+
+from app.extensions import db
+from app.models import UnhandledEmail
+
+from . import metrics
+from .compaction import compact_body, token_budget
+from .llm import structured_complete
+from .prefilter import preclassify_emails
+from .ratelimit import RateLimited
+from .refunds import record_refunds
+from .structured import StructuredOutputError
+
+CLASSIFY_TEMPLATE = "\n".join([
+	"You triage customer emails for a shop. Classify the email, extract the",
+	"order number it refers to (if any), rate its importance and give a short",
+	"reason.{reply_instruction}",
+	"",
+	"Subject: {subject}",
+	"From: {sender}",
+	"",
+	"{body}",
+])
+
+THREAD_CONTEXT_TEMPLATE = "\n".join([
+	"Earlier messages in this conversation, oldest first:",
+	"",
+	"{history}",
+])
+
+REPLY_INSTRUCTION = " Also draft a polite reply to the customer."
+
+# One call fills every field; strict-mode compatible (all required, no extras).
+# Ingestion stores no reply, so only TRIAGE_SCHEMA (/llm/triage) pays for one.
+CLASSIFY_SCHEMA: dict[str, Any] = {
+	"type": "object",
+	"additionalProperties": False,
+	"required": ["category", "order_number", "importance", "reason"],
+	"properties": {
+		"category": {"type": "string", "enum": ["refund", "other"]},
+		"order_number": {"type": ["string", "null"]},
+		"importance": {"type": "string", "enum": ["low", "medium", "high"]},
+		"reason": {"type": "string"},
+	},
+}
+
+TRIAGE_SCHEMA: dict[str, Any] = {
+	**CLASSIFY_SCHEMA,
+	"required": [*CLASSIFY_SCHEMA["required"], "reply"],
+	"properties": {**CLASSIFY_SCHEMA["properties"], "reply": {"type": "string"}},
+}
+
+_SNIPPET = 500
+
+
+def _prompt(email: dict[str, Any], body: str, draft_reply: bool = False) -> str:
+	prompt = CLASSIFY_TEMPLATE.format(
+		reply_instruction=REPLY_INSTRUCTION if draft_reply else "",
+		subject=email.get("subject") or "",
+		sender=email.get("from") or "",
+		body=body,
+	)
+	# Replies carry the earlier conversation (see threads.attach_thread_context)
+	if email.get("thread_context"):
+		prompt = f"{prompt}\n\n{THREAD_CONTEXT_TEMPLATE.format(history=email['thread_context'])}"
+	return prompt
+
+
+def _fallback(reason: str) -> dict[str, Any]:
+	# Unclassifiable mail is kept for a human rather than dropped
+	return {
+		"category": "other",
+		"order_number": None,
+		"importance": "medium",
+		"reason": reason,
+		"reply": None,
+		"source": "llm",
+	}
+
+
+def _verdict(data: dict[str, Any]) -> dict[str, Any]:
+	"""Normalise a schema-valid triage object into a classification result."""
+	return {
+		"category": data["category"],
+		"order_number": (data["order_number"] or "").lstrip("#").strip()[:64] or None,
+		"importance": data["importance"],
+		"reason": (data["reason"] or "llm")[:64],
+		"reply": data.get("reply"),
+		"source": "llm",
+	}
+
+
+def triage_email(
+	email: dict[str, Any], provider: Optional[str] = None, draft_reply: bool = False
+) -> dict[str, Any]:
+	"""Classify one email (and with ``draft_reply`` draft its reply) in a single structured LLM call.
+
+	The body is compacted to the model's token budget first.
+	"""
+	cfg = current_app.config
+	provider = provider or cfg.get("LLM_CLASSIFY_PROVIDER", "groq")
+	model = cfg.get("LLM_CLASSIFY_MODEL")
+	compacted = compact_body(email.get("body") or "", token_budget(model, provider))
+	data = structured_complete(
+		provider,
+		_prompt(email, compacted["body"], draft_reply),
+		TRIAGE_SCHEMA if draft_reply else CLASSIFY_SCHEMA,
+		name="triage",
+		model=model,
+	)
+	return {**_verdict(data), "tokens_saved": compacted["tokens_saved"]}
+
+
+async def _classify_one(
+	email: dict[str, Any],
+	provider: str,
+	semaphore: asyncio.Semaphore,
+	executor: ThreadPoolExecutor,
+	timeout: float,
+) -> dict[str, Any]:
+	async with semaphore:
+		started = time.perf_counter()
+		# Run in a copy of the current context so the thread sees the app context
+		call = contextvars.copy_context().run
+		try:
+			return await asyncio.wait_for(
+				asyncio.get_running_loop().run_in_executor(executor, call, triage_email, email, provider),
+				timeout,
+			)
+		except asyncio.TimeoutError:
+			metrics.incr("llm.classify.timeout")
+			return _fallback("llm_timeout")
+		except RateLimited as exc:
+			metrics.incr("llm.classify.throttled")
+			return {**_fallback("llm_throttled"), "retry_after": exc.retry_after}
+		except StructuredOutputError as exc:
+			current_app.logger.warning("Unusable classification for %s: %s", email.get("id"), exc)
+			metrics.incr("llm.classify.invalid")
+			return _fallback("llm_invalid")
+		except Exception as exc:  # noqa: BLE001
+			current_app.logger.error("Classification of %s failed: %s", email.get("id"), exc)
+			metrics.incr("llm.classify.error")
+			return _fallback("llm_error")
+		finally:
+			metrics.observe(f"llm.classify.{provider}", time.perf_counter() - started)
+
+
+async def classify_emails_async(emails: list[dict[str, Any]]) -> list[dict[str, Any]]:
+	"""Classify ``emails`` concurrently, at most the provider's limit in flight.
+
+	Each call is bounded by ``LLM_CLASSIFY_TIMEOUT``; a timeout or error
+	yields an ``other`` verdict instead of failing the batch. Results are in
+	input order.
+	"""
+	cfg = current_app.config
+	provider = cfg.get("LLM_CLASSIFY_PROVIDER", "groq")
+	limit = max(1, int((cfg.get("LLM_CONCURRENCY") or {}).get(provider, 8)))
+	timeout = float(cfg.get("LLM_CLASSIFY_TIMEOUT", 20))
+	semaphore = asyncio.Semaphore(limit)
+	# Provider clients are synchronous and pooled; give every permit a thread.
+	# Timed-out calls are abandoned, not waited for, when the batch finishes.
+	executor = ThreadPoolExecutor(max_workers=limit, thread_name_prefix="llm-classify")
+	try:
+		return list(await asyncio.gather(*(
+			_classify_one(email, provider, semaphore, executor, timeout)
+			for email in emails
+		)))
+	finally:
+		executor.shutdown(wait=False)
+
+
+def rule_verdicts(emails: list[dict[str, Any]]) -> list[Optional[dict[str, Any]]]:
+	"""Pre-classifier verdicts, ``None`` where the LLM is needed (all, if disabled)."""
+	if current_app.config.get("PREFILTER_ENABLED", True):
+		return preclassify_emails(emails)
+	return [None] * len(emails)
+
+
+def classify_emails(emails: list[dict[str, Any]], prefilter: bool = True) -> list[dict[str, Any]]:
+	"""Synchronous entry point for Celery tasks (runs its own event loop).
+
+	Obvious mail is settled by the rule pre-classifier; only the ambiguous
+	rest is sent to the LLM. Pass ``prefilter=False`` for emails the rules
+	have already seen.
+	"""
+	if not emails:
+		return []
+	verdicts = rule_verdicts(emails) if prefilter else [None] * len(emails)
+	pending = [email for email, verdict in zip(emails, verdicts) if verdict is None]
+	llm_results: list[dict[str, Any]] = []
+	if pending:
+		started = time.perf_counter()
+		llm_results = asyncio.run(classify_emails_async(pending))
+		metrics.observe("llm.classify.batch", time.perf_counter() - started)
+		metrics.incr("llm.classify.emails", len(pending))
+	remaining = iter(llm_results)
+	return [verdict if verdict is not None else next(remaining) for verdict in verdicts]
+
+
+def save_classifications(
+	user_id: int,
+	emails: list[dict[str, Any]],
+	results: list[dict[str, Any]],
+) -> dict[str, int]:
+	"""Stage refund / not-found / unhandled rows for a batch without committing.
+
+	Orders are resolved in one go and rows are inserted in bulk, so the
+	caller's commit writes the whole batch in a single transaction.
+	"""
+	counts = {"refund": 0, "not_found": 0, "unhandled": 0, "llm_avoided": 0, "tokens_saved": 0}
+	refunds: list[dict[str, Any]] = []
+	unhandled: list[dict[str, Any]] = []
+	for email, result in zip(emails, results):
+		if result.get("source") == "rules":
+			counts["llm_avoided"] += 1
+		counts["tokens_saved"] += result.get("tokens_saved", 0)
+		if result["category"] == "refund":
+			refunds.append({
+				"order_number": result["order_number"],
+				"requester_email": parseaddr(email.get("from") or "")[1] or (email.get("from") or ""),
+				"reason": result["reason"],
+				"conversation_thread_id": email.get("threadId"),
+			})
+		else:
+			unhandled.append({
+				"user_id": user_id,
+				"subject": email.get("subject"),
+				"body_snippet": (email.get("body") or "")[:_SNIPPET],
+				"importance": result["importance"],
+				"reason": result["reason"],
+			})
+	if refunds:
+		counts.update(record_refunds(refunds))
+	if unhandled:
+		db.session.execute(UnhandledEmail.__table__.insert(), unhandled)
+		counts["unhandled"] = len(unhandled)
+	for name in ("refund", "not_found", "unhandled"):
+		metrics.incr(f"llm.classify.{name}", counts[name])
+	return counts
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import time
+from typing import Optional
+
+from flask import current_app
+
+from .store import acquire_lock, get_store, release_lock
+
+# Gmail pushes once per mailbox change; bursts for one user collapse into a
+# single history sync per window, with at most one sync in flight per user.
+
+_MAX_KEY = "gmail:history:max:{}"
+_PENDING_KEY = "gmail:history:pending:{}"
+_LOCK_KEY = "gmail:history:lock:{}"
+
+
+def coalesce_window() -> float:
+	"""Debounce window in seconds (``GMAIL_COALESCE_WINDOW_MS``)."""
+	return max(0, int(current_app.config.get("GMAIL_COALESCE_WINDOW_MS", 1000))) / 1000
+
+
+def _lock_ttl() -> float:
+	return float(current_app.config.get("GMAIL_SYNC_LOCK_TTL", 300))
+
+
+def register_notification(email: str, history_id: int) -> bool:
+	"""Record a push; returns True if the caller should schedule a sync.
+
+	The highest historyId seen is kept per user. Only the first notification
+	of a window gets True, the rest ride along with the already-queued sync.
+	"""
+	store = get_store()
+	horizon = coalesce_window() + _lock_ttl()
+	store.max_int(_MAX_KEY.format(email), int(history_id), ttl=horizon)
+	return store.set_nx(_PENDING_KEY.format(email), 1, ttl=horizon)
+
+
+def cancel_notification(email: str) -> None:
+	"""Drop the pending flag after failing to schedule its sync, so the next push schedules one."""
+	get_store().delete(_PENDING_KEY.format(email))
+
+
+def begin_sync(email: str, wait: bool = False) -> tuple[Optional[str], Optional[int]]:
+	"""Take the per-user sync lock and claim pending notifications.
+
+	Returns ``(owner, highest_history_id)``; ``owner`` is None when another
+	sync is in flight. With ``wait`` (eager mode) the call blocks until the
+	lock frees up or its TTL passes.
+	"""
+	store = get_store()
+	ttl = _lock_ttl()
+	deadline = time.monotonic() + ttl
+	owner = acquire_lock(_LOCK_KEY.format(email), ttl)
+	while owner is None and wait and time.monotonic() < deadline:
+		time.sleep(0.05)
+		owner = acquire_lock(_LOCK_KEY.format(email), ttl)
+	if owner is None:
+		return None, None
+
+	# Clear the flag before syncing so pushes that land mid-sync schedule a follow-up
+	store.delete(_PENDING_KEY.format(email))
+	highest = store.get(_MAX_KEY.format(email))
+	return owner, int(highest) if highest is not None else None
+
+
+def end_sync(email: str, owner: str) -> None:
+	release_lock(_LOCK_KEY.format(email), owner)
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import re
+from typing import Any, Optional
+
+from flask import current_app
+
+from . import metrics
+
+# "On Mon, 1 Jan 2024 at 10:00, Ann <a@b.c> wrote:" (clients may wrap it over two lines)
+_REPLY_HEADER_RE = re.compile(r"^\s*(?:On\s.{0,200}wrote:|Le\s.{0,200}a écrit\s?:|Am\s.{0,200}schrieb.{0,40}:)\s*$", re.IGNORECASE)
+_ORIGINAL_RE = re.compile(r"^\s*-{2,}\s*(?:Original Message|Reply message)\s*-{2,}\s*$", re.IGNORECASE)
+_OUTLOOK_FROM_RE = re.compile(r"^\s*\*?From:\*?\s.+$", re.IGNORECASE)
+_OUTLOOK_NEXT_RE = re.compile(r"^\s*\*?(?:Sent|Date|To):\*?\s", re.IGNORECASE)
+_FORWARD_RE = re.compile(r"^\s*-{2,}\s*Forwarded message\s*-{2,}\s*$|^\s*Begin forwarded message:\s*$", re.IGNORECASE)
+_FORWARD_HEADER_RE = re.compile(r"^\s*(?:From|Date|Sent|Subject|To|Cc|Reply-To):\s", re.IGNORECASE)
+_SIGNATURE_RE = re.compile(
+	r"^(?:-- ?|__+|Sent from my \w+.*|Get Outlook for \w+.*|Sent from (?:Mail|Yahoo Mail|Outlook) for .*)$",
+	re.IGNORECASE,
+)
+# Disclaimer sentences, not keywords: a customer may well write "unsubscribe" or "confidential"
+_BOILERPLATE_RE = re.compile(
+	r"this (?:e-?mail|message)(?: and any (?:files|attachments)(?: transmitted with it)?)? (?:is|are|may be|may contain)"
+	r" (?:strictly )?(?:confidential|privileged|intended)"
+	r"|intended (?:solely|only) for the (?:use of the )?(?:individual|addressee|named recipient|recipient)s?"
+	r"|if you (?:have )?received this (?:e-?mail|message|communication) in error"
+	r"|please consider the environment before printing"
+	r"|(?:click here|to stop receiving these e-?mails|you are receiving this e-?mail because)[^.\n]{0,80}unsubscribe"
+	r"|unsubscribe from (?:this|our) (?:mailing list|newsletter)",
+	re.IGNORECASE,
+)
+_SPACES_RE = re.compile(r"[ \t\u00a0]+")
+_TRUNCATION_MARK = "\n[...]\n"
+
+
+def estimate_tokens(text: str) -> int:
+	"""Cheap token estimate (~4 characters per token for English text)."""
+	return (len(text) + 3) // 4
+
+
+def strip_noise(text: str) -> str:
+	"""Drop quoted history, forwarded headers, signatures and legal boilerplate.
+
+	One pass over the lines. A reply attribution ("On ... wrote:") is skipped
+	along with the quoted block under it, so bottom-posted and inline answers
+	survive; it only ends the message when nothing but quotes follows. A
+	signature delimiter or an unquoted original-message header ends it
+	outright. Disclaimer paragraphs are only dropped from the end of what
+	remains.
+	"""
+	kept: list[str] = []
+	lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+	in_forward_headers = False
+	skip = 0
+	for i, line in enumerate(lines):
+		if skip:
+			skip -= 1
+			continue
+		if in_forward_headers:
+			if _FORWARD_HEADER_RE.match(line):
+				continue
+			in_forward_headers = False
+		if line.startswith(">"):
+			continue
+		header_lines = 0
+		if _REPLY_HEADER_RE.match(line):
+			header_lines = 1
+		elif i + 1 < len(lines) and line.lstrip().startswith("On ") and _REPLY_HEADER_RE.match(f"{line} {lines[i + 1]}"):
+			header_lines = 2
+		if header_lines:
+			if all(not rest.strip() or rest.startswith(">") for rest in lines[i + header_lines:]):
+				break
+			skip = header_lines - 1
+			continue
+		if _ORIGINAL_RE.match(line) or _SIGNATURE_RE.match(line.rstrip()):
+			break
+		if _OUTLOOK_FROM_RE.match(line) and i + 1 < len(lines) and _OUTLOOK_NEXT_RE.match(lines[i + 1]):
+			break
+		if _FORWARD_RE.match(line):
+			in_forward_headers = True
+			continue
+		kept.append(line)
+
+	# Legal footers and unsubscribe blurbs trail the message as whole paragraphs
+	paragraphs = "\n".join(kept).split("\n\n")
+	while paragraphs and _BOILERPLATE_RE.search(paragraphs[-1]):
+		paragraphs.pop()
+	return "\n\n".join(paragraphs)
+
+
+def collapse_whitespace(text: str) -> str:
+	lines = (_SPACES_RE.sub(" ", line).strip() for line in text.split("\n"))
+	out: list[str] = []
+	for line in lines:
+		if line or (out and out[-1]):
+			out.append(line)
+	return "\n".join(out).strip()
+
+
+def truncate_to_budget(text: str, max_tokens: int) -> str:
+	"""Keep the head and tail of ``text`` (2:1) within ``max_tokens``."""
+	if estimate_tokens(text) <= max_tokens:
+		return text
+	max_chars = max(0, max_tokens * 4 - len(_TRUNCATION_MARK))
+	head = max_chars * 2 // 3
+	tail = max_chars - head
+	return text[:head] + _TRUNCATION_MARK + (text[-tail:] if tail else "")
+
+
+def token_budget(model: Optional[str], provider: Optional[str] = None) -> int:
+	"""Body token budget from ``LLM_BODY_TOKEN_BUDGET``: by model, then provider, then default."""
+	budgets = current_app.config.get("LLM_BODY_TOKEN_BUDGET") or {}
+	for key in (model, provider):
+		if key and key in budgets:
+			return int(budgets[key])
+	return int(budgets.get("default", 1500))
+
+
+def compact_body(text: str, max_tokens: int) -> dict[str, Any]:
+	"""Compact an email body for a prompt and report the tokens saved."""
+	before = estimate_tokens(text or "")
+	body = truncate_to_budget(collapse_whitespace(strip_noise(text or "")), max_tokens)
+	after = estimate_tokens(body)
+	metrics.incr("llm.compaction.tokens_saved", before - after)
+	metrics.incr("llm.compaction.bodies")
+	return {"body": body, "tokens_before": before, "tokens_after": after, "tokens_saved": before - after}
@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Iterable, Optional
+
+from flask import current_app
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.extensions import db
+from app.models import ProcessedMessage
+
+from . import metrics
+from .bloom import BloomFilter
+
+# Keeps IN (...) lists well under SQLite's bound-parameter limit.
+_IN_CHUNK = 500
+_WARM_BATCH = 10_000
+# Shortest gap between overlap re-reads when tailing on every check
+_OVERLAP_REREAD_MIN = 5.0
+
+
+class ProcessedIdFilter:
+	"""Per-process Bloom filter in front of ``processed_messages``.
+
+	Ids the filter has never seen skip the database entirely; only "maybe
+	seen" ids are checked with an IN query. Rows written by other workers are
+	picked up by a primary-key tail query (at most every
+	``DEDUP_BLOOM_TAIL_INTERVAL`` seconds, 0 = every check) and the filter is
+	rebuilt from scratch every ``DEDUP_BLOOM_REBUILD_SECONDS`` or once it
+	outgrows its capacity.
+
+	Concurrent transactions can commit a lower id after a higher one, so
+	periodic tails re-read from the highest id seen
+	``DEDUP_BLOOM_TAIL_OVERLAP`` seconds ago rather than from the highest id
+	seen so far. Tails on every check only read past the highest id, with the
+	overlap re-read at most every ``_OVERLAP_REREAD_MIN`` seconds.
+	"""
+
+	def __init__(self) -> None:
+		self._bloom: Optional[BloomFilter] = None
+		self._max_pk = 0
+		# (monotonic time, highest id seen then); the tail restarts from the
+		# newest mark older than the overlap window
+		self._marks: deque[tuple[float, int]] = deque()
+		self._floor_pk = 0
+		self._built_at = 0.0
+		self._tailed_at = 0.0
+		self._reread_at = 0.0
+		self._lock = threading.Lock()
+
+	def _config(self, name: str, default: Any) -> Any:
+		return current_app.config.get(name, default)
+
+	def _overlap(self) -> float:
+		return float(self._config("DEDUP_BLOOM_TAIL_OVERLAP", 120))
+
+	def rebuild(self) -> None:
+		"""Stream every processed id into a fresh filter sized for the table."""
+		started = time.perf_counter()
+		settled_before = datetime.utcnow() - timedelta(seconds=self._overlap())
+		total = db.session.query(db.func.count(ProcessedMessage.id)).scalar() or 0
+		bloom = BloomFilter(
+			capacity=max(int(self._config("DEDUP_BLOOM_CAPACITY", 1_000_000)), total * 2),
+			error_rate=float(self._config("DEDUP_BLOOM_ERROR_RATE", 0.001)),
+		)
+		max_pk = floor_pk = 0
+		rows = (
+			db.session.query(ProcessedMessage.id, ProcessedMessage.gmail_message_id, ProcessedMessage.created_at)
+			.order_by(ProcessedMessage.id)
+			.yield_per(_WARM_BATCH)
+		)
+		for pk, message_id, created_at in rows:
+			bloom.add(message_id)
+			max_pk = pk
+			if created_at is not None and created_at < settled_before:
+				floor_pk = pk
+		with self._lock:
+			self._bloom = bloom
+			self._max_pk = max_pk
+			# Rows newer than the overlap may have lower-id neighbours still uncommitted
+			self._floor_pk = floor_pk
+			self._marks.clear()
+			self._built_at = self._tailed_at = self._reread_at = time.monotonic()
+		metrics.incr("dedup.bloom.rebuilds")
+		metrics.observe("dedup.bloom.rebuild", time.perf_counter() - started)
+
+	def _tail(self, reread: bool) -> None:
+		now = time.monotonic()
+		settled = now - self._overlap()
+		with self._lock:
+			while self._marks and self._marks[0][0] <= settled:
+				self._floor_pk = max(self._floor_pk, self._marks.popleft()[1])
+			floor_pk = self._floor_pk if reread else self._max_pk
+		rows = (
+			db.session.query(ProcessedMessage.id, ProcessedMessage.gmail_message_id)
+			.filter(ProcessedMessage.id > floor_pk)
+			.order_by(ProcessedMessage.id)
+			.all()
+		)
+		with self._lock:
+			for pk, message_id in rows:
+				self._bloom.add(message_id)
+				self._max_pk = max(self._max_pk, pk)
+			self._marks.append((now, self._max_pk))
+			self._tailed_at = now
+			if reread:
+				self._reread_at = now
+		metrics.incr("dedup.bloom.tail_queries")
+		metrics.incr("dedup.bloom.tail_rows", len(rows))
+
+	def _ensure_fresh(self) -> bool:
+		"""Rebuild or tail the filter when due; True if that hit the database."""
+		now = time.monotonic()
+		rebuild_every = float(self._config("DEDUP_BLOOM_REBUILD_SECONDS", 3600))
+		if self._bloom is None or self._bloom.saturated or now - self._built_at >= rebuild_every:
+			self.rebuild()
+			return True
+		interval = float(self._config("DEDUP_BLOOM_TAIL_INTERVAL", 5))
+		if now - self._tailed_at >= interval:
+			self._tail(reread=now - self._reread_at >= max(interval, _OVERLAP_REREAD_MIN))
+			return True
+		return False
+
+	def maybe_seen(self, message_ids: list[str]) -> list[str]:
+		"""Return the ids that might already be processed."""
+		queried = self._ensure_fresh()
+		bloom = self._bloom
+		maybe = [mid for mid in message_ids if mid in bloom]
+		# Only a check that skipped the database entirely saved a lookup
+		if not maybe and not queried:
+			metrics.incr("dedup.bloom.lookups_avoided")
+		metrics.incr("dedup.bloom.ids_filtered", len(message_ids) - len(maybe))
+		return maybe
+
+	def add(self, message_ids: Iterable[str]) -> None:
+		with self._lock:
+			if self._bloom is not None:
+				self._bloom.update(message_ids)
+
+	def stats(self) -> dict[str, Any]:
+		bloom = self._bloom
+		if bloom is None:
+			return {"built": False}
+		return {
+			"built": True,
+			"count": bloom.count,
+			"capacity": bloom.capacity,
+			"bits": bloom.num_bits,
+			"hashes": bloom.num_hashes,
+			"error_rate": bloom.error_rate,
+		}
+
+	def reset_after_fork(self) -> None:
+		self._lock = threading.Lock()
+
+
+processed_filter = ProcessedIdFilter()
+metrics.register_gauge("dedup.bloom", processed_filter.stats)
+
+if hasattr(os, "register_at_fork"):
+	os.register_at_fork(after_in_child=processed_filter.reset_after_fork)
+
+
+def _bloom_enabled() -> bool:
+	return bool(current_app.config.get("DEDUP_BLOOM_ENABLED", True))
+
+
+def warm_processed_filter() -> None:
+	"""Build the filter ahead of the first notification (worker startup)."""
+	if _bloom_enabled():
+		processed_filter.rebuild()
+
+
+def _chunks(items: list[str], size: int = _IN_CHUNK) -> Iterable[list[str]]:
+	for start in range(0, len(items), size):
+		yield items[start:start + size]
+
+
+def seen_message_ids(message_ids: Iterable[str]) -> set[str]:
+	"""Return the subset of ``message_ids`` already in ``processed_messages``."""
+	ids = list(dict.fromkeys(message_ids))
+	seen: set[str] = set()
+	for chunk in _chunks(ids):
+		rows = db.session.query(ProcessedMessage.gmail_message_id).filter(
+			ProcessedMessage.gmail_message_id.in_(chunk)
+		)
+		seen.update(row[0] for row in rows)
+	return seen
+
+
+def filter_unseen(message_ids: Iterable[str]) -> list[str]:
+	"""Drop already-processed ids with one indexed query, preserving order."""
+	ids = list(dict.fromkeys(message_ids))
+	if not ids:
+		return []
+	candidates = processed_filter.maybe_seen(ids) if _bloom_enabled() else ids
+	seen = seen_message_ids(candidates) if candidates else set()
+	if seen:
+		metrics.incr("dedup.skipped", len(seen))
+	return [mid for mid in ids if mid not in seen]
+
+
+def mark_processed(user_id: int, message_ids: Iterable[str]) -> None:
+	"""Record ids with a single ``INSERT ... ON CONFLICT DO NOTHING``.
+
+	Does not commit, so callers can make it atomic with their own writes. The
+	ids go into the Bloom filter straight away; should the commit fail they
+	only cost an extra DB check later.
+	"""
+	ids = list(dict.fromkeys(message_ids))
+	if not ids:
+		return
+	now = datetime.utcnow()
+	rows = [
+		{"gmail_message_id": mid, "user_id": user_id, "created_at": now, "updated_at": now}
+		for mid in ids
+	]
+	dialect = db.session.get_bind().dialect.name
+	if dialect == "postgresql":
+		stmt = pg_insert(ProcessedMessage.__table__).on_conflict_do_nothing(index_elements=["gmail_message_id"])
+	elif dialect == "sqlite":
+		stmt = sqlite_insert(ProcessedMessage.__table__).on_conflict_do_nothing(index_elements=["gmail_message_id"])
+	else:
+		# No portable upsert; insert whatever is not there yet
+		seen = seen_message_ids(ids)
+		rows = [row for row in rows if row["gmail_message_id"] not in seen]
+		if not rows:
+			return
+		stmt = ProcessedMessage.__table__.insert()
+	db.session.execute(stmt, rows)
+	processed_filter.add(ids)
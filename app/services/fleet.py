@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import json
+import time
+import uuid
+from typing import Any, Optional
+
+from flask import current_app
+
+from . import metrics
+from .store import get_store
+
+# Fleet sync cycles are coordinated through the shared store: the beat task
+# records how many users it dispatched, chunk tasks add what they finished,
+# and whichever side sees the two meet reports the cycle exactly once.
+
+_ACTIVE_KEY = "fleet:active"
+_LAST_KEY = "fleet:last"
+_CYCLE_KEY = "fleet:{}"
+_DONE_KEY = "fleet:{}:done"
+_FAILED_KEY = "fleet:{}:failed"
+_REPORTED_KEY = "fleet:{}:reported"
+
+# Last completed cycle seen by this process, for the metrics snapshot
+_last_report: dict[str, Any] = {}
+metrics.register_gauge("gmail_fleet_last_cycle", lambda: dict(_last_report))
+
+
+def _ttl() -> float:
+	# Tied to the beat period, so a cycle whose chunk died only blocks the next one or two beats
+	interval = float(current_app.config.get("GMAIL_FLEET_SYNC_INTERVAL", 900))
+	return float(current_app.config.get("GMAIL_FLEET_CYCLE_TTL", 2 * interval))
+
+
+def start_cycle() -> Optional[str]:
+	"""Begin a cycle; ``None`` while the previous one is still running."""
+	cycle = uuid.uuid4().hex
+	if not get_store().set_nx(_ACTIVE_KEY, cycle, ttl=_ttl()):
+		return None
+	get_store().set(_CYCLE_KEY.format(cycle), json.dumps({"started_at": time.time()}), ttl=_ttl())
+	return cycle
+
+
+def finish_dispatch(cycle: str, total: int) -> None:
+	"""Record how many users the cycle dispatched (chunks may already be done)."""
+	store = get_store()
+	record = json.loads(store.get(_CYCLE_KEY.format(cycle)) or "{}")
+	record["total"] = total
+	store.set(_CYCLE_KEY.format(cycle), json.dumps(record), ttl=_ttl())
+	_maybe_complete(cycle)
+
+
+def record_progress(cycle: str, synced: int, failed: int) -> None:
+	"""Add a finished chunk's counts to the cycle."""
+	store = get_store()
+	if synced:
+		store.incr(_DONE_KEY.format(cycle), synced, ttl=_ttl())
+	if failed:
+		store.incr(_FAILED_KEY.format(cycle), failed, ttl=_ttl())
+	metrics.incr("gmail.fleet.synced", synced)
+	metrics.incr("gmail.fleet.failed", failed)
+	_maybe_complete(cycle)
+
+
+def last_cycle() -> Optional[dict[str, Any]]:
+	value = get_store().get(_LAST_KEY)
+	return json.loads(value) if value is not None else None
+
+
+def _maybe_complete(cycle: str) -> None:
+	store = get_store()
+	record = json.loads(store.get(_CYCLE_KEY.format(cycle)) or "{}")
+	total = record.get("total")
+	if total is None:
+		return
+	synced = int(store.get(_DONE_KEY.format(cycle)) or 0)
+	failed = int(store.get(_FAILED_KEY.format(cycle)) or 0)
+	if synced + failed < total or not store.set_nx(_REPORTED_KEY.format(cycle), "1", ttl=_ttl()):
+		return
+
+	elapsed = max(time.time() - record["started_at"], 1e-6)
+	report = {
+		"cycle": cycle,
+		"started_at": record["started_at"],
+		"seconds": round(elapsed, 3),
+		"users": total,
+		"synced": synced,
+		"failed": failed,
+		"users_per_second": round(total / elapsed, 2),
+	}
+	metrics.observe("gmail.fleet.cycle", elapsed)
+	metrics.incr("gmail.fleet.cycles")
+	_last_report.clear()
+	_last_report.update(report)
+	store.set(_LAST_KEY, json.dumps(report))
+	store.compare_and_delete(_ACTIVE_KEY, cycle)
+	current_app.logger.info(
+		"Fleet sync cycle %s: %d users (%d failed) in %.1fs, %.1f users/s",
+		cycle, total, failed, elapsed, report["users_per_second"],
+	)
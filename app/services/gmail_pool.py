@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+from . import metrics
+
+try:
+	import httplib2
+	from google_auth_httplib2 import AuthorizedHttp
+	from googleapiclient.http import HttpRequest
+except Exception:  # pragma: no cover - optional until packages installed
+	httplib2 = None  # type: ignore
+	AuthorizedHttp = None  # type: ignore
+	HttpRequest = None  # type: ignore
+
+
+def token_fingerprint(access_token: str) -> str:
+	"""Short, non-reversible key for an access token."""
+	return hashlib.sha256(access_token.encode("utf-8")).hexdigest()[:16]
+
+
+def thread_local_request_builder(credentials: Any, timeout: Optional[float] = None) -> Callable[..., Any]:
+	"""Return a ``requestBuilder`` that executes on a per-thread ``AuthorizedHttp``.
+
+	httplib2 connections are not thread-safe, so a Resource shared between
+	gunicorn threads must not share one ``Http``. Each thread lazily gets its
+	own keep-alive connection pool, reused for every request it makes.
+	"""
+	local = threading.local()
+
+	def _builder(http: Any, *args: Any, **kwargs: Any) -> Any:
+		thread_http = getattr(local, "http", None)
+		if thread_http is None:
+			thread_http = local.http = AuthorizedHttp(credentials, http=httplib2.Http(timeout=timeout))
+		return HttpRequest(thread_http, *args, **kwargs)
+
+	return _builder
+
+
+class GmailClientPool:
+	"""Bounded, thread-safe LRU/TTL cache of Gmail API resources.
+
+	Entries are keyed by ``(user_id, token_fingerprint)`` so a refreshed token
+	never reuses a client holding stale credentials.
+	"""
+
+	def __init__(self, max_size: int = 256, ttl_seconds: float = 1800) -> None:
+		self.max_size = max_size
+		self.ttl_seconds = ttl_seconds
+		self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def configure(self, max_size: int, ttl_seconds: float) -> None:
+		with self._lock:
+			self.max_size = max_size
+			self.ttl_seconds = ttl_seconds
+			self._evict_over_capacity()
+
+	def get(self, user_id: Optional[int], access_token: str, factory: Callable[[], Any]) -> Any:
+		"""Return a cached client, building it with ``factory`` on a miss."""
+		key = (user_id, token_fingerprint(access_token))
+		now = time.monotonic()
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is not None and now - entry[0] < self.ttl_seconds:
+				self._entries.move_to_end(key)
+				self.hits += 1
+				metrics.incr("gmail_client_pool.hit")
+				return entry[1]
+			if entry is not None:
+				del self._entries[key]
+				self.evictions += 1
+			self.misses += 1
+		metrics.incr("gmail_client_pool.miss")
+
+		# Build outside the lock; a concurrent miss for the same key just wins or loses the insert.
+		client = factory()
+		with self._lock:
+			self._entries[key] = (now, client)
+			self._entries.move_to_end(key)
+			self._evict_over_capacity()
+		return client
+
+	def invalidate(self, user_id: Optional[int] = None, access_token: Optional[str] = None) -> int:
+		"""Drop entries for a user and/or token; returns the number removed."""
+		fingerprint = token_fingerprint(access_token) if access_token else None
+		with self._lock:
+			doomed = [
+				key for key in self._entries
+				if (user_id is None or key[0] == user_id)
+				and (fingerprint is None or key[1] == fingerprint)
+			]
+			for key in doomed:
+				del self._entries[key]
+		return len(doomed)
+
+	def clear(self) -> None:
+		with self._lock:
+			self._entries.clear()
+
+	def reset_after_fork(self) -> None:
+		# The parent's lock may have been held mid-fork; start the child clean.
+		self._lock = threading.Lock()
+		self._entries = OrderedDict()
+
+	def stats(self) -> dict[str, Any]:
+		with self._lock:
+			return {
+				"size": len(self._entries),
+				"max_size": self.max_size,
+				"hits": self.hits,
+				"misses": self.misses,
+				"evictions": self.evictions,
+			}
+
+	def _evict_over_capacity(self) -> None:
+		while len(self._entries) > self.max_size:
+			self._entries.popitem(last=False)
+			self.evictions += 1
+
+
+gmail_client_pool = GmailClientPool()
+metrics.register_gauge("gmail_client_pool", gmail_client_pool.stats)
+
+# Sockets inherited across a fork (Celery prefork) must never be shared.
+if hasattr(os, "register_at_fork"):
+	os.register_at_fork(after_in_child=gmail_client_pool.reset_after_fork)
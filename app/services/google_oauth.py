@@ -5,18 +5,27 @@ from typing import Any, Optional
 
 from flask import current_app, url_for
 import requests
-import base64
+import json
+import threading
+import time
+from pathlib import Path
+
+from .gmail_pool import gmail_client_pool, thread_local_request_builder
+from .mime import attachment_bytes, extract_message
+from .ratelimit import gmail_quota
 
 try:
 	from google_auth_oauthlib.flow import Flow
 	from google.oauth2.credentials import Credentials
 	from google.auth.transport.requests import Request
-	from googleapiclient.discovery import build
+	from googleapiclient.discovery import build_from_document
+	from googleapiclient.errors import HttpError
 except Exception:  # pragma: no cover - optional until packages installed
 	Flow = None  # type: ignore
 	Credentials = None  # type: ignore
 	Request = None  # type: ignore
-	build = None  # type: ignore
+	build_from_document = None  # type: ignore
+	HttpError = None  # type: ignore
 
 
 def _scopes() -> list[str]:
@@ -101,71 +110,252 @@ def refresh_access_token(refresh_token: str) -> dict[str, Any]:
 	}
 
 
-def build_gmail_service(access_token: str) -> Any:
-	if build is None:
+# Gmail v1 discovery document shipped with the app so clients build offline.
+GMAIL_DISCOVERY_PATH = Path(__file__).resolve().parent / "discovery" / "gmail.v1.json"
+
+_discovery_lock = threading.Lock()
+_gmail_discovery: Optional[dict[str, Any]] = None
+
+
+def _warm_resource(resource: Any, desc: dict[str, Any]) -> None:
+	for name, sub_desc in desc.get("resources", {}).items():
+		_warm_resource(getattr(resource, name)(), sub_desc)
+
+
+def load_gmail_discovery() -> dict[str, Any]:
+	"""Parse the bundled Gmail discovery document once per process.
+
+	googleapiclient fixes up method parameters in the document the first time
+	each resource is built, so a throwaway client walks every resource under
+	the lock before the document is shared between threads.
+	"""
+	global _gmail_discovery
+	if _gmail_discovery is not None:
+		return _gmail_discovery
+	with _discovery_lock:
+		if _gmail_discovery is None:
+			if build_from_document is None:
+				raise RuntimeError("google-api-python-client not installed")
+			import httplib2
+
+			doc = json.loads(GMAIL_DISCOVERY_PATH.read_bytes())
+			_warm_resource(build_from_document(doc, http=httplib2.Http()), doc)
+			_gmail_discovery = doc
+	return _gmail_discovery
+
+
+def build_gmail_service(access_token: str, user_id: Optional[int] = None) -> Any:
+	"""Return a pooled Gmail client for ``(user_id, access_token)``.
+
+	Clients are cached per process (see ``GmailClientPool``); each thread
+	executes requests on its own keep-alive connection.
+	"""
+	if build_from_document is None:
 		raise RuntimeError("google-api-python-client not installed")
-	creds = Credentials(access_token, scopes=_scopes())
-	return build("gmail", "v1", credentials=creds, cache_discovery=False)
 
+	max_size = int(current_app.config.get("GMAIL_CLIENT_POOL_SIZE", 256))
+	ttl = float(current_app.config.get("GMAIL_CLIENT_POOL_TTL", 1800))
+	if (max_size, ttl) != (gmail_client_pool.max_size, gmail_client_pool.ttl_seconds):
+		gmail_client_pool.configure(max_size, ttl)
+	scopes = _scopes()
+	timeout = current_app.config.get("GMAIL_HTTP_TIMEOUT")
+
+	def _factory() -> Any:
+		creds = Credentials(access_token, scopes=scopes)
+		return build_from_document(
+			load_gmail_discovery(),
+			credentials=creds,
+			requestBuilder=thread_local_request_builder(creds, timeout=timeout),
+		)
+
+	return gmail_client_pool.get(user_id, access_token, _factory)
+
+
+def invalidate_gmail_clients(user_id: Optional[int] = None, access_token: Optional[str] = None) -> int:
+	"""Drop pooled clients after a token refresh, re-login or logout."""
+	return gmail_client_pool.invalidate(user_id=user_id, access_token=access_token)
+
+
+# Gmail rejects batch requests with more than 100 inner calls.
+GMAIL_BATCH_LIMIT = 100
+GMAIL_LIST_PAGE_LIMIT = 500
+_RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+def list_message_ids(
+	service: Any, max_results: int, q: Optional[str] = None, user_id: Optional[int] = None
+) -> list[str]:
+	"""Page through ``messages.list`` until ``max_results`` ids are collected."""
+	ids: list[str] = []
+	page_token: Optional[str] = None
+	while len(ids) < max_results:
+		params: dict[str, Any] = {
+			"userId": "me",
+			"maxResults": min(GMAIL_LIST_PAGE_LIMIT, max_results - len(ids)),
+		}
+		if q:
+			params["q"] = q
+		if page_token:
+			params["pageToken"] = page_token
+		gmail_quota(user_id, "messages.list")
+		resp = service.users().messages().list(**params).execute()
+		ids.extend(m["id"] for m in resp.get("messages", []) if m.get("id"))
+		page_token = resp.get("nextPageToken")
+		if not page_token:
+			break
+	return ids[:max_results]
+
+
+def _is_retryable(exc: Exception) -> bool:
+	status = getattr(getattr(exc, "resp", None), "status", None)
+	try:
+		return int(status) in _RETRYABLE_STATUSES
+	except (TypeError, ValueError):
+		return HttpError is None or not isinstance(exc, HttpError)
 
-def watch_user_gmail(access_token: str):	
-    service = build_gmail_service(access_token=access_token)
+
+def batch_get_messages(
+	service: Any,
+	message_ids: list[str],
+	max_attempts: int = 3,
+	user_id: Optional[int] = None,
+	**get_kwargs: Any,
+) -> dict[str, dict[str, Any]]:
+	"""Fetch many messages with Gmail batch requests instead of one call each.
+
+	Ids are grouped up to ``GMAIL_BATCH_SIZE`` (capped at the API limit) per HTTP
+	call. Items that fail with a retryable status are re-sent in a later batch
+	with exponential backoff; permanent failures are logged and omitted. Each
+	HTTP call is charged to ``user_id``'s quota bucket first.
+
+	Returns:
+		Mapping of message id to the ``messages.get`` response.
+	"""
+	batch_size = max(1, min(int(current_app.config.get("GMAIL_BATCH_SIZE", 50)), GMAIL_BATCH_LIMIT))
+	results: dict[str, dict[str, Any]] = {}
+	pending = list(dict.fromkeys(message_ids))
+
+	for attempt in range(max_attempts):
+		if not pending:
+			break
+		if attempt:
+			time.sleep(0.5 * 2 ** (attempt - 1))
+		retry: list[str] = []
+
+		def _callback(request_id: str, response: Any, exception: Exception | None) -> None:
+			if exception is None:
+				results[request_id] = response
+			elif _is_retryable(exception):
+				retry.append(request_id)
+			else:
+				current_app.logger.warning("Gmail get failed for %s: %s", request_id, exception)
+
+		for start in range(0, len(pending), batch_size):
+			chunk = pending[start:start + batch_size]
+			gmail_quota(user_id, "messages.get", len(chunk))
+			batch = service.new_batch_http_request(callback=_callback)
+			for msg_id in chunk:
+				batch.add(
+					service.users().messages().get(userId="me", id=msg_id, **get_kwargs),
+					request_id=msg_id,
+				)
+			batch.execute()
+		pending = retry
+
+	if pending:
+		current_app.logger.error(
+			"Gmail batch get gave up on %d message(s) after %d attempts", len(pending), max_attempts
+		)
+	return results
+
+
+def watch_user_gmail(access_token: str, user_id: Optional[int] = None):
+    service = build_gmail_service(access_token=access_token, user_id=user_id)
     request = {
         "topicName": "projects/PROJECT_ID/topics/gmail-updates"
     }
+    gmail_quota(user_id, "watch")
     response = service.users().watch(userId="me", body=request).execute()
     return response
 
-def get_history(access_token, start_history_id):
-    service = build_gmail_service(access_token=access_token)
-    history = service.users().history().list(
-        userId="me", startHistoryId=start_history_id
-    ).execute()
-    return history
+class HistoryExpiredError(Exception):
+	"""Raised when Gmail no longer has history for the requested startHistoryId."""
+
 
-def get_message_content(access_token, message_id):
-    service = build_gmail_service(access_token=access_token)
+def get_history(access_token, start_history_id, user_id=None, history_types=("messageAdded",)):
+	"""Return every history record after ``start_history_id``, across all pages.
+
+	The result mirrors a single ``history.list`` response: ``history`` holds the
+	merged records and ``historyId`` the mailbox's latest history id.
+	"""
+	service = build_gmail_service(access_token=access_token, user_id=user_id)
+	params: dict[str, Any] = {"userId": "me", "startHistoryId": start_history_id}
+	if history_types:
+		params["historyTypes"] = list(history_types)
+
+	records: list[dict[str, Any]] = []
+	latest_id = None
+	while True:
+		gmail_quota(user_id, "history.list")
+		try:
+			resp = service.users().history().list(**params).execute()
+		except Exception as exc:  # noqa: BLE001
+			if getattr(getattr(exc, "resp", None), "status", None) == 404:
+				raise HistoryExpiredError(str(start_history_id)) from exc
+			raise
+		records.extend(resp.get("history", []))
+		latest_id = resp.get("historyId") or latest_id
+		page_token = resp.get("nextPageToken")
+		if not page_token:
+			break
+		params["pageToken"] = page_token
+	return {"history": records, "historyId": latest_id}
+
+
+def get_latest_history_id(access_token, user_id=None):
+	"""The mailbox's current ``historyId`` (``users.getProfile``), to start a new cursor from."""
+	service = build_gmail_service(access_token=access_token, user_id=user_id)
+	gmail_quota(user_id, "users.getProfile")
+	return service.users().getProfile(userId="me").execute()["historyId"]
+
+def get_message_content(access_token, message_id, user_id=None):
+    service = build_gmail_service(access_token=access_token, user_id=user_id)
+    gmail_quota(user_id, "messages.get")
     message = service.users().messages().get(
         userId='me',
         id=message_id,
         format='full'  # options: 'minimal', 'full', 'metadata', 'raw'
     ).execute()
-    
-    # Extract payload
-    payload = message.get('payload', {})
-    headers = payload.get('headers', [])
-
-    # Parse useful headers
-    subject = next((h['value'] for h in headers if h['name'] == 'Subject'), '')
-    from_ = next((h['value'] for h in headers if h['name'] == 'From'), '')
-    
-    # Extract body (handle multipart)
-    body = ''
-    if 'parts' in payload:
-        for part in payload['parts']:
-            if part['mimeType'] == 'text/plain':
-                body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-                break
-    else:
-        body_data = payload.get('body', {}).get('data')
-        if body_data:
-            body = base64.urlsafe_b64decode(body_data).decode('utf-8')
-    
-    return {
-        "subject": subject,
-        "from": from_,
-        "body": body
-    }
+    return parse_message_content(message)
+
+def parse_message_content(message, max_bytes=None):
+	"""Body, headers and attachment stubs of a full message (see ``mime.extract_message``)."""
+	if max_bytes is None:
+		max_bytes = int(current_app.config.get("GMAIL_BODY_MAX_BYTES", 256 * 1024))
+	return extract_message(message, max_bytes=max_bytes)
 
-def process_gmail_history(access_token, history):
-	messages_array = []
+def get_attachment(access_token, message_id, attachment_id, user_id=None):
+	"""Fetch one attachment's bytes on demand; message bodies never include them."""
+	service = build_gmail_service(access_token=access_token, user_id=user_id)
+	gmail_quota(user_id, "messages.attachments.get")
+	resp = service.users().messages().attachments().get(
+		userId="me", messageId=message_id, id=attachment_id
+	).execute()
+	return attachment_bytes(resp.get("data"))
 
+def fetch_message_contents(access_token, message_ids, user_id=None):
+	"""Fetch and parse many full messages via batch requests, preserving order."""
+	if not message_ids:
+		return []
+	service = build_gmail_service(access_token=access_token, user_id=user_id)
+	fetched = batch_get_messages(service, list(message_ids), user_id=user_id, format="full")
+	return [parse_message_content(fetched[mid]) for mid in message_ids if mid in fetched]
+
+def history_message_ids(history):
+	"""Ids of added messages in a history response, deduplicated, in order."""
+	message_ids = []
 	for record in history.get('history', []):
 		# Only process new messages
 		for added in record.get('messagesAdded', []):
-			message_id = added['message']['id']
-			content = get_message_content(access_token=access_token, message_id=message_id)
-			messages_array.append(content)
-			print("New email:", content['subject'], "from", content['from'])
-
-	return messages_array
\ No newline at end of file
+			message_ids.append(added['message']['id'])
+	return list(dict.fromkeys(message_ids))
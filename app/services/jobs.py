@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import base64
+import json
+import time
+import uuid
+import zlib
+from typing import Any, Optional
+
+from flask import current_app
+
+from . import metrics
+from .store import get_store
+
+# Job records live in the shared store so any web process can answer a poll
+# for a task run by any worker; Celery's own result backend is not used.
+
+_KEY = "job:{}"
+_DONE_KEY = "job:{}:done"
+_FAILED_KEY = "job:{}:failed"
+_TERMINAL = frozenset(("succeeded", "failed", "partial"))
+_POLL_INTERVAL = 0.2
+
+
+def _ttl() -> float:
+	return float(current_app.config.get("JOB_RESULT_TTL", 3600))
+
+
+def _encode(record: dict[str, Any]) -> str:
+	raw = json.dumps(record, separators=(",", ":"))
+	if len(raw) < int(current_app.config.get("JOB_COMPRESS_MIN_BYTES", 1024)):
+		return "j:" + raw
+	return "z:" + base64.b64encode(zlib.compress(raw.encode("utf-8"), 6)).decode("ascii")
+
+
+def _decode(value: str) -> dict[str, Any]:
+	if value.startswith("z:"):
+		return json.loads(zlib.decompress(base64.b64decode(value[2:])))
+	return json.loads(value[2:] if value.startswith("j:") else value)
+
+
+def _save(record: dict[str, Any]) -> None:
+	get_store().set(_KEY.format(record["id"]), _encode(record), ttl=_ttl())
+
+
+def create_job(kind: str, job_id: Optional[str] = None, **fields: Any) -> dict[str, Any]:
+	"""Record a queued job; its id doubles as the Celery task id."""
+	now = time.time()
+	record = {
+		"id": job_id or uuid.uuid4().hex,
+		"kind": kind,
+		"state": "queued",
+		"version": 1,
+		"created_at": now,
+		"updated_at": now,
+		**fields,
+	}
+	_save(record)
+	metrics.incr("jobs.created")
+	return record
+
+
+def get_job(job_id: str) -> Optional[dict[str, Any]]:
+	value = get_store().get(_KEY.format(job_id))
+	return _decode(value) if value is not None else None
+
+
+def update_job(
+	job_id: Optional[str],
+	state: str,
+	result: Any = None,
+	error: Optional[str] = None,
+) -> None:
+	"""Move a job to ``state``; a no-op for tasks not started through the job API."""
+	record = get_job(job_id) if job_id else None
+	if record is None:
+		return
+	record.update(state=state, version=record["version"] + 1, updated_at=time.time())
+	if result is not None:
+		record["result"] = result
+	if error is not None:
+		record["error"] = error
+	_save(record)
+	group_id = record.get("group_id")
+	if group_id and state in _TERMINAL:
+		key = _DONE_KEY if state == "succeeded" else _FAILED_KEY
+		get_store().incr(key.format(group_id), ttl=_ttl())
+
+
+def create_group(kind: str, size: int, group_id: Optional[str] = None) -> dict[str, Any]:
+	"""Record a bulk job; member jobs report into it via ``group_id``."""
+	return create_job(kind, job_id=group_id, total=size)
+
+
+def job_status(job_id: str) -> Optional[dict[str, Any]]:
+	"""The job record, with progress counters folded in for groups."""
+	record = get_job(job_id)
+	if record is None or record.get("total") is None:
+		return record
+	store = get_store()
+	done = int(store.get(_DONE_KEY.format(job_id)) or 0)
+	failed = int(store.get(_FAILED_KEY.format(job_id)) or 0)
+	total = int(record["total"])
+	if done + failed >= total:
+		state = "succeeded" if not failed else "failed" if not done else "partial"
+	else:
+		state = "running" if done or failed else "queued"
+	record.update(state=state, succeeded=done, failed=failed, version=done + failed + 1)
+	return record
+
+
+def job_etag(record: dict[str, Any]) -> str:
+	return f'"{record["id"]}-{record["version"]}"'
+
+
+def wait_for_change(job_id: str, etag: Optional[str], timeout: float) -> Optional[dict[str, Any]]:
+	"""Long-poll: return the job once its ETag differs from ``etag`` or ``timeout`` passes."""
+	deadline = time.monotonic() + timeout
+	record = job_status(job_id)
+	while (
+		record is not None
+		and etag == job_etag(record)
+		and record["state"] not in _TERMINAL
+		and time.monotonic() < deadline
+	):
+		time.sleep(_POLL_INTERVAL)
+		record = job_status(job_id)
+	return record
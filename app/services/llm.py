@@ -1,10 +1,26 @@
 from __future__ import annotations
 
+import hashlib
+import json
 import os
-from typing import Any, Optional
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Hashable, Iterator, Optional, Sequence
 
 from flask import current_app
 
+from . import metrics, structured
+from .llm_cache import cached_completion, lookup_completion, store_completion
+from .ratelimit import RateLimited, llm_quota, request_max_wait
+from .semantic_cache import semantic_lookup, semantic_store
+from .structured import StructuredOutputError
+
+try:
+	import httpx
+except Exception:  # pragma: no cover
+	httpx = None  # type: ignore
+
 try:
 	from openai import OpenAI
 except Exception:  # pragma: no cover
@@ -23,79 +39,531 @@ except Exception: # pragma: no cover
 	ChatGroq = None
 
 
+class _ClientRegistry:
+	"""Process-wide LLM clients, one per provider, shared by all threads.
+
+	A client is rebuilt only when its key (API key fingerprint + HTTP/model
+	settings) changes. After a fork the child drops the parent's clients so
+	pooled connections are never shared between processes.
+	"""
+
+	def __init__(self) -> None:
+		self._lock = threading.Lock()
+		self._pid = os.getpid()
+		self._clients: dict[str, tuple[Hashable, Any]] = {}
+
+	def get(self, provider: str, key: Hashable, factory: Callable[[], Any]) -> Any:
+		if self._pid != os.getpid():
+			self._lock = threading.Lock()
+			self._clients = {}
+			self._pid = os.getpid()
+		entry = self._clients.get(provider)
+		if entry is not None and entry[0] == key:
+			return entry[1]
+		with self._lock:
+			entry = self._clients.get(provider)
+			if entry is None or entry[0] != key:
+				entry = (key, factory())
+				self._clients[provider] = entry
+			return entry[1]
+
+	def clear(self) -> None:
+		with self._lock:
+			self._clients = {}
+
+
+_clients = _ClientRegistry()
+
+
+def _fingerprint(secret: str) -> str:
+	return hashlib.sha256(secret.encode("utf-8")).hexdigest()[:16]
+
+
+def _http_settings() -> tuple[float, float, int, int, float, int]:
+	cfg = current_app.config
+	return (
+		float(cfg.get("LLM_HTTP_TIMEOUT", 60)),
+		float(cfg.get("LLM_HTTP_CONNECT_TIMEOUT", 5)),
+		int(cfg.get("LLM_HTTP_MAX_CONNECTIONS", 20)),
+		int(cfg.get("LLM_HTTP_MAX_KEEPALIVE", 10)),
+		float(cfg.get("LLM_HTTP_KEEPALIVE_EXPIRY", 30)),
+		int(cfg.get("LLM_MAX_RETRIES", 2)),
+	)
+
+
+def _http_client(settings: tuple[float, float, int, int, float, int]) -> Any:
+	"""Keep-alive httpx client with bounded pool and timeouts."""
+	timeout, connect_timeout, max_connections, max_keepalive, keepalive_expiry, _ = settings
+	if httpx is None:
+		return None
+	return httpx.Client(
+		timeout=httpx.Timeout(timeout, connect=connect_timeout),
+		limits=httpx.Limits(
+			max_connections=max_connections,
+			max_keepalive_connections=max_keepalive,
+			keepalive_expiry=keepalive_expiry,
+		),
+	)
+
+
 def get_openai_client() -> Any:
 	api_key = current_app.config.get("OPENAI_API_KEY") or os.getenv("OPENAI_API_KEY")
 	if not api_key or OpenAI is None:
 		raise RuntimeError("OpenAI client not configured or library missing")
-	return OpenAI(api_key=api_key)
+	settings = _http_settings()
+	return _clients.get(
+		"openai",
+		(_fingerprint(api_key), settings),
+		lambda: OpenAI(api_key=api_key, max_retries=settings[-1], http_client=_http_client(settings)),
+	)
 
 
 def get_anthropic_client() -> Any:
 	api_key = current_app.config.get("ANTHROPIC_API_KEY") or os.getenv("ANTHROPIC_API_KEY")
 	if not api_key or anthropic is None:
 		raise RuntimeError("Anthropic client not configured or library missing")
-	return anthropic.Anthropic(api_key=api_key)
+	settings = _http_settings()
+	return _clients.get(
+		"anthropic",
+		(_fingerprint(api_key), settings),
+		lambda: anthropic.Anthropic(
+			api_key=api_key, max_retries=settings[-1], http_client=_http_client(settings)
+		),
+	)
 
 def get_groq_llm() -> Any:
 	api_key = current_app.config.get("GROQ_API_KEY") or os.getenv("GROQ_API_KEY")
 	api_model = current_app.config.get("GROQ_MODEL_NAME") or os.getenv("GROQ_MODEL_NAME")
-	llm = ChatGroq(model_name=api_model,
-					groq_api_key=api_key,
-					temperature=0.3)
-	return llm
+	if not api_key or ChatGroq is None:
+		raise RuntimeError("Groq client not configured or library missing")
+	settings = _http_settings()
+	return _clients.get(
+		"groq",
+		(_fingerprint(api_key), api_model, settings),
+		lambda: ChatGroq(
+			model_name=api_model,
+			groq_api_key=api_key,
+			temperature=0.3,
+			max_retries=settings[-1],
+			http_client=_http_client(settings),
+		),
+	)
+
+
+_OPENAI_PARAMS = {"temperature": 0.2}
+_ANTHROPIC_PARAMS = {"max_tokens": 512}
 
 
-def safe_openai_complete(prompt: str, model: str = "gpt-4o-mini") -> str:
-	"""Minimal safe wrapper for OpenAI text completion/chat."""
+def _openai_chat(client: Any, prompt: str, model: str, max_wait: Optional[float] = None) -> str:
+	llm_quota("openai", model, prompt, max_wait)
+	resp = client.chat.completions.create(
+		model=model,
+		messages=[{"role": "user", "content": prompt}],
+		**_OPENAI_PARAMS,
+	)
+	return resp.choices[0].message.content or ""
+
+
+def _anthropic_message(client: Any, prompt: str, model: str, max_wait: Optional[float] = None) -> str:
+	llm_quota("anthropic", model, prompt, max_wait)
+	resp = client.messages.create(
+		model=model,
+		messages=[{"role": "user", "content": prompt}],
+		**_ANTHROPIC_PARAMS,
+	)
+	# Anthropic returns a list of content blocks
+	parts = resp.content or []
+	return "".join(
+		p.text for p in parts if getattr(p, "type", None) == "text" and getattr(p, "text", None)
+	)
+
+
+def safe_openai_complete(prompt: str, model: str = "gpt-4o-mini", cache: bool = True) -> str:
+	"""Minimal safe wrapper for OpenAI text completion/chat; raises ``RateLimited``."""
 	client = get_openai_client()
+
+	def _complete() -> str:
+		try:
+			return _openai_chat(client, prompt, model)
+		except RateLimited:
+			raise
+		except Exception as exc:  # noqa: BLE001
+			current_app.logger.error("OpenAI error: %s", exc)
+			return ""
+
+	return cached_completion("openai", model, prompt, _OPENAI_PARAMS, _complete, use_cache=cache)
+
+
+def safe_anthropic_complete(
+	prompt: str, model: str = "claude-3-5-sonnet-20240620", cache: bool = True
+) -> str:
+	"""Minimal safe wrapper for Anthropic messages API; raises ``RateLimited``."""
+	client = get_anthropic_client()
+
+	def _complete() -> str:
+		try:
+			return _anthropic_message(client, prompt, model)
+		except RateLimited:
+			raise
+		except Exception as exc:  # noqa: BLE001
+			current_app.logger.error("Anthropic error: %s", exc)
+			return ""
+
+	return cached_completion("anthropic", model, prompt, _ANTHROPIC_PARAMS, _complete, use_cache=cache)
+
+GROQ_TEMPLATE = "\n".join([
+    "Please politely reply to the client"
+    "{message}",
+])
+def get_groq_chain() -> Any:
+	"""``GROQ_TEMPLATE | llm`` compiled once per process (per Groq client)."""
+	llm = get_groq_llm()
+	return _clients.get(
+		"groq_chain",
+		id(llm),
+		lambda: PromptTemplate(input_variables=["message"], template=GROQ_TEMPLATE) | llm,
+	)
+
+
+def safe_groq_complete(prompt: str, cache: bool = True) -> str:
+	"""Minimal safe wrapper for Groq messages API; raises ``RateLimited``."""
+	llm = get_groq_llm()
+	chain = get_groq_chain()
+
+	def _complete() -> str:
+		# Near-duplicate emails reuse an earlier reply with their own order numbers
+		if cache:
+			reused = semantic_lookup(prompt)
+			if reused is not None:
+				return reused
+		try:
+			llm_quota("groq", llm.model_name, prompt)
+			result_string = chain.invoke({"message": prompt}).content
+			if cache:
+				semantic_store(prompt, result_string)
+			return result_string
+		except RateLimited:
+			raise
+		except Exception as exc:  # noqa: BLE001
+			current_app.logger.error("Groq error: %s", exc)
+			return ""
+
+	return cached_completion("groq", llm.model_name, prompt, _groq_params(llm), _complete, use_cache=cache)
+
+
+def _groq_params(llm: Any) -> dict[str, Any]:
+	return {"template": GROQ_TEMPLATE, "temperature": llm.temperature}
+
+
+def _instrumented_stream(
+	provider: str,
+	model: str,
+	prompt: str,
+	params: dict[str, Any],
+	chunks: Iterator[str],
+	use_cache: bool,
+) -> Iterator[str]:
+	"""Relay text deltas, recording time-to-first-token and caching the full text.
+
+	Closing this generator (client disconnect) closes ``chunks`` and with it
+	the upstream HTTP stream.
+	"""
+	started = time.perf_counter()
+	first = True
+	parts: list[str] = []
+	completed = False
 	try:
-		resp = client.chat.completions.create(
+		for chunk in chunks:
+			if first:
+				ttft = time.perf_counter() - started
+				metrics.observe(f"llm.{provider}.ttft", ttft)
+				current_app.logger.info("LLM %s time-to-first-token %.1f ms", provider, ttft * 1000)
+				first = False
+			parts.append(chunk)
+			yield chunk
+		completed = True
+	finally:
+		if not completed:
+			metrics.incr(f"llm.{provider}.stream_cancelled")
+		close = getattr(chunks, "close", None)
+		if close is not None:
+			close()
+		metrics.observe(f"llm.{provider}.stream", time.perf_counter() - started)
+		if completed and use_cache:
+			store_completion(provider, model, prompt, params, "".join(parts))
+
+
+def _stream_or_cached(
+	provider: str,
+	model: str,
+	prompt: str,
+	params: dict[str, Any],
+	open_stream: Callable[[], Iterator[str]],
+	use_cache: bool,
+) -> Iterator[str]:
+	if use_cache:
+		hit = lookup_completion(provider, model, prompt, params)
+		if hit is not None:
+			return iter([hit])
+	return _instrumented_stream(provider, model, prompt, params, open_stream(), use_cache)
+
+
+def stream_openai_complete(prompt: str, model: str = "gpt-4o-mini", cache: bool = True) -> Iterator[str]:
+	"""Yield completion text deltas from OpenAI's streaming chat API."""
+	client = get_openai_client()
+
+	def _open() -> Iterator[str]:
+		llm_quota("openai", model, prompt)
+		stream = client.chat.completions.create(
 			model=model,
 			messages=[{"role": "user", "content": prompt}],
-			temperature=0.2,
+			stream=True,
+			**_OPENAI_PARAMS,
 		)
-		return resp.choices[0].message.content or ""
-	except Exception as exc:  # noqa: BLE001
-		current_app.logger.error("OpenAI error: %s", exc)
-		return ""
+		try:
+			for chunk in stream:
+				delta = chunk.choices[0].delta.content if chunk.choices else None
+				if delta:
+					yield delta
+		finally:
+			stream.close()
 
+	return _stream_or_cached("openai", model, prompt, _OPENAI_PARAMS, _open, cache)
 
-def safe_anthropic_complete(prompt: str, model: str = "claude-3-5-sonnet-20240620") -> str:
-	"""Minimal safe wrapper for Anthropic messages API."""
+
+def stream_anthropic_complete(
+	prompt: str, model: str = "claude-3-5-sonnet-20240620", cache: bool = True
+) -> Iterator[str]:
+	"""Yield completion text deltas from Anthropic's streaming messages API."""
 	client = get_anthropic_client()
-	try:
-		resp = client.messages.create(
+
+	def _open() -> Iterator[str]:
+		llm_quota("anthropic", model, prompt)
+		with client.messages.stream(
+			model=model,
+			messages=[{"role": "user", "content": prompt}],
+			**_ANTHROPIC_PARAMS,
+		) as stream:
+			yield from stream.text_stream
+
+	return _stream_or_cached("anthropic", model, prompt, _ANTHROPIC_PARAMS, _open, cache)
+
+
+def stream_groq_complete(prompt: str, cache: bool = True) -> Iterator[str]:
+	"""Yield reply text deltas from the Groq chain's ``stream``."""
+	llm = get_groq_llm()
+
+	chain = get_groq_chain()
+
+	def _open() -> Iterator[str]:
+		llm_quota("groq", llm.model_name, prompt)
+		for chunk in chain.stream({"message": prompt}):
+			if chunk.content:
+				yield chunk.content
+
+	return _stream_or_cached("groq", llm.model_name, prompt, _groq_params(llm), _open, cache)
+
+
+def _structured_call(
+	provider: str, prompt: str, schema: dict[str, Any], name: str, model: Optional[str]
+) -> Any:
+	"""One schema-constrained call; returns tool-call arguments or JSON text."""
+	if provider == "openai":
+		model = model or "gpt-4o-mini"
+		llm_quota(provider, model, prompt)
+		resp = get_openai_client().chat.completions.create(
+			model=model,
+			messages=[{"role": "user", "content": prompt}],
+			response_format={
+				"type": "json_schema",
+				"json_schema": {"name": name, "schema": schema, "strict": True},
+			},
+			**_OPENAI_PARAMS,
+		)
+		return resp.choices[0].message.content or ""
+	if provider == "anthropic":
+		model = model or "claude-3-5-sonnet-20240620"
+		llm_quota(provider, model, prompt)
+		resp = get_anthropic_client().messages.create(
 			model=model,
-			max_tokens=512,
 			messages=[{"role": "user", "content": prompt}],
+			tools=[{"name": name, "description": f"Record the {name}.", "input_schema": schema}],
+			tool_choice={"type": "tool", "name": name},
+			**_ANTHROPIC_PARAMS,
 		)
-		# Anthropic returns a list of content blocks
-		parts = resp.content or []
-		text = "".join(
-			p.text for p in parts if getattr(p, "type", None) == "text" and getattr(p, "text", None)
+		for block in resp.content or []:
+			if getattr(block, "type", None) == "tool_use":
+				return block.input
+		return "".join(getattr(b, "text", "") or "" for b in resp.content or [])
+	if provider == "groq":
+		llm = get_groq_llm()
+		bound = _clients.get(
+			f"groq_tool_{name}",
+			(id(llm), json.dumps(schema, sort_keys=True)),
+			lambda: llm.bind_tools(
+				[{
+					"type": "function",
+					"function": {"name": name, "description": f"Record the {name}.", "parameters": schema},
+				}],
+				tool_choice=name,
+			),
 		)
-		return text
-	except Exception as exc:  # noqa: BLE001
-		current_app.logger.error("Anthropic error: %s", exc)
-		return ""
+		llm_quota(provider, llm.model_name, prompt)
+		message = bound.invoke(prompt)
+		if message.tool_calls:
+			return message.tool_calls[0]["args"]
+		return message.content
+	raise ValueError(f"unknown LLM provider: {provider}")
 
-GROQ_TEMPLATE = "\n".join([
-    "Please politely reply to the client"
-    "{message}",
-])
-def safe_groq_complete(prompt: str) -> str:
-	"""Minimal safe wrapper for Groq messages API."""
-	llm = get_groq_llm()
-	try:
-		groq_template = PromptTemplate(
-			input_variables = ["message"],
-			template = GROQ_TEMPLATE
+
+def structured_complete(
+	provider: str,
+	prompt: str,
+	schema: dict[str, Any],
+	name: str,
+	model: Optional[str] = None,
+) -> dict[str, Any]:
+	"""Single call returning an object validated against ``schema``.
+
+	Uses JSON-schema output (OpenAI) or forced tool calling (Anthropic,
+	Groq). Text replies are repaired once locally; if the result is still
+	invalid the call is retried up to ``LLM_STRUCTURED_RETRIES`` times with
+	the validation error appended. Raises ``StructuredOutputError`` or the
+	provider's error.
+	"""
+	retries = int(current_app.config.get("LLM_STRUCTURED_RETRIES", 1))
+	attempt_prompt = prompt
+	failures = 0
+	while True:
+		reply = _structured_call(provider, attempt_prompt, schema, name, model)
+		try:
+			return structured.parse(reply, schema)
+		except StructuredOutputError as exc:
+			metrics.incr("llm.structured.invalid")
+			failures += 1
+			if failures > retries:
+				raise
+			attempt_prompt = (
+				f"{prompt}\n\nYour previous reply was rejected ({exc}). "
+				"Reply again with only the JSON object."
+			)
+
+
+def _batch_concurrency(requested: Optional[int]) -> int:
+	limit = int(current_app.config.get("LLM_BATCH_CONCURRENCY", 8))
+	return max(1, min(limit, requested or limit))
+
+
+def _run_batch(
+	provider: str,
+	prompts: Sequence[str],
+	call: Callable[[str], str],
+	max_concurrency: int,
+) -> list[dict[str, Any]]:
+	"""Run ``call`` over ``prompts`` on a bounded thread pool.
+
+	Results keep the input order; a failing item yields ``{"error": ...}``
+	without affecting the rest.
+	"""
+	app = current_app._get_current_object()
+
+	def _one(prompt: str) -> dict[str, Any]:
+		with app.app_context():
+			try:
+				return {"text": call(prompt)}
+			except RateLimited as exc:
+				app.logger.warning("%s batch item throttled: %s", provider, exc)
+				return {"error": f"{provider}_throttled", "retry_after": round(exc.retry_after, 2)}
+			except Exception as exc:  # noqa: BLE001
+				app.logger.error("%s batch item error: %s", provider, exc)
+				return {"error": f"{provider}_failed"}
+
+	if not prompts:
+		return []
+	with ThreadPoolExecutor(max_workers=min(max_concurrency, len(prompts))) as pool:
+		return list(pool.map(_one, prompts))
+
+
+def batch_openai_complete(
+	prompts: Sequence[str],
+	model: str = "gpt-4o-mini",
+	max_concurrency: Optional[int] = None,
+	cache: bool = True,
+) -> list[dict[str, Any]]:
+	"""Complete many prompts with OpenAI, ``max_concurrency`` at a time."""
+	client = get_openai_client()
+	# Pool threads have no request context; decide the wait here
+	max_wait = request_max_wait()
+
+	def _call(prompt: str) -> str:
+		return cached_completion(
+			"openai", model, prompt, _OPENAI_PARAMS,
+			lambda: _openai_chat(client, prompt, model, max_wait), use_cache=cache,
 		)
-		client = groq_template | llm
-		result_string = client.invoke({"message": prompt}).content
-		return result_string
-		pass
-	except Exception as exc:  # noqa: BLE001
-		current_app.logger.error("Groq error: %s", exc)
-		return ""
 
+	return _run_batch("openai", prompts, _call, _batch_concurrency(max_concurrency))
+
+
+def batch_anthropic_complete(
+	prompts: Sequence[str],
+	model: str = "claude-3-5-sonnet-20240620",
+	max_concurrency: Optional[int] = None,
+	cache: bool = True,
+) -> list[dict[str, Any]]:
+	"""Complete many prompts with Anthropic, ``max_concurrency`` at a time."""
+	client = get_anthropic_client()
+	# Pool threads have no request context; decide the wait here
+	max_wait = request_max_wait()
+
+	def _call(prompt: str) -> str:
+		return cached_completion(
+			"anthropic", model, prompt, _ANTHROPIC_PARAMS,
+			lambda: _anthropic_message(client, prompt, model, max_wait), use_cache=cache,
+		)
+
+	return _run_batch("anthropic", prompts, _call, _batch_concurrency(max_concurrency))
+
+
+def batch_groq_complete(
+	prompts: Sequence[str],
+	max_concurrency: Optional[int] = None,
+	cache: bool = True,
+) -> list[dict[str, Any]]:
+	"""Draft replies for many prompts through the compiled chain's ``batch``.
+
+	Cached prompts are answered locally; only misses go to Groq, with
+	``max_concurrency`` calls in flight.
+	"""
+	llm = get_groq_llm()
+	chain = get_groq_chain()
+	params = _groq_params(llm)
+	results: list[Optional[dict[str, Any]]] = [None] * len(prompts)
+	misses: list[int] = []
+	for i, prompt in enumerate(prompts):
+		hit = lookup_completion("groq", llm.model_name, prompt, params) if cache else None
+		if hit is not None:
+			results[i] = {"text": hit}
+			continue
+		try:
+			llm_quota("groq", llm.model_name, prompt)
+		except RateLimited as exc:
+			current_app.logger.warning("groq batch item throttled: %s", exc)
+			results[i] = {"error": "groq_throttled", "retry_after": round(exc.retry_after, 2)}
+			continue
+		misses.append(i)
+
+	if misses:
+		outputs = chain.batch(
+			[{"message": prompts[i]} for i in misses],
+			config={"max_concurrency": _batch_concurrency(max_concurrency)},
+			return_exceptions=True,
+		)
+		for i, output in zip(misses, outputs):
+			if isinstance(output, Exception):
+				current_app.logger.error("groq batch item error: %s", output)
+				results[i] = {"error": "groq_failed"}
+				continue
+			results[i] = {"text": output.content}
+			if cache:
+				store_completion("groq", llm.model_name, prompts[i], params, output.content)
+	return results  # type: ignore[return-value]
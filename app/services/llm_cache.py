@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+from flask import current_app
+
+from . import metrics
+from .store import store_for_url
+
+_KEY_PREFIX = "llm:resp:"
+
+
+def cache_key(provider: str, model: str, prompt: str, params: dict[str, Any]) -> str:
+	"""Stable hash of everything that determines a completion."""
+	raw = json.dumps([provider, model, prompt, params], sort_keys=True, separators=(",", ":"))
+	return _KEY_PREFIX + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class MemoryLLMCache:
+	"""Thread-safe in-process LRU with TTL and entry/byte limits (dev)."""
+
+	def __init__(self, max_entries: int = 1024, max_bytes: int = 32 * 1024 * 1024) -> None:
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.bytes = 0
+		self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key: str) -> Optional[str]:
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				return None
+			if entry[0] <= time.monotonic():
+				self._drop(key)
+				return None
+			self._entries.move_to_end(key)
+			return entry[1]
+
+	def set(self, key: str, value: str, ttl: float) -> None:
+		size = len(value.encode("utf-8"))
+		if size > self.max_bytes:
+			return
+		with self._lock:
+			if key in self._entries:
+				self._drop(key)
+			self._entries[key] = (time.monotonic() + ttl, value)
+			self.bytes += size
+			while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+				self._drop(next(iter(self._entries)))
+
+	def _drop(self, key: str) -> None:
+		_, value = self._entries.pop(key)
+		self.bytes -= len(value.encode("utf-8"))
+
+	def stats(self) -> dict[str, Any]:
+		return {"entries": len(self._entries), "bytes": self.bytes}
+
+
+class RedisLLMCache:
+	"""Redis-backed cache shared by every process (production).
+
+	Size is bounded by the TTL plus the server's ``maxmemory`` eviction
+	policy; values larger than ``max_value_bytes`` are not stored.
+	"""
+
+	def __init__(self, url: str, max_value_bytes: int = 256 * 1024) -> None:
+		self._store = store_for_url(url)
+		self.max_value_bytes = max_value_bytes
+
+	def get(self, key: str) -> Optional[str]:
+		return self._store.get(key)
+
+	def set(self, key: str, value: str, ttl: float) -> None:
+		if len(value.encode("utf-8")) <= self.max_value_bytes:
+			self._store.set(key, value, ttl=ttl)
+
+
+_backends: dict[str, Any] = {}
+_backends_lock = threading.Lock()
+
+
+def get_llm_cache() -> Optional[MemoryLLMCache | RedisLLMCache]:
+	"""Backend selected by ``LLM_CACHE_URL``; empty disables caching."""
+	url = current_app.config.get("LLM_CACHE_URL") or ""
+	if not url:
+		return None
+	backend = _backends.get(url)
+	if backend is None:
+		with _backends_lock:
+			backend = _backends.get(url)
+			if backend is None:
+				max_bytes = int(current_app.config.get("LLM_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+				if url.startswith("memory://"):
+					backend = MemoryLLMCache(
+						max_entries=int(current_app.config.get("LLM_CACHE_MAX_ENTRIES", 1024)),
+						max_bytes=max_bytes,
+					)
+					metrics.register_gauge("llm_cache", backend.stats)
+				else:
+					backend = RedisLLMCache(url, max_value_bytes=min(max_bytes, 256 * 1024))
+				_backends[url] = backend
+	return backend
+
+
+def lookup_completion(provider: str, model: str, prompt: str, params: dict[str, Any]) -> Optional[str]:
+	"""Cached text for this call, or None (also when caching is disabled)."""
+	backend = get_llm_cache()
+	if backend is None:
+		return None
+	try:
+		hit = backend.get(cache_key(provider, model, prompt, params))
+	except Exception as exc:  # noqa: BLE001
+		current_app.logger.warning("LLM cache read failed: %s", exc)
+		hit = None
+	if hit is not None:
+		metrics.incr(f"llm_cache.{provider}.hit")
+		metrics.incr("llm_cache.bytes_served", len(hit))
+	else:
+		metrics.incr(f"llm_cache.{provider}.miss")
+	return hit
+
+
+def store_completion(provider: str, model: str, prompt: str, params: dict[str, Any], text: str) -> None:
+	"""Store a completion; empty text (the ``safe_*`` error value) is skipped."""
+	backend = get_llm_cache()
+	if backend is None or not text:
+		return
+	try:
+		backend.set(
+			cache_key(provider, model, prompt, params),
+			text,
+			ttl=float(current_app.config.get("LLM_CACHE_TTL", 3600)),
+		)
+		metrics.incr("llm_cache.bytes_stored", len(text))
+	except Exception as exc:  # noqa: BLE001
+		current_app.logger.warning("LLM cache write failed: %s", exc)
+
+
+def cached_completion(
+	provider: str,
+	model: str,
+	prompt: str,
+	params: dict[str, Any],
+	complete: Callable[[], str],
+	use_cache: bool = True,
+) -> str:
+	"""Return a cached completion or call ``complete`` and store its result.
+
+	Empty results (the ``safe_*`` wrappers' error value) are never cached, and
+	backend failures fall through to the provider.
+	"""
+	if not use_cache:
+		return complete()
+	hit = lookup_completion(provider, model, prompt, params)
+	if hit is not None:
+		return hit
+	text = complete()
+	store_completion(provider, model, prompt, params, text)
+	return text
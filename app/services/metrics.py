@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+# Per-process registry; each gunicorn/Celery worker reports its own numbers.
+_SAMPLE_WINDOW = 1024
+
+_lock = threading.Lock()
+_counters: dict[str, float] = defaultdict(float)
+_timings: dict[str, deque[float]] = {}
+_gauges: dict[str, Callable[[], Any]] = {}
+
+
+def incr(name: str, value: float = 1) -> None:
+	"""Increment a counter."""
+	with _lock:
+		_counters[name] += value
+
+
+def observe(name: str, seconds: float) -> None:
+	"""Record a duration sample (seconds) for a timing metric."""
+	with _lock:
+		samples = _timings.get(name)
+		if samples is None:
+			samples = _timings[name] = deque(maxlen=_SAMPLE_WINDOW)
+		samples.append(seconds)
+
+
+@contextmanager
+def timer(name: str) -> Iterator[None]:
+	"""Time the wrapped block and record it under ``name``."""
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		observe(name, time.perf_counter() - start)
+
+
+def register_gauge(name: str, fn: Callable[[], Any]) -> None:
+	"""Register a callable evaluated on every snapshot."""
+	with _lock:
+		_gauges[name] = fn
+
+
+def _percentile(ordered: list[float], pct: float) -> float:
+	idx = min(len(ordered) - 1, int(round(pct * (len(ordered) - 1))))
+	return ordered[idx]
+
+
+def snapshot() -> dict[str, Any]:
+	"""Return counters, timing summaries (ms) and gauges as plain dicts."""
+	with _lock:
+		counters = dict(_counters)
+		timings = {name: sorted(samples) for name, samples in _timings.items() if samples}
+		gauges = dict(_gauges)
+
+	timing_summary = {
+		name: {
+			"count": len(ordered),
+			"p50_ms": round(_percentile(ordered, 0.50) * 1000, 3),
+			"p99_ms": round(_percentile(ordered, 0.99) * 1000, 3),
+			"max_ms": round(ordered[-1] * 1000, 3),
+		}
+		for name, ordered in timings.items()
+	}
+	gauge_values: dict[str, Any] = {}
+	for name, fn in gauges.items():
+		try:
+			gauge_values[name] = fn()
+		except Exception:  # noqa: BLE001
+			gauge_values[name] = None
+	return {"counters": counters, "timings": timing_summary, "gauges": gauge_values}
@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import base64
+import codecs
+import html
+import re
+from typing import Any, Iterator, Optional
+
+# Base64 groups (4 characters -> 3 bytes) decoded per step: 192 KiB of output.
+_DECODE_CHUNK = 64 * 1024
+
+_CHARSET_RE = re.compile(r"charset\s*=\s*\"?([\w.:-]+)", re.IGNORECASE)
+_HTML_DROP_RE = re.compile(r"<(script|style|head|title)\b[^>]*>.*?</\1\s*>|<!--.*?-->", re.IGNORECASE | re.DOTALL)
+_HTML_BREAK_RE = re.compile(r"<\s*(?:br|/p|/div|/li|/tr|/h[1-6]|p|div|li|tr|h[1-6])\b[^>]*>", re.IGNORECASE)
+_HTML_TAG_RE = re.compile(r"<[^>]+>")
+_BLANK_LINES_RE = re.compile(r"\n\s*\n\s*\n+")
+
+
+def parse_headers(headers: list[dict[str, str]]) -> dict[str, str]:
+	"""Gmail header list to ``{lower-cased name: value}``; first occurrence wins."""
+	parsed: dict[str, str] = {}
+	for header in headers:
+		parsed.setdefault(header.get("name", "").lower(), header.get("value", ""))
+	return parsed
+
+
+def _charset(part: dict[str, Any]) -> str:
+	for header in part.get("headers") or ():
+		if header.get("name", "").lower() == "content-type":
+			match = _CHARSET_RE.search(header.get("value", ""))
+			if match:
+				try:
+					return codecs.lookup(match.group(1)).name
+				except LookupError:
+					break
+	return "utf-8"
+
+
+def _is_attachment(part: dict[str, Any]) -> bool:
+	if part.get("filename") or (part.get("body") or {}).get("attachmentId"):
+		return True
+	for header in part.get("headers") or ():
+		if header.get("name", "").lower() == "content-disposition":
+			return header.get("value", "").lower().startswith("attachment")
+	return False
+
+
+def decode_body(data: str, charset: str, max_bytes: int) -> tuple[str, int, bool]:
+	"""Decode base64url ``data`` chunk by chunk, stopping at ``max_bytes``.
+
+	Returns ``(text, bytes_used, truncated)``. Only the needed prefix is ever
+	decoded and a multi-byte character split by the cap is dropped, not
+	mangled.
+	"""
+	decoder = codecs.getincrementaldecoder(charset)(errors="replace")
+	out: list[str] = []
+	used = 0
+	start = 0
+	while start < len(data):
+		# Never decode much past the cap: 4 base64 characters per 3 bytes
+		step = min(_DECODE_CHUNK, -(-(max_bytes - used) // 3)) * 4
+		chunk = data[start:start + step]
+		start += step
+		raw = base64.urlsafe_b64decode(chunk + "=" * (-len(chunk) % 4))
+		if used + len(raw) >= max_bytes:
+			out.append(decoder.decode(raw[:max_bytes - used], final=False))
+			truncated = used + len(raw) > max_bytes or start < len(data)
+			return "".join(out), max_bytes, truncated
+		out.append(decoder.decode(raw))
+		used += len(raw)
+	out.append(decoder.decode(b"", final=True))
+	return "".join(out), used, False
+
+
+def html_to_text(markup: str) -> str:
+	"""Fast regex HTML-to-text: drop scripts/styles, keep block breaks, unescape."""
+	text = _HTML_DROP_RE.sub("", markup)
+	text = _HTML_BREAK_RE.sub("\n", text)
+	text = html.unescape(_HTML_TAG_RE.sub("", text))
+	return _BLANK_LINES_RE.sub("\n\n", text).strip()
+
+
+def walk_parts(payload: dict[str, Any]) -> Iterator[dict[str, Any]]:
+	"""Depth-first, document-order walk over every MIME part (no recursion)."""
+	stack = [payload]
+	while stack:
+		part = stack.pop()
+		yield part
+		children = part.get("parts")
+		if children:
+			stack.extend(reversed(children))
+
+
+def extract_message(message: dict[str, Any], max_bytes: int = 256 * 1024) -> dict[str, Any]:
+	"""Body text, headers and attachment stubs from a ``format=full`` message.
+
+	Prefers ``text/plain`` parts at any depth and falls back to converted
+	``text/html``. At most ``max_bytes`` of body are decoded; attachments
+	are listed (with their ``attachmentId``) but never decoded.
+	"""
+	payload = message.get("payload") or {}
+	plain: list[dict[str, Any]] = []
+	markup: list[dict[str, Any]] = []
+	attachments: list[dict[str, Any]] = []
+	for part in walk_parts(payload):
+		mime_type = (part.get("mimeType") or "").lower()
+		if mime_type.startswith("multipart/"):
+			continue
+		body = part.get("body") or {}
+		if _is_attachment(part):
+			attachments.append({
+				"filename": part.get("filename") or "",
+				"mimeType": mime_type,
+				"size": body.get("size", 0),
+				"attachmentId": body.get("attachmentId"),
+				"partId": part.get("partId"),
+			})
+		elif mime_type == "text/plain" and body.get("data"):
+			plain.append(part)
+		elif mime_type == "text/html" and body.get("data"):
+			markup.append(part)
+
+	texts: list[str] = []
+	truncated = False
+	remaining = max_bytes
+	for part in plain or markup:
+		if remaining <= 0:
+			truncated = True
+			break
+		text, used, cut = decode_body(part["body"]["data"], _charset(part), remaining)
+		remaining -= used
+		truncated = truncated or cut
+		texts.append(text)
+	body_text = "\n\n".join(texts)
+	if not plain and markup:
+		body_text = html_to_text(body_text)
+
+	headers = parse_headers(payload.get("headers") or [])
+	return {
+		"id": message.get("id"),
+		"threadId": message.get("threadId"),
+		"subject": headers.get("subject", ""),
+		"from": headers.get("from", ""),
+		"body": body_text,
+		"headers": headers,
+		"attachments": attachments,
+		"truncated": truncated,
+	}
+
+
+def attachment_bytes(data: Optional[str]) -> bytes:
+	"""Decode an ``attachments.get`` payload."""
+	return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)) if data else b""
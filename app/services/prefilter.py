@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import re
+from email.utils import parseaddr
+from typing import Any, Collection, Optional
+
+from . import metrics
+from .refunds import resolve_orders
+
+# Only the start of a body is scanned; order numbers and intent come early.
+_SCAN_CHARS = 4000
+
+_NO_REPLY_RE = re.compile(
+	r"^(?:no[-_.]?reply|do[-_.]?not[-_.]?reply|mailer[-_.]daemon|postmaster|bounces?|"
+	r"notifications?|alerts?|newsletters?|marketing|news)(?:[-_.+].*)?@",
+	re.IGNORECASE,
+)
+_BULK_PRECEDENCE = frozenset(("bulk", "list", "junk"))
+_ORDER_RE = re.compile(
+	r"(?:\border\b(?:\s*(?:no\.?|number|num|id))?\s*[:#]?\s*|#)((?=[A-Z0-9-]*\d)[A-Z0-9][A-Z0-9-]{3,63})\b",
+	re.IGNORECASE,
+)
+_REFUND_RE = re.compile(r"\b(?:refund|money\s+back|reimburse|charge\s*back|return(?:ing)?\s+(?:my|the|this))", re.IGNORECASE)
+_URGENT_RE = re.compile(r"\b(?:urgent|asap|immediately|lawyer|legal\s+action|fraud|chargeback)\b", re.IGNORECASE)
+
+
+def _verdict(category: str, importance: str, reason: str, order_number: Optional[str] = None) -> dict[str, Any]:
+	return {
+		"category": category,
+		"order_number": order_number,
+		"importance": importance,
+		"reason": reason,
+		"reply": None,
+		"source": "rules",
+	}
+
+
+def header_importance(headers: dict[str, str], text: str) -> str:
+	"""``high`` for flagged or urgent mail, ``low`` for bulk, else ``medium``."""
+	priority = headers.get("x-priority", "")[:1]
+	if priority in ("1", "2") or headers.get("importance", "").lower() == "high" \
+			or headers.get("priority", "").lower() == "urgent" or _URGENT_RE.search(text):
+		return "high"
+	if priority in ("4", "5") or headers.get("importance", "").lower() == "low":
+		return "low"
+	return "medium"
+
+
+def email_importance(email: dict[str, Any]) -> str:
+	"""``header_importance`` of a parsed email, before any LLM verdict."""
+	return header_importance(email.get("headers") or {}, _text(email))
+
+
+def _bulk_reason(email: dict[str, Any]) -> Optional[str]:
+	headers = email.get("headers") or {}
+	if "list-unsubscribe" in headers or "list-id" in headers:
+		return "newsletter"
+	if headers.get("precedence", "").strip().lower() in _BULK_PRECEDENCE:
+		return "bulk"
+	if headers.get("auto-submitted", "no").strip().lower() != "no":
+		return "auto_submitted"
+	if _NO_REPLY_RE.match(parseaddr(email.get("from") or "")[1]):
+		return "no_reply_sender"
+	return None
+
+
+def order_numbers(text: str) -> list[str]:
+	"""Order-number candidates in ``text``, in order of appearance."""
+	return list(dict.fromkeys(m.group(1) for m in _ORDER_RE.finditer(text)))
+
+
+def _text(email: dict[str, Any]) -> str:
+	return f"{email.get('subject') or ''}\n{(email.get('body') or '')[:_SCAN_CHARS]}"
+
+
+def _refund_candidates(email: dict[str, Any]) -> tuple[str, list[str]]:
+	text = _text(email)
+	return text, order_numbers(text) if _REFUND_RE.search(text) else []
+
+
+def _refund_verdict(
+	email: dict[str, Any], text: str, candidates: list[str], known_orders: Collection[str]
+) -> Optional[dict[str, Any]]:
+	matched = next((n for n in candidates if n in known_orders), None)
+	if matched is None:
+		return None
+	importance = header_importance(email.get("headers") or {}, text)
+	return _verdict("refund", importance, "order_number_match", matched)
+
+
+def preclassify(
+	email: dict[str, Any],
+	known_orders: Collection[str] = frozenset(),
+) -> Optional[dict[str, Any]]:
+	"""Deterministic verdict for obvious mail, or None if the LLM should decide.
+
+	Bulk and automated mail is filed as low-importance ``other``. A refund
+	request naming an order in ``known_orders`` is a ``refund``.
+	"""
+	reason = _bulk_reason(email)
+	if reason is not None:
+		return _verdict("other", "low", reason)
+	text, candidates = _refund_candidates(email)
+	return _refund_verdict(email, text, candidates, known_orders)
+
+
+def preclassify_emails(emails: list[dict[str, Any]]) -> list[Optional[dict[str, Any]]]:
+	"""``preclassify`` a batch, resolving every candidate order in one query."""
+	verdicts: list[Optional[dict[str, Any]]] = []
+	refunds: list[tuple[int, dict[str, Any], str, list[str]]] = []
+	for i, email in enumerate(emails):
+		reason = _bulk_reason(email)
+		if reason is not None:
+			verdicts.append(_verdict("other", "low", reason))
+			continue
+		text, candidates = _refund_candidates(email)
+		verdicts.append(None)
+		if candidates:
+			refunds.append((i, email, text, candidates))
+
+	known = resolve_orders(n for _, _, _, candidates in refunds for n in candidates).keys()
+	for i, email, text, candidates in refunds:
+		verdicts[i] = _refund_verdict(email, text, candidates, known)
+
+	decided = [v for v in verdicts if v is not None]
+	metrics.incr("llm.prefilter.avoided", len(decided))
+	metrics.incr("llm.prefilter.ambiguous", len(verdicts) - len(decided))
+	for verdict in decided:
+		metrics.incr(f"llm.prefilter.{verdict['reason']}")
+	return verdicts
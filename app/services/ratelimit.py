@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import random
+import time
+from typing import Optional
+
+from flask import current_app, has_request_context
+
+from . import metrics
+from .compaction import estimate_tokens
+from .store import get_store
+
+# Gmail API quota units per call (per-user limit: 250 units/second)
+GMAIL_QUOTA_UNITS = {
+	"messages.get": 5,
+	"messages.list": 5,
+	"messages.attachments.get": 5,
+	"history.list": 2,
+	"threads.get": 10,
+	"watch": 100,
+	"users.getProfile": 1,
+}
+
+
+class RateLimited(Exception):
+	"""A rate limit would make the caller wait longer than allowed."""
+
+	def __init__(self, scope: str, retry_after: float) -> None:
+		super().__init__(f"{scope} rate limited; retry in {retry_after:.2f}s")
+		self.scope = scope
+		self.retry_after = retry_after
+
+
+def acquire(
+	scope: str,
+	buckets: list[tuple[str, float, float, float]],
+	max_wait: Optional[float] = None,
+) -> float:
+	"""Take tokens from ``(key, cost, capacity, rate/s)`` buckets, sleeping while empty.
+
+	Buckets live in the shared store, so every process draws from the same
+	budget, and are charged together or not at all. Returns the seconds
+	waited; raises ``RateLimited`` if the wait would exceed ``max_wait``
+	(default ``RATE_LIMIT_MAX_WAIT``), leaving the caller to reschedule.
+	"""
+	if not buckets or not current_app.config.get("RATE_LIMIT_ENABLED", True):
+		return 0.0
+	if max_wait is None:
+		max_wait = float(current_app.config.get("RATE_LIMIT_MAX_WAIT", 10))
+	# A request larger than the bucket could never be paid for; charge a full bucket
+	charges = [(key, min(cost, capacity), capacity, rate) for key, cost, capacity, rate in buckets]
+	store = get_store()
+	waited = 0.0
+	while True:
+		wait = store.take_tokens(charges)
+		if wait <= 0:
+			break
+		if waited + wait > max_wait:
+			metrics.incr(f"ratelimit.{scope}.rejected")
+			if waited:
+				metrics.observe(f"ratelimit.{scope}.wait", waited)
+			raise RateLimited(scope, wait)
+		# Jitter so waiters on one bucket do not all retry at the same instant
+		pause = wait + random.uniform(0, min(wait, 0.05))
+		time.sleep(pause)
+		waited += pause
+	if waited:
+		metrics.incr(f"ratelimit.{scope}.throttled")
+		metrics.observe(f"ratelimit.{scope}.wait", waited)
+	return waited
+
+
+def gmail_quota(user_id: Optional[int], method: str, calls: int = 1, max_wait: Optional[float] = None) -> float:
+	"""Charge ``calls`` Gmail ``method`` requests to the user's quota bucket."""
+	rate = float(current_app.config.get("GMAIL_QUOTA_UNITS_PER_SECOND", 250))
+	burst = float(current_app.config.get("GMAIL_QUOTA_BURST", rate))
+	key = f"ratelimit:gmail:{user_id if user_id is not None else 'default'}"
+	return acquire("gmail", [(key, GMAIL_QUOTA_UNITS[method] * calls, burst, rate)], max_wait)
+
+
+def request_max_wait() -> Optional[float]:
+	"""``RATE_LIMIT_HTTP_MAX_WAIT`` inside an HTTP request, else ``None`` (the task default).
+
+	Request threads answer "throttled" instead of sleeping on a bucket;
+	only Celery tasks wait for it or reschedule.
+	"""
+	if has_request_context():
+		return float(current_app.config.get("RATE_LIMIT_HTTP_MAX_WAIT", 0))
+	return None
+
+
+def llm_quota(provider: str, model: str, prompt: str, max_wait: Optional[float] = None) -> float:
+	"""Charge one request and its estimated tokens to the provider/model RPM and TPM buckets.
+
+	Limits come from ``LLM_RATE_LIMITS`` (``"provider:model"`` first, then
+	``"provider"``); output tokens are reserved up front as
+	``LLM_RATE_OUTPUT_TOKENS``. ``max_wait`` defaults to ``request_max_wait()``.
+	"""
+	if max_wait is None:
+		max_wait = request_max_wait()
+	limits = current_app.config.get("LLM_RATE_LIMITS") or {}
+	entry = limits.get(f"{provider}:{model}") or limits.get(provider)
+	if not entry:
+		return 0.0
+	# Hash tag keeps both buckets in one Redis Cluster slot for the atomic script
+	base = f"ratelimit:{{llm:{provider}:{model}}}"
+	buckets: list[tuple[str, float, float, float]] = []
+	rpm = float(entry.get("rpm") or 0)
+	if rpm:
+		buckets.append((f"{base}:rpm", 1, rpm, rpm / 60))
+	tpm = float(entry.get("tpm") or 0)
+	if tpm:
+		tokens = estimate_tokens(prompt) + int(current_app.config.get("LLM_RATE_OUTPUT_TOKENS", 512))
+		buckets.append((f"{base}:tpm", tokens, tpm, tpm / 60))
+	return acquire(f"llm.{provider}", buckets, max_wait)
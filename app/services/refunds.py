@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Iterable, NamedTuple, Optional
+
+from flask import current_app
+from sqlalchemy import event
+
+from app.extensions import db
+from app.models import NotFoundRefund, Order, RefundRequest
+
+from . import metrics
+
+# Keeps IN (...) lists well under SQLite's bound-parameter limit.
+_IN_CHUNK = 500
+
+
+class OrderRef(NamedTuple):
+	"""Session-independent snapshot of the order fields refund matching needs."""
+
+	id: int
+	order_number: str
+	status: str
+	refund_requested: bool
+
+
+class OrderCache:
+	"""Bounded LRU/TTL cache of orders by number, plus a negative cache.
+
+	Misses are remembered for ``negative_ttl`` seconds so unknown numbers
+	quoted again and again do not hit the database every batch. Entries are
+	dropped as soon as an order's ``status``/``refund_requested`` changes or
+	a new order is inserted in this process; other processes catch up
+	within the TTL.
+	"""
+
+	def __init__(self, max_size: int = 10_000, ttl_seconds: float = 300, negative_ttl: float = 60) -> None:
+		self.max_size = max_size
+		self.ttl_seconds = ttl_seconds
+		self.negative_ttl = negative_ttl
+		self._entries: OrderedDict[str, tuple[float, Optional[OrderRef]]] = OrderedDict()
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.negative_hits = 0
+		self.misses = 0
+
+	def configure(self, max_size: int, ttl_seconds: float, negative_ttl: float) -> None:
+		with self._lock:
+			self.max_size = max_size
+			self.ttl_seconds = ttl_seconds
+			self.negative_ttl = negative_ttl
+			self._evict_over_capacity()
+
+	def get_many(self, numbers: Iterable[str]) -> tuple[dict[str, OrderRef], list[str]]:
+		"""Split ``numbers`` into cached orders and numbers still to look up.
+
+		Numbers in the negative cache appear in neither.
+		"""
+		found: dict[str, OrderRef] = {}
+		missing: list[str] = []
+		now = time.monotonic()
+		with self._lock:
+			for number in numbers:
+				entry = self._entries.get(number)
+				if entry is not None:
+					ttl = self.ttl_seconds if entry[1] is not None else self.negative_ttl
+					if now - entry[0] < ttl:
+						self._entries.move_to_end(number)
+						if entry[1] is not None:
+							found[number] = entry[1]
+							self.hits += 1
+						else:
+							self.negative_hits += 1
+						continue
+					del self._entries[number]
+				missing.append(number)
+				self.misses += 1
+		return found, missing
+
+	def put_many(self, orders: Iterable[OrderRef], missing: Iterable[str] = ()) -> None:
+		now = time.monotonic()
+		with self._lock:
+			for order in orders:
+				self._entries[order.order_number] = (now, order)
+				self._entries.move_to_end(order.order_number)
+			for number in missing:
+				self._entries[number] = (now, None)
+				self._entries.move_to_end(number)
+			self._evict_over_capacity()
+
+	def invalidate(self, numbers: Iterable[str]) -> None:
+		with self._lock:
+			for number in numbers:
+				self._entries.pop(number, None)
+
+	def clear(self) -> None:
+		with self._lock:
+			self._entries.clear()
+
+	def reset_after_fork(self) -> None:
+		self._lock = threading.Lock()
+
+	def stats(self) -> dict[str, Any]:
+		with self._lock:
+			return {
+				"size": len(self._entries),
+				"max_size": self.max_size,
+				"hits": self.hits,
+				"negative_hits": self.negative_hits,
+				"misses": self.misses,
+			}
+
+	def _evict_over_capacity(self) -> None:
+		while len(self._entries) > self.max_size:
+			self._entries.popitem(last=False)
+
+
+order_cache = OrderCache()
+metrics.register_gauge("order_cache", order_cache.stats)
+
+if hasattr(os, "register_at_fork"):
+	os.register_at_fork(after_in_child=order_cache.reset_after_fork)
+
+
+@event.listens_for(Order.status, "set")
+@event.listens_for(Order.refund_requested, "set")
+def _invalidate_changed_order(target: Order, value: Any, oldvalue: Any, initiator: Any) -> None:
+	if target.order_number and value != oldvalue:
+		order_cache.invalidate([target.order_number])
+
+
+@event.listens_for(Order, "after_insert")
+def _invalidate_new_order(mapper: Any, connection: Any, target: Order) -> None:
+	# Drop a cached "does not exist" for the new number
+	order_cache.invalidate([target.order_number])
+
+
+def _configure_cache() -> None:
+	cfg = current_app.config
+	settings = (
+		int(cfg.get("ORDER_CACHE_SIZE", 10_000)),
+		float(cfg.get("ORDER_CACHE_TTL", 300)),
+		float(cfg.get("ORDER_CACHE_NEGATIVE_TTL", 60)),
+	)
+	if settings != (order_cache.max_size, order_cache.ttl_seconds, order_cache.negative_ttl):
+		order_cache.configure(*settings)
+
+
+def resolve_orders(numbers: Iterable[str]) -> dict[str, OrderRef]:
+	"""Map each known order number to its order, one IN query for cache misses."""
+	_configure_cache()
+	wanted = list(dict.fromkeys(n for n in numbers if n))
+	if not wanted:
+		return {}
+	found, missing = order_cache.get_many(wanted)
+	if missing:
+		loaded: list[OrderRef] = []
+		for start in range(0, len(missing), _IN_CHUNK):
+			rows = db.session.query(
+				Order.id, Order.order_number, Order.status, Order.refund_requested
+			).filter(Order.order_number.in_(missing[start:start + _IN_CHUNK]))
+			loaded.extend(OrderRef(*row) for row in rows)
+		found.update((order.order_number, order) for order in loaded)
+		order_cache.put_many(loaded, missing=set(missing) - {o.order_number for o in loaded})
+		metrics.incr("orders.lookup.queried", len(missing))
+	metrics.incr("orders.lookup.cached", len(wanted) - len(missing))
+	return found
+
+
+def record_refunds(requests: list[dict[str, Any]]) -> dict[str, int]:
+	"""Bulk-stage refund requests matched to orders, without committing.
+
+	Each request is a dict with ``order_number``, ``requester_email``,
+	``reason`` and ``conversation_thread_id``. Requests whose order exists
+	become ``RefundRequest`` rows and flag the order; the rest become
+	``NotFoundRefund`` rows. One insert per table and one UPDATE for the
+	orders, however large the batch.
+	"""
+	orders = resolve_orders(r["order_number"] for r in requests if r.get("order_number"))
+	matched: list[dict[str, Any]] = []
+	not_found: list[dict[str, Any]] = []
+	for request in requests:
+		order = orders.get(request.get("order_number") or "")
+		if order is not None:
+			matched.append({
+				"order_id": order.id,
+				"order_number": order.order_number,
+				"requester_email": request["requester_email"],
+				"conversation_thread_id": request.get("conversation_thread_id"),
+			})
+		else:
+			not_found.append({
+				"order_number": request.get("order_number"),
+				"requester_email": request["requester_email"],
+				"reason": request.get("reason") if request.get("order_number") else "no_order_number",
+				"conversation_thread_id": request.get("conversation_thread_id"),
+			})
+
+	if matched:
+		db.session.execute(RefundRequest.__table__.insert(), matched)
+		flagged = {row["order_id"]: row["order_number"] for row in matched}
+		Order.query.filter(Order.id.in_(flagged)).update(
+			{Order.refund_requested: True}, synchronize_session=False
+		)
+		# The bulk UPDATE bypasses attribute events
+		order_cache.invalidate(flagged.values())
+	if not_found:
+		db.session.execute(NotFoundRefund.__table__.insert(), not_found)
+	return {"refund": len(matched), "not_found": len(not_found)}
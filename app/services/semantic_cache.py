@@ -0,0 +1,279 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Optional
+
+from flask import current_app
+
+from . import metrics
+
+try:
+	import numpy as np
+except Exception:  # pragma: no cover - optional until packages installed
+	np = None  # type: ignore
+
+try:
+	import fcntl
+except Exception:  # pragma: no cover - Windows
+	fcntl = None  # type: ignore
+
+# Order numbers, ticket ids and amounts: anything alphanumeric containing a digit.
+_ENTITY_RE = re.compile(r"#?\b(?=[A-Za-z0-9-]*\d)[A-Za-z0-9][A-Za-z0-9-]{2,}\b")
+_TOKEN_RE = re.compile(r"[a-z]+|<n>")
+
+
+def extract_entities(text: str) -> list[str]:
+	return [m.group(0).lstrip("#") for m in _ENTITY_RE.finditer(text)]
+
+
+def normalize(text: str) -> list[str]:
+	"""Lower-case word tokens with every entity collapsed to ``<n>``."""
+	return _TOKEN_RE.findall(_ENTITY_RE.sub(" <n> ", text).lower())
+
+
+def hashing_vector(text: str, dim: int) -> "np.ndarray":
+	"""L2-normalised signed hashing vector over unigrams and bigrams."""
+	tokens = normalize(text)
+	features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+	vec = np.zeros(dim, dtype=np.float32)
+	if not features:
+		return vec
+	hashes = np.fromiter(
+		(zlib.crc32(f.encode("utf-8")) for f in features), dtype=np.uint32, count=len(features)
+	)
+	signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+	np.add.at(vec, (hashes % dim).astype(np.intp), signs)
+	norm = float(np.linalg.norm(vec))
+	return vec / norm if norm else vec
+
+
+class SemanticIndex:
+	"""Append-only, memory-mapped cosine index of prompts and their replies.
+
+	Vectors are stored as int8 with a per-row scale in memmaps and bucketed
+	by a random-hyperplane SimHash; a lookup scores only the query's bucket
+	and its one-bit neighbours, so cost stays flat as the index grows. Files:
+
+	``meta.json`` (count/capacity), ``vectors.i8``, ``scales.f32``,
+	``codes.u16``, ``offsets.i64`` (start/length into ``replies.jsonl``).
+	"""
+
+	def __init__(self, path: str | Path, dim: int = 512, bits: int = 12, seed: int = 1729) -> None:
+		self.path = Path(path)
+		self.path.mkdir(parents=True, exist_ok=True)
+		self.dim = dim
+		self.bits = bits
+		rng = np.random.default_rng(seed)
+		self._planes = rng.standard_normal((bits, dim)).astype(np.float32)
+		self._weights = (1 << np.arange(bits)).astype(np.uint32)
+		self._lock = threading.Lock()
+		self._count = 0
+		self._capacity = 0
+		self._meta_mtime = 0
+		self._buckets: dict[int, list[int]] = {}
+		self._load()
+
+	# -- storage -----------------------------------------------------------
+
+	def _file(self, name: str) -> Path:
+		return self.path / name
+
+	def _read_meta(self) -> dict[str, Any]:
+		meta_file = self._file("meta.json")
+		if not meta_file.exists():
+			return {"count": 0, "capacity": 0, "dim": self.dim, "bits": self.bits}
+		meta = json.loads(meta_file.read_text())
+		if meta.get("dim") != self.dim or meta.get("bits") != self.bits:
+			raise RuntimeError(f"semantic index at {self.path} was built with other dim/bits")
+		return meta
+
+	def _write_meta(self) -> None:
+		tmp = self._file("meta.json.tmp")
+		tmp.write_text(json.dumps({
+			"count": self._count, "capacity": self._capacity, "dim": self.dim, "bits": self.bits,
+		}))
+		os.replace(tmp, self._file("meta.json"))
+		self._meta_mtime = self._file("meta.json").stat().st_mtime_ns
+
+	def _map(self, capacity: int) -> None:
+		for name, dtype, shape in (
+			("vectors.i8", np.int8, (capacity, self.dim)),
+			("scales.f32", np.float32, (capacity,)),
+			("codes.u16", np.uint16, (capacity,)),
+			("offsets.i64", np.int64, (capacity, 2)),
+		):
+			file = self._file(name)
+			size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+			with open(file, "ab") as fh:
+				if fh.tell() < size:
+					fh.truncate(size)
+		self._vectors = np.memmap(self._file("vectors.i8"), np.int8, "r+", shape=(capacity, self.dim))
+		self._scales = np.memmap(self._file("scales.f32"), np.float32, "r+", shape=(capacity,))
+		self._codes = np.memmap(self._file("codes.u16"), np.uint16, "r+", shape=(capacity,))
+		self._offsets = np.memmap(self._file("offsets.i64"), np.int64, "r+", shape=(capacity, 2))
+		self._capacity = capacity
+
+	def _load(self) -> None:
+		meta = self._read_meta()
+		self._map(max(int(meta["capacity"]), 1024))
+		self._count = int(meta["count"])
+		self._index_rows(0, self._count)
+		if self._file("meta.json").exists():
+			self._meta_mtime = self._file("meta.json").stat().st_mtime_ns
+
+	def _index_rows(self, start: int, stop: int) -> None:
+		for row, code in enumerate(self._codes[start:stop].tolist(), start):
+			self._buckets.setdefault(code, []).append(row)
+
+	def _refresh(self) -> None:
+		"""Pick up rows appended by other processes."""
+		meta_file = self._file("meta.json")
+		try:
+			mtime = meta_file.stat().st_mtime_ns
+		except FileNotFoundError:
+			return
+		if mtime == self._meta_mtime:
+			return
+		meta = self._read_meta()
+		if int(meta["capacity"]) > self._capacity:
+			self._map(int(meta["capacity"]))
+		new_count = int(meta["count"])
+		if new_count > self._count:
+			self._index_rows(self._count, new_count)
+			self._count = new_count
+		self._meta_mtime = mtime
+
+	# -- public API --------------------------------------------------------
+
+	def _code(self, vec: "np.ndarray") -> int:
+		return int(((self._planes @ vec) > 0).astype(np.uint32) @ self._weights)
+
+	def __len__(self) -> int:
+		return self._count
+
+	def lookup(self, text: str, threshold: float) -> Optional[tuple[float, str]]:
+		"""Best cached reply for a near-duplicate of ``text``, templated to its entities."""
+		vec = hashing_vector(text, self.dim)
+		if not vec.any():
+			return None
+		code = self._code(vec)
+		with self._lock:
+			self._refresh()
+			rows: list[int] = []
+			for probe in [code] + [code ^ (1 << i) for i in range(self.bits)]:
+				rows.extend(self._buckets.get(probe, ()))
+			if not rows:
+				return None
+			idx = np.asarray(rows, dtype=np.intp)
+			scores = (self._vectors[idx].astype(np.float32) @ vec) * self._scales[idx]
+			best = int(scores.argmax())
+			score = float(scores[best])
+			if score < threshold:
+				return None
+			start, length = (int(x) for x in self._offsets[idx[best]])
+		with open(self._file("replies.jsonl"), "rb") as fh:
+			fh.seek(start)
+			record = json.loads(fh.read(length))
+		reply = _retemplate(record["reply"], record["entities"], extract_entities(text))
+		return (score, reply) if reply is not None else None
+
+	def add(self, text: str, reply: str) -> None:
+		vec = hashing_vector(text, self.dim)
+		if not vec.any():
+			return
+		line = (json.dumps({"reply": reply, "entities": extract_entities(text)}) + "\n").encode("utf-8")
+		with self._lock, open(self._file("index.lock"), "a") as lock_fh:
+			if fcntl is not None:
+				fcntl.flock(lock_fh, fcntl.LOCK_EX)
+			try:
+				self._refresh()
+				if self._count >= self._capacity:
+					self._vectors.flush()
+					self._map(self._capacity * 2)
+				with open(self._file("replies.jsonl"), "ab") as fh:
+					start = fh.tell()
+					fh.write(line)
+				row = self._count
+				scale = float(np.abs(vec).max()) / 127
+				self._vectors[row] = np.rint(vec / scale).astype(np.int8)
+				self._scales[row] = scale
+				self._codes[row] = self._code(vec)
+				self._offsets[row] = (start, len(line))
+				for array in (self._vectors, self._scales, self._codes, self._offsets):
+					array.flush()
+				self._count += 1
+				self._buckets.setdefault(int(self._codes[row]), []).append(row)
+				self._write_meta()
+			finally:
+				if fcntl is not None:
+					fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+
+def _retemplate(reply: str, cached_entities: list[str], entities: list[str]) -> Optional[str]:
+	"""Swap the cached prompt's order numbers etc. for the new prompt's.
+
+	Returns None when the entities cannot be paired up, so a reply quoting
+	someone else's order is never reused verbatim.
+	"""
+	if len(cached_entities) != len(entities):
+		return None
+	mapping = {old: new for old, new in zip(cached_entities, entities) if old != new}
+	if not mapping:
+		return reply
+	# One pass over whole tokens, so a new value is never rewritten by a later pair
+	alternatives = "|".join(re.escape(old) for old in sorted(mapping, key=len, reverse=True))
+	pattern = re.compile(rf"(?<![A-Za-z0-9-])(?:{alternatives})(?![A-Za-z0-9-])")
+	return pattern.sub(lambda m: mapping[m.group(0)], reply)
+
+
+_indexes: dict[str, SemanticIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_semantic_index() -> Optional[SemanticIndex]:
+	"""Index configured by ``SEMANTIC_CACHE_*``; None when disabled or numpy is missing."""
+	cfg = current_app.config
+	if np is None or not cfg.get("SEMANTIC_CACHE_ENABLED", False):
+		return None
+	path = os.path.abspath(cfg.get("SEMANTIC_CACHE_DIR") or os.path.join(current_app.instance_path, "semantic_cache"))
+	index = _indexes.get(path)
+	if index is None:
+		with _indexes_lock:
+			index = _indexes.get(path)
+			if index is None:
+				index = SemanticIndex(path, dim=int(cfg.get("SEMANTIC_CACHE_DIM", 512)))
+				_indexes[path] = index
+	return index
+
+
+def semantic_lookup(prompt: str) -> Optional[str]:
+	"""Return a reusable reply for a near-duplicate prompt, if any."""
+	index = get_semantic_index()
+	if index is None:
+		return None
+	started = time.perf_counter()
+	try:
+		hit = index.lookup(prompt, threshold=float(current_app.config.get("SEMANTIC_CACHE_THRESHOLD", 0.92)))
+	except Exception as exc:  # noqa: BLE001
+		current_app.logger.warning("Semantic cache lookup failed: %s", exc)
+		return None
+	finally:
+		metrics.observe("semantic_cache.lookup", time.perf_counter() - started)
+	metrics.incr("semantic_cache.hit" if hit else "semantic_cache.miss")
+	return hit[1] if hit else None
+
+
+def semantic_store(prompt: str, reply: str) -> None:
+	index = get_semantic_index()
+	if index is None or not reply:
+		return
+	try:
+		index.add(prompt, reply)
+	except Exception as exc:  # noqa: BLE001
+		current_app.logger.warning("Semantic cache write failed: %s", exc)
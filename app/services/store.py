@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import threading
+import time
+import uuid
+from typing import Any, Optional, Sequence
+
+from flask import current_app
+
+try:
+	import redis
+except Exception:  # pragma: no cover - optional until packages installed
+	redis = None  # type: ignore
+
+
+class MemoryStore:
+	"""Process-local key/value store with TTLs, for dev/eager mode and tests."""
+
+	def __init__(self) -> None:
+		self._data: dict[str, tuple[Optional[float], Any]] = {}
+		self._lock = threading.Lock()
+
+	def _live(self, key: str) -> Any:
+		entry = self._data.get(key)
+		if entry is None:
+			return None
+		expires, value = entry
+		if expires is not None and expires <= time.monotonic():
+			del self._data[key]
+			return None
+		return value
+
+	@staticmethod
+	def _expiry(ttl: Optional[float]) -> Optional[float]:
+		return time.monotonic() + ttl if ttl else None
+
+	def get(self, key: str) -> Optional[str]:
+		with self._lock:
+			return self._live(key)
+
+	def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+		with self._lock:
+			self._data[key] = (self._expiry(ttl), str(value))
+
+	def set_nx(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+		with self._lock:
+			if self._live(key) is not None:
+				return False
+			self._data[key] = (self._expiry(ttl), str(value))
+			return True
+
+	def delete(self, key: str) -> None:
+		with self._lock:
+			self._data.pop(key, None)
+
+	def compare_and_delete(self, key: str, value: Any) -> bool:
+		with self._lock:
+			if self._live(key) != str(value):
+				return False
+			del self._data[key]
+			return True
+
+	def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+		with self._lock:
+			current = self._live(key)
+			value = (int(current) if current is not None else 0) + amount
+			self._data[key] = (self._expiry(ttl), str(value))
+			return value
+
+	def max_int(self, key: str, value: int, ttl: Optional[float] = None) -> int:
+		with self._lock:
+			current = self._live(key)
+			best = max(int(current), value) if current is not None else value
+			self._data[key] = (self._expiry(ttl), str(best))
+			return best
+
+	def take_tokens(self, buckets: Sequence[tuple[str, float, float, float]]) -> float:
+		"""Take ``cost`` from every ``(key, cost, capacity, rate)`` bucket or from none.
+
+		Returns 0 when taken, else the seconds until all buckets could pay.
+		"""
+		with self._lock:
+			now = time.monotonic()
+			levels: list[float] = []
+			wait = 0.0
+			for key, cost, capacity, rate in buckets:
+				current = self._live(key)
+				level, stamp = map(float, current.split(":")) if current is not None else (capacity, now)
+				level = min(capacity, level + max(0.0, now - stamp) * rate)
+				levels.append(level)
+				if level < cost:
+					wait = max(wait, (cost - level) / rate)
+			if wait > 0:
+				return wait
+			for (key, cost, capacity, rate), level in zip(buckets, levels):
+				self._data[key] = (self._expiry(2 * capacity / rate), f"{level - cost}:{now}")
+			return 0.0
+
+
+# KEYS[1]=key ARGV[1]=candidate ARGV[2]=ttl ms (0 = none)
+_MAX_INT_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '')
+local candidate = tonumber(ARGV[1])
+if current == nil or candidate > current then current = candidate end
+if tonumber(ARGV[2]) > 0 then
+	redis.call('SET', KEYS[1], current, 'PX', ARGV[2])
+else
+	redis.call('SET', KEYS[1], current)
+end
+return current
+"""
+
+# KEYS=buckets ARGV=(cost, capacity, rate/s) per bucket. All-or-nothing: tokens
+# are taken from every bucket or none; returns the wait in seconds ("0" = taken)
+_TAKE_TOKENS_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+	local cost, capacity, rate = tonumber(ARGV[i * 3 - 2]), tonumber(ARGV[i * 3 - 1]), tonumber(ARGV[i * 3])
+	local state = redis.call('HMGET', key, 'tokens', 'ts')
+	local level = tonumber(state[1]) or capacity
+	local stamp = tonumber(state[2]) or now
+	level = math.min(capacity, level + math.max(0, now - stamp) * rate)
+	levels[i] = level
+	if level < cost then wait = math.max(wait, (cost - level) / rate) end
+end
+if wait > 0 then return tostring(wait) end
+for i, key in ipairs(KEYS) do
+	local cost, capacity, rate = tonumber(ARGV[i * 3 - 2]), tonumber(ARGV[i * 3 - 1]), tonumber(ARGV[i * 3])
+	redis.call('HSET', key, 'tokens', tostring(levels[i] - cost), 'ts', tostring(now))
+	redis.call('PEXPIRE', key, math.ceil(2000 * capacity / rate))
+end
+return '0'
+"""
+
+_COMPARE_AND_DELETE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+
+class RedisStore:
+	"""Redis-backed store shared by every web and worker process."""
+
+	def __init__(self, url: str) -> None:
+		if redis is None:
+			raise RuntimeError("redis not installed")
+		self.client = redis.Redis.from_url(url, decode_responses=True)
+		self._max_int = self.client.register_script(_MAX_INT_SCRIPT)
+		self._compare_and_delete = self.client.register_script(_COMPARE_AND_DELETE_SCRIPT)
+		self._take_tokens = self.client.register_script(_TAKE_TOKENS_SCRIPT)
+
+	@staticmethod
+	def _px(ttl: Optional[float]) -> Optional[int]:
+		return int(ttl * 1000) if ttl else None
+
+	def get(self, key: str) -> Optional[str]:
+		return self.client.get(key)
+
+	def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+		self.client.set(key, value, px=self._px(ttl))
+
+	def set_nx(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+		return bool(self.client.set(key, value, nx=True, px=self._px(ttl)))
+
+	def delete(self, key: str) -> None:
+		self.client.delete(key)
+
+	def compare_and_delete(self, key: str, value: Any) -> bool:
+		return bool(self._compare_and_delete(keys=[key], args=[str(value)]))
+
+	def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+		pipe = self.client.pipeline()
+		pipe.incrby(key, amount)
+		if ttl:
+			pipe.pexpire(key, self._px(ttl))
+		return int(pipe.execute()[0])
+
+	def max_int(self, key: str, value: int, ttl: Optional[float] = None) -> int:
+		return int(self._max_int(keys=[key], args=[value, self._px(ttl) or 0]))
+
+	def take_tokens(self, buckets: Sequence[tuple[str, float, float, float]]) -> float:
+		args: list[float] = []
+		for _, cost, capacity, rate in buckets:
+			args.extend((cost, capacity, rate))
+		return float(self._take_tokens(keys=[key for key, *_ in buckets], args=args))
+
+
+_stores: dict[str, Any] = {}
+_stores_lock = threading.Lock()
+
+
+def store_for_url(url: str) -> MemoryStore | RedisStore:
+	"""Return the process-wide store for ``url`` (``memory://`` or ``redis://``)."""
+	store = _stores.get(url)
+	if store is None:
+		with _stores_lock:
+			store = _stores.get(url)
+			if store is None:
+				store = MemoryStore() if url.startswith("memory://") else RedisStore(url)
+				_stores[url] = store
+	return store
+
+
+def get_store() -> MemoryStore | RedisStore:
+	"""Return the shared-state store configured by ``SHARED_STATE_URL``.
+
+	``memory://`` gives a per-process store; ``redis://`` / ``rediss://`` a
+	client shared by every caller in the process.
+	"""
+	return store_for_url(current_app.config.get("SHARED_STATE_URL") or "memory://")
+
+
+def acquire_lock(key: str, ttl: float) -> Optional[str]:
+	"""Take a TTL-bounded lock; returns the owner token or None if held."""
+	owner = uuid.uuid4().hex
+	return owner if get_store().set_nx(key, owner, ttl=ttl) else None
+
+
+def release_lock(key: str, owner: str) -> bool:
+	"""Release a lock only if ``owner`` still holds it."""
+	return get_store().compare_and_delete(key, owner)
@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import json
+import re
+from typing import Any
+
+try:
+	import orjson
+except Exception:  # pragma: no cover - optional until packages installed
+	orjson = None  # type: ignore
+
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$", re.IGNORECASE)
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+_TYPES: dict[str, tuple[type, ...]] = {
+	"object": (dict,),
+	"array": (list,),
+	"string": (str,),
+	"integer": (int,),
+	"number": (int, float),
+	"boolean": (bool,),
+	"null": (type(None),),
+}
+
+
+class StructuredOutputError(ValueError):
+	"""Raised when a model reply is not valid JSON for the expected schema."""
+
+
+def loads(text: str | bytes) -> Any:
+	"""Parse JSON with orjson when available."""
+	if orjson is not None:
+		return orjson.loads(text)
+	return json.loads(text)
+
+
+def validate(data: Any, schema: dict[str, Any], path: str = "$") -> None:
+	"""Check ``data`` against the JSON-schema subset the LLM schemas use.
+
+	Supports ``type`` (string or list), ``enum``, ``properties``,
+	``required`` and ``additionalProperties: false``.
+	"""
+	types = schema.get("type")
+	if types is not None:
+		names = [types] if isinstance(types, str) else types
+		ok = any(
+			isinstance(data, _TYPES[name]) and not (name in ("integer", "number") and isinstance(data, bool))
+			for name in names
+		)
+		if not ok:
+			raise StructuredOutputError(f"{path}: expected {'/'.join(names)}, got {type(data).__name__}")
+	if "enum" in schema and data not in schema["enum"]:
+		raise StructuredOutputError(f"{path}: {data!r} not one of {schema['enum']}")
+	if isinstance(data, dict):
+		properties = schema.get("properties", {})
+		for name in schema.get("required", ()):
+			if name not in data:
+				raise StructuredOutputError(f"{path}: missing {name!r}")
+		if schema.get("additionalProperties") is False:
+			extra = set(data) - set(properties)
+			if extra:
+				raise StructuredOutputError(f"{path}: unexpected {sorted(extra)}")
+		for name, sub in properties.items():
+			if name in data:
+				validate(data[name], sub, f"{path}.{name}")
+
+
+def repair(text: str) -> str:
+	"""Best-effort cleanup of common model slips: code fences, prose, trailing commas."""
+	text = _FENCE_RE.sub("", text.strip())
+	start, end = text.find("{"), text.rfind("}")
+	if start != -1 and end > start:
+		text = text[start:end + 1]
+	return _TRAILING_COMMA_RE.sub(r"\1", text)
+
+
+def parse(reply: Any, schema: dict[str, Any]) -> dict[str, Any]:
+	"""Validated object from a tool-call dict or JSON text, repairing text once.
+
+	Raises ``StructuredOutputError`` if neither the reply nor its repair fits
+	``schema``.
+	"""
+	if isinstance(reply, dict):
+		validate(reply, schema)
+		return reply
+	text = reply or ""
+	try:
+		data = loads(text)
+	except ValueError:
+		try:
+			data = loads(repair(text))
+		except ValueError as exc:
+			raise StructuredOutputError(f"invalid JSON: {exc}") from exc
+	validate(data, schema)
+	return data
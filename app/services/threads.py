@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from flask import current_app
+
+from . import metrics
+from .compaction import collapse_whitespace, estimate_tokens, strip_noise, truncate_to_budget
+from .google_oauth import batch_get_messages, build_gmail_service
+from .mime import extract_message
+from .ratelimit import gmail_quota
+
+
+def _compact_message(message: dict[str, Any], max_bytes: int) -> dict[str, Any]:
+	"""Only what reply context needs; quoted history is redundant within a thread."""
+	parsed = extract_message(message, max_bytes=max_bytes)
+	return {
+		"id": parsed["id"],
+		"from": parsed["from"],
+		"subject": parsed["subject"],
+		"date": parsed["headers"].get("date", ""),
+		"body": collapse_whitespace(strip_noise(parsed["body"])),
+	}
+
+
+class ThreadCache:
+	"""Bounded LRU/TTL cache of compacted conversations.
+
+	Entries are keyed by ``(user_id, thread_id)`` and remember the thread's
+	``historyId`` so a changed thread is refreshed by fetching only the
+	messages not already held.
+	"""
+
+	def __init__(self, max_size: int = 1024, ttl_seconds: float = 3600) -> None:
+		self.max_size = max_size
+		self.ttl_seconds = ttl_seconds
+		self._entries: OrderedDict[Hashable, tuple[float, dict[str, Any]]] = OrderedDict()
+		self._lock = threading.Lock()
+
+	def configure(self, max_size: int, ttl_seconds: float) -> None:
+		with self._lock:
+			self.max_size = max_size
+			self.ttl_seconds = ttl_seconds
+			self._evict_over_capacity()
+
+	def get(self, key: Hashable) -> Optional[dict[str, Any]]:
+		now = time.monotonic()
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				return None
+			if now - entry[0] >= self.ttl_seconds:
+				del self._entries[key]
+				return None
+			self._entries.move_to_end(key)
+			return entry[1]
+
+	def put(self, key: Hashable, thread: dict[str, Any]) -> None:
+		with self._lock:
+			self._entries[key] = (time.monotonic(), thread)
+			self._entries.move_to_end(key)
+			self._evict_over_capacity()
+
+	def invalidate(self, key: Hashable) -> None:
+		with self._lock:
+			self._entries.pop(key, None)
+
+	def clear(self) -> None:
+		with self._lock:
+			self._entries.clear()
+
+	def reset_after_fork(self) -> None:
+		self._lock = threading.Lock()
+
+	def stats(self) -> dict[str, Any]:
+		with self._lock:
+			return {"size": len(self._entries), "max_size": self.max_size}
+
+	def _evict_over_capacity(self) -> None:
+		while len(self._entries) > self.max_size:
+			self._entries.popitem(last=False)
+
+
+thread_cache = ThreadCache()
+metrics.register_gauge("thread_cache", thread_cache.stats)
+
+if hasattr(os, "register_at_fork"):
+	os.register_at_fork(after_in_child=thread_cache.reset_after_fork)
+
+
+def _configure_cache() -> None:
+	max_size = int(current_app.config.get("THREAD_CACHE_SIZE", 1024))
+	ttl = float(current_app.config.get("THREAD_CACHE_TTL", 3600))
+	if (max_size, ttl) != (thread_cache.max_size, thread_cache.ttl_seconds):
+		thread_cache.configure(max_size, ttl)
+
+
+def get_thread(
+	access_token: str,
+	thread_id: str,
+	user_id: Optional[int] = None,
+	history_id: Optional[int | str] = None,
+) -> dict[str, Any]:
+	"""A conversation as ``{"id", "historyId", "messages"}`` with compacted bodies.
+
+	A cold thread costs one ``threads.get``. A cached thread costs nothing
+	when ``history_id`` (e.g. from a push notification) shows it is current;
+	otherwise a metadata-only ``threads.get`` detects changes and only new
+	messages are fetched, in one batch request.
+	"""
+	_configure_cache()
+	key = (user_id, thread_id)
+	max_bytes = int(current_app.config.get("GMAIL_BODY_MAX_BYTES", 256 * 1024))
+	cached = thread_cache.get(key)
+	if cached is not None and history_id is not None and int(cached["historyId"]) >= int(history_id):
+		metrics.incr("gmail.thread.hit")
+		return cached
+
+	service = build_gmail_service(access_token=access_token, user_id=user_id)
+	threads = service.users().threads()
+	gmail_quota(user_id, "threads.get")
+	if cached is None:
+		metrics.incr("gmail.thread.full")
+		resp = threads.get(userId="me", id=thread_id, format="full").execute()
+		thread = {
+			"id": thread_id,
+			"historyId": resp.get("historyId"),
+			"messages": [_compact_message(m, max_bytes) for m in resp.get("messages", [])],
+		}
+		thread_cache.put(key, thread)
+		return thread
+
+	resp = threads.get(userId="me", id=thread_id, format="minimal", fields="historyId,messages/id").execute()
+	if resp.get("historyId") == cached["historyId"]:
+		metrics.incr("gmail.thread.hit")
+		return cached
+	ids = [m["id"] for m in resp.get("messages", [])]
+	held = {m["id"]: m for m in cached["messages"]}
+	new_ids = [mid for mid in ids if mid not in held]
+	fetched = batch_get_messages(service, new_ids, user_id=user_id, format="full") if new_ids else {}
+	metrics.incr("gmail.thread.delta")
+	metrics.incr("gmail.thread.delta_messages", len(new_ids))
+	messages = []
+	for mid in ids:
+		if mid in held:
+			messages.append(held[mid])
+		elif mid in fetched:
+			messages.append(_compact_message(fetched[mid], max_bytes))
+	thread = {"id": thread_id, "historyId": resp.get("historyId"), "messages": messages}
+	if len(fetched) < len(new_ids):
+		# Keep the old entry so the missing messages are fetched next time
+		metrics.incr("gmail.thread.incomplete")
+		return thread
+	thread_cache.put(key, thread)
+	return thread
+
+
+def format_thread(thread: dict[str, Any], max_tokens: int) -> str:
+	"""Oldest-to-newest conversation text for a prompt, head/tail-truncated."""
+	text = "\n\n".join(
+		f"From: {m['from']}\nDate: {m['date']}\n{m['body']}" for m in thread["messages"]
+	)
+	if estimate_tokens(text) > max_tokens:
+		metrics.incr("gmail.thread.truncated")
+	return truncate_to_budget(text, max_tokens)
+
+
+def attach_thread_context(access_token: str, emails: list[dict[str, Any]], user_id: Optional[int] = None) -> None:
+	"""Set ``thread_context`` on replies to the conversation that precedes them.
+
+	One ``get_thread`` per conversation, however many of its messages are in
+	``emails``; mail starting a new thread gets no context. Failures only
+	cost the context, never the email.
+	"""
+	max_tokens = int(current_app.config.get("LLM_THREAD_TOKEN_BUDGET", 1000))
+	by_thread: dict[str, list[dict[str, Any]]] = {}
+	for email in emails:
+		thread_id = email.get("threadId")
+		if thread_id and thread_id != email.get("id"):
+			by_thread.setdefault(thread_id, []).append(email)
+	for thread_id, members in by_thread.items():
+		try:
+			thread = get_thread(access_token, thread_id, user_id=user_id)
+		except Exception as exc:  # noqa: BLE001
+			current_app.logger.warning("Thread context for %s unavailable: %s", thread_id, exc)
+			metrics.incr("gmail.thread.context_failed")
+			continue
+		for email in members:
+			earlier = []
+			for message in thread["messages"]:
+				if message["id"] == email.get("id"):
+					break
+				earlier.append(message)
+			if earlier:
+				email["thread_context"] = format_thread({**thread, "messages": earlier}, max_tokens)
@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from flask import current_app
+
+from app.extensions import db
+from app.models import GmailToken
+
+from . import metrics
+from .google_oauth import invalidate_gmail_clients, refresh_access_token
+from .store import acquire_lock, get_store, release_lock
+
+_LOCK_KEY = "gmail:token:refresh:{}"
+_SCHEDULED_KEY = "gmail:token:scheduled:{}"
+
+
+class TokenRefreshError(Exception):
+	"""Raised when an access token could not be refreshed."""
+
+
+def _as_utc(expiry: datetime) -> datetime:
+	return expiry.replace(tzinfo=timezone.utc) if expiry.tzinfo is None else expiry
+
+
+def needs_refresh(expiry: Optional[datetime], ahead: float = 0) -> bool:
+	"""True if ``expiry`` falls within ``ahead`` seconds from now."""
+	if not expiry:
+		return False
+	return _as_utc(expiry) <= datetime.now(timezone.utc) + timedelta(seconds=ahead)
+
+
+def _refresh_margin() -> float:
+	# Task-time safety net: refresh only tokens about to lapse mid-request
+	return float(current_app.config.get("GMAIL_TOKEN_REFRESH_MARGIN", 60))
+
+
+def refresh_token(token: GmailToken, ahead: Optional[float] = None) -> GmailToken:
+	"""Refresh ``token`` single-flight per user and persist it with one commit.
+
+	The refresh is skipped if, once the lock is held, the token no longer
+	expires within ``ahead`` seconds (default: the inline margin). If another
+	worker holds the user's refresh lock this waits for it to finish and
+	reloads the row instead of calling Google a second time.
+	"""
+	lock_key = _LOCK_KEY.format(token.user_id)
+	lock_ttl = float(current_app.config.get("GMAIL_TOKEN_REFRESH_LOCK_TTL", 30))
+	deadline = time.monotonic() + lock_ttl
+	owner = acquire_lock(lock_key, lock_ttl)
+	if owner is None:
+		metrics.incr("gmail.token.refresh_waited")
+		while owner is None and time.monotonic() < deadline:
+			time.sleep(0.05)
+			owner = acquire_lock(lock_key, lock_ttl)
+		if owner is None:
+			db.session.refresh(token)
+			return token
+
+	try:
+		# Someone may have refreshed while we waited for the lock
+		db.session.refresh(token)
+		if not needs_refresh(token.token_expiry, ahead=_refresh_margin() if ahead is None else ahead):
+			return token
+
+		started = time.perf_counter()
+		try:
+			res = refresh_access_token(token.refresh_token)
+		except Exception as exc:  # noqa: BLE001
+			metrics.incr("gmail.token.refresh_failed")
+			raise TokenRefreshError(str(exc)) from exc
+		metrics.observe("gmail.token.refresh", time.perf_counter() - started)
+
+		old_access_token = token.access_token
+		token.access_token = res.get("access_token") or token.access_token
+		token.token_expiry = res.get("expiry") or token.token_expiry
+		try:
+			db.session.commit()
+		except Exception:
+			db.session.rollback()
+			raise
+		invalidate_gmail_clients(user_id=token.user_id, access_token=old_access_token)
+		metrics.incr("gmail.token.refreshed")
+		return token
+	finally:
+		release_lock(lock_key, owner)
+
+
+def ensure_fresh_token(token: GmailToken) -> GmailToken:
+	"""Return ``token``, refreshing it first only if it is about to expire.
+
+	The beat job normally keeps tokens ahead of expiry, so this is a no-op on
+	the hot path.
+	"""
+	if needs_refresh(token.token_expiry, ahead=_refresh_margin()):
+		metrics.incr("gmail.token.refresh_inline")
+		return refresh_token(token)
+	return token
+
+
+def refresh_ahead() -> float:
+	"""Look-ahead used by the beat job (``GMAIL_TOKEN_REFRESH_AHEAD``)."""
+	return float(current_app.config.get("GMAIL_TOKEN_REFRESH_AHEAD", 600))
+
+
+def tokens_due_for_refresh() -> list[tuple[int, float]]:
+	"""``(token_id, countdown)`` for tokens expiring within the refresh horizon.
+
+	Countdowns are jittered so refreshes spread out, but always land before
+	the margin at which a request would refresh inline. Tokens already
+	scheduled in the current window are skipped.
+	"""
+	ahead = refresh_ahead()
+	jitter = float(current_app.config.get("GMAIL_TOKEN_REFRESH_JITTER", 120))
+	interval = float(current_app.config.get("GMAIL_TOKEN_REFRESH_INTERVAL", 60))
+	margin = _refresh_margin()
+	now = datetime.now(timezone.utc)
+	horizon = (now + timedelta(seconds=ahead)).replace(tzinfo=None)
+
+	store = get_store()
+	due: list[tuple[int, float]] = []
+	rows = db.session.query(GmailToken.id, GmailToken.user_id, GmailToken.token_expiry).filter(
+		GmailToken.token_expiry.isnot(None), GmailToken.token_expiry <= horizon
+	)
+	for token_id, user_id, expiry in rows:
+		if not store.set_nx(_SCHEDULED_KEY.format(user_id), 1, ttl=jitter + interval):
+			continue
+		latest = max(0.0, (_as_utc(expiry) - now).total_seconds() - margin * 2)
+		due.append((token_id, random.uniform(0, min(jitter, latest))))
+	return due
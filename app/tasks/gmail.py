@@ -1,64 +1,402 @@
 from __future__ import annotations
 
-from datetime import datetime, timezone
+import time
+from datetime import datetime, timedelta, timezone
 from typing import Any
 
-from celery import shared_task
+from celery import group, shared_task
 from flask import current_app
+from sqlalchemy import or_
 
 from app.extensions import db
-from app.models import GmailToken
-from app.services.google_oauth import build_gmail_service, refresh_access_token
+from app.models import GmailToken, User
+from app.services import metrics
+from app.services.classifier import classify_emails, rule_verdicts, save_classifications
+from app.services.coalesce import begin_sync, coalesce_window, end_sync
+from app.services.dedup import filter_unseen, mark_processed
+from app.services.fleet import finish_dispatch, record_progress, start_cycle
+from app.services.jobs import update_job
+from app.services.ratelimit import RateLimited
+from app.services.threads import attach_thread_context
+from app.services.google_oauth import (
+	HistoryExpiredError,
+	batch_get_messages,
+	build_gmail_service,
+	fetch_message_contents,
+	get_history,
+	get_latest_history_id,
+	history_message_ids,
+	list_message_ids,
+)
+from app.services.token_manager import (
+	TokenRefreshError,
+	ensure_fresh_token,
+	refresh_ahead,
+	refresh_token,
+	tokens_due_for_refresh,
+)
+from app.tasks.llm import enqueue_triage, hold_for_triage
 
-def _needs_refresh(expiry: datetime | None) -> bool:
-    if not expiry:
-        return False
-    if expiry.tzinfo is None:  # make naive datetime UTC
-        expiry = expiry.replace(tzinfo=timezone.utc)
-    return expiry <= datetime.now(timezone.utc)
 
+def _sync_user(user_id: int, max_results: int) -> dict[str, Any]:
+	"""Fetch a user's recent unread message metadata; raises on Gmail errors."""
+	token = GmailToken.query.filter_by(user_id=user_id).first()
+	if not token:
+		return {"ok": False, "error": "no_token"}
 
-@shared_task(bind=True, name="gmail.sync_user")
+	# Normally a no-op: the beat job refreshes tokens ahead of expiry
+	try:
+		token = ensure_fresh_token(token)
+	except TokenRefreshError as exc:
+		current_app.logger.error("Token refresh failed for user %s: %s", user_id, exc)
+		return {"ok": False, "error": "refresh_failed"}
+
+	# Build Gmail client, page through ids and batch the metadata fetches
+	service = build_gmail_service(token.access_token, user_id=user_id)
+	msg_ids = list_message_ids(service, max_results, q="is:unread", user_id=user_id)
+	details = batch_get_messages(
+		service, msg_ids, user_id=user_id, format="metadata", metadataHeaders=["From", "Subject"]
+	)
+
+	messages = []
+	for msg_id in msg_ids:
+		msg_detail = details.get(msg_id)
+		if msg_detail is None:
+			continue
+		headers = {h["name"]: h["value"] for h in msg_detail.get("payload", {}).get("headers", [])}
+		messages.append({
+			"id": msg_id,
+			"from": headers.get("From"),
+			"subject": headers.get("Subject"),
+			"snippet": msg_detail.get("snippet")
+		})
+
+	return {"ok": True, "count": len(messages), "message_ids": messages}
+
+
+def _mark_synced(user_ids: list[int]) -> None:
+	"""Stamp ``last_synced_at`` for many users in one UPDATE and commit."""
+	if not user_ids:
+		return
+	GmailToken.query.filter(GmailToken.user_id.in_(user_ids)).update(
+		{GmailToken.last_synced_at: datetime.utcnow()}, synchronize_session=False
+	)
+	db.session.commit()
+
+
+# Results are kept in the job store (see app.services.jobs), not the Celery backend.
+# Only quota deferrals retry, and they may do so as often as the limiter asks.
+@shared_task(bind=True, name="gmail.sync_user", ignore_result=True, max_retries=None)
 def sync_user_gmail(self, user_id: int, max_results: int = 10) -> dict[str, Any]:
 	"""Fetch a user's recent Gmail message IDs, refreshing token if needed."""
+	job_id = self.request.id
+	while True:
+		update_job(job_id, "running")
+		try:
+			result = _sync_user(user_id, max_results)
+			break
+		except RateLimited as exc:
+			metrics.incr("gmail.sync_user.throttled")
+			update_job(job_id, "queued")
+			if not self.request.is_eager:
+				raise self.retry(exc=exc, countdown=exc.retry_after)
+			# Eager mode ignores countdown; wait and go again in this call
+			time.sleep(exc.retry_after)
+		except Exception as exc:  # noqa: BLE001
+			current_app.logger.error("Gmail sync error for user %s: %s", user_id, exc)
+			update_job(job_id, "failed", error="sync_failed")
+			raise
+	if result["ok"]:
+		_mark_synced([user_id])
+		update_job(job_id, "succeeded", result=result)
+	else:
+		update_job(job_id, "failed", error=result["error"])
+	return result
+
+
+@shared_task(name="gmail.sync_fleet")
+def sync_fleet() -> dict[str, Any]:
+	"""Beat job: queue chunked syncs for every user not synced recently.
+
+	Tokens are read in keyset-paginated pages (never the whole table) and
+	each page is dispatched as a group of ``gmail.sync_fleet_chunk`` tasks,
+	so the cycle spreads over however many workers are running.
+	"""
+	cycle = start_cycle()
+	if cycle is None:
+		metrics.incr("gmail.fleet.overlap_skipped")
+		return {"ok": False, "error": "cycle_running"}
+	page_size = int(current_app.config.get("GMAIL_FLEET_PAGE_SIZE", 1000))
+	chunk_size = int(current_app.config.get("GMAIL_FLEET_CHUNK_SIZE", 25))
+	cutoff = datetime.utcnow() - timedelta(seconds=float(current_app.config.get("GMAIL_FLEET_MIN_AGE", 3600)))
+
+	total = 0
+	last_id = 0
+	while True:
+		rows = (
+			db.session.query(GmailToken.id, GmailToken.user_id)
+			.filter(
+				GmailToken.id > last_id,
+				or_(GmailToken.last_synced_at.is_(None), GmailToken.last_synced_at < cutoff),
+			)
+			.order_by(GmailToken.id)
+			.limit(page_size)
+			.all()
+		)
+		if not rows:
+			break
+		last_id = rows[-1][0]
+		user_ids = [user_id for _, user_id in rows]
+		group(
+			sync_fleet_chunk.si(cycle, user_ids[i:i + chunk_size])
+			for i in range(0, len(user_ids), chunk_size)
+		).apply_async()
+		total += len(user_ids)
+		if len(rows) < page_size:
+			break
+
+	finish_dispatch(cycle, total)
+	return {"ok": True, "cycle": cycle, "dispatched": total}
+
+
+@shared_task(name="gmail.sync_fleet_chunk", ignore_result=True)
+def sync_fleet_chunk(cycle: str, user_ids: list[int]) -> dict[str, Any]:
+	"""Catch a slice of the fleet up from their history cursors and report progress.
+
+	Each user goes through the same cursor walk as a push notification
+	(``_sync_history``) under the per-user sync lock, so mail whose push was
+	missed is ingested and users with nothing new cost one ``history.list``.
+	"""
+	emails = dict(db.session.query(User.id, User.email).filter(User.id.in_(user_ids)).all())
+	synced: list[int] = []
+	failed = 0
+	for user_id in user_ids:
+		email = emails.get(user_id)
+		if email is None:
+			failed += 1
+			continue
+		owner, highest = begin_sync(email)
+		if owner is None:
+			# A push-triggered sync for this user is running right now
+			metrics.incr("gmail.fleet.busy")
+			synced.append(user_id)
+			continue
+		try:
+			if _sync_history(email, str(highest) if highest is not None else None)["ok"]:
+				synced.append(user_id)
+			else:
+				failed += 1
+		except RateLimited:
+			# Left unstamped, so the next cycle picks the user up again
+			db.session.rollback()
+			metrics.incr("gmail.fleet.throttled")
+			failed += 1
+		except Exception as exc:  # noqa: BLE001
+			db.session.rollback()
+			current_app.logger.error("Fleet sync failed for user %s: %s", user_id, exc)
+			failed += 1
+		finally:
+			end_sync(email, owner)
 	try:
-		token = GmailToken.query.filter_by(user_id=user_id).first()
-		if not token:
-			return {"ok": False, "error": "no_token"}
+		_mark_synced(synced)
+	except Exception as exc:  # noqa: BLE001
+		# Unstamped users are simply synced again next cycle; the cycle must still complete
+		db.session.rollback()
+		current_app.logger.error("Could not stamp fleet sync for %d users: %s", len(synced), exc)
+	record_progress(cycle, synced=len(synced), failed=failed)
+	return {"ok": True, "synced": len(synced), "failed": failed}
 
-		# Refresh access token if expired
-		if _needs_refresh(token.token_expiry):
-			try:
-				res = refresh_access_token(token.refresh_token)
-				token.access_token = res.get("access_token") or token.access_token
-				token.token_expiry = res.get("expiry") or token.token_expiry
-				db.session.commit()
-			except Exception as exc:  # noqa: BLE001
-				current_app.logger.error("Token refresh failed for user %s: %s", user_id, exc)
-				return {"ok": False, "error": "refresh_failed"}
-
-		# Build Gmail client and fetch messages
-		service = build_gmail_service(token.access_token)
-		resp = (
-			service.users()
-			.messages()
-			.list(userId="me", maxResults=max_results, q="is:unread")
-			.execute()
+
+def _advance_history_cursor(token_id: int, history_id: int) -> bool:
+	"""Move a token's history cursor forward in one conditional UPDATE.
+
+	The ``<`` guard means concurrent syncs can never rewind the cursor. Any
+	pending session writes (classification and processed-message rows)
+	commit with it.
+	"""
+	updated = (
+		GmailToken.query
+		.filter(
+			GmailToken.id == token_id,
+			or_(GmailToken.last_history_id.is_(None), GmailToken.last_history_id < history_id),
+		)
+		.update({GmailToken.last_history_id: history_id}, synchronize_session=False)
+	)
+	db.session.commit()
+	return bool(updated)
+
+
+def _recent_message_ids(token: GmailToken, user_id: int) -> list[str]:
+	"""Bounded fallback when history is unavailable: ids of the newest messages."""
+	limit = int(current_app.config.get("GMAIL_RESYNC_MAX_MESSAGES", 100))
+	service = build_gmail_service(token.access_token, user_id=user_id)
+	return list_message_ids(service, limit, user_id=user_id)
+
+
+def _parse_publish_time(value: str | None) -> float | None:
+	"""Pub/Sub ``publishTime`` (RFC 3339, up to ns precision) as epoch seconds."""
+	if not value:
+		return None
+	try:
+		head, _, frac = value.rstrip("Z").partition(".")
+		ts = datetime.fromisoformat(head).replace(tzinfo=timezone.utc).timestamp()
+		return ts + (float(f"0.{frac}") if frac else 0.0)
+	except ValueError:
+		return None
+
+
+def _sync_history(email: str, history_id: str | None) -> dict[str, Any]:
+	"""Walk one user's history and file what is new; raises ``RateLimited`` before committing.
+
+	``history_id`` is the newest one a push announced, if any; without it a
+	user who has no usable cursor starts from the mailbox's current one.
+	"""
+	user = User.query.filter_by(email=email).first()
+	if not user:
+		return {"ok": False, "error": "no_user"}
+
+	token = GmailToken.query.filter_by(user_id=user.id).first()
+	if not token:
+		return {"ok": False, "error": "no_token"}
+	token = ensure_fresh_token(token)
+
+	# Walk history from the stored cursor; re-list recent mail only when it is unusable
+	try:
+		if token.last_history_id is None:
+			raise HistoryExpiredError("no cursor")
+		history = get_history(
+			access_token=token.access_token,
+			start_history_id=token.last_history_id,
+			user_id=user.id,
 		)
+		candidate_ids = history_message_ids(history)
+		new_cursor = history.get("historyId") or history_id
+	except HistoryExpiredError:
+		metrics.incr("gmail.history.resync")
+		# Read before listing, so mail arriving in between is picked up next time
+		new_cursor = history_id or get_latest_history_id(token.access_token, user_id=user.id)
+		candidate_ids = _recent_message_ids(token, user.id)
+
+	# Redeliveries cost one indexed query; content is fetched for unseen ids only
+	unseen_ids = filter_unseen(candidate_ids)
+	new_messages = fetch_message_contents(
+		access_token=token.access_token, message_ids=unseen_ids, user_id=user.id
+	)
+	# Failed or exhausted fetches are held for llm.triage to fetch again, so the
+	# cursor can move past them without losing the mail
+	fetched_ids = {m["id"] for m in new_messages}
+	missing = [{"id": mid} for mid in unseen_ids if mid not in fetched_ids]
+	if missing:
+		metrics.incr("gmail.process_history.fetch_missing", len(missing))
+
+	# Rule verdicts, dedup rows, pending-triage rows and cursor share one commit; with
+	# LLM_TRIAGE_ASYNC the undecided rest goes to the llm queue so ingestion never
+	# waits on a model, and llm.requeue_pending resends it if that task is lost
+	verdicts = rule_verdicts(new_messages)
+	pending = [m for m, v in zip(new_messages, verdicts) if v is None]
+	if current_app.config.get("LLM_TRIAGE_ASYNC", True):
+		settled = [(m, v) for m, v in zip(new_messages, verdicts) if v is not None]
+		triage = save_classifications(user.id, [m for m, _ in settled], [v for _, v in settled])
+		held = hold_for_triage(user.id, pending + missing)
+	else:
+		# Replies reach the LLM with their conversation (one threads.get per thread)
+		attach_thread_context(token.access_token, pending, user_id=user.id)
+		llm_results = iter(classify_emails(pending, prefilter=False))
+		results = [v if v is not None else next(llm_results) for v in verdicts]
+		triage = save_classifications(user.id, new_messages, results)
+		held = hold_for_triage(user.id, missing)
+	mark_processed(user.id, unseen_ids)
+	_advance_history_cursor(token.id, int(new_cursor))
+	triage["llm_queued"] = enqueue_triage(user.id, held)
 
-		messages = []
-		for msg in resp.get("messages", []):
-			msg_id = msg.get("id")
-			msg_detail = service.users().messages().get(userId="me", id=msg_id, format="metadata", metadataHeaders=["From","Subject"]).execute()
-			headers = {h["name"]: h["value"] for h in msg_detail.get("payload", {}).get("headers", [])}
-			messages.append({
-                "id": msg_id,
-                "from": headers.get("From"),
-                "subject": headers.get("Subject"),
-                "snippet": msg_detail.get("snippet")
-			})
-
-		return {"ok": True, "count": len(messages), "message_ids": messages}
+	metrics.incr("gmail.process_history.messages", len(new_messages))
+	return {"ok": True, "count": len(new_messages), **triage}
+
+
+@shared_task(bind=True, name="gmail.process_history", max_retries=3)
+def process_history(
+	self,
+	email: str,
+	history_id: str,
+	published_at: str | None = None,
+	enqueued_at: float | None = None,
+) -> dict[str, Any]:
+	"""Sync a user's Gmail history for one or more coalesced push notifications."""
+	started = time.time()
+	owner, highest = begin_sync(email, wait=bool(self.request.is_eager))
+	if owner is None:
+		# Another sync for this user is in flight; run again after a window
+		metrics.incr("gmail.process_history.deferred")
+		self.apply_async(
+			kwargs={
+				"email": email,
+				"history_id": history_id,
+				"published_at": published_at,
+				"enqueued_at": enqueued_at,
+			},
+			countdown=max(coalesce_window(), 1.0),
+		)
+		return {"ok": True, "deferred": True}
+
+	if enqueued_at:
+		metrics.observe("gmail.process_history.queue_wait", started - enqueued_at)
+	if highest is not None and highest > int(history_id):
+		history_id = str(highest)
+	retry_after = None
+	try:
+		while True:
+			try:
+				return _sync_history(email, history_id)
+			except RateLimited as exc:
+				# Over the user's Gmail quota: nothing was committed, run again once it refills
+				db.session.rollback()
+				metrics.incr("gmail.process_history.throttled")
+				if not self.request.is_eager:
+					retry_after = exc.retry_after
+					return {"ok": True, "deferred": True}
+				# Eager mode ignores countdown; wait and go again in this call
+				time.sleep(exc.retry_after)
 	except Exception as exc:  # noqa: BLE001
-		current_app.logger.error("Gmail sync error for user %s: %s", user_id, exc)
-		raise
+		current_app.logger.error("Gmail history processing failed for %s: %s", email, exc)
+		raise self.retry(exc=exc, countdown=2 ** self.request.retries)
+	finally:
+		end_sync(email, owner)
+		finished = time.time()
+		metrics.observe("gmail.process_history.duration", finished - started)
+		published = _parse_publish_time(published_at)
+		if published is not None:
+			metrics.observe("gmail.process_history.end_to_end", finished - published)
+		# Re-queued only once the sync lock is released
+		if retry_after is not None:
+			self.apply_async(
+				kwargs={
+					"email": email,
+					"history_id": history_id,
+					"published_at": published_at,
+					"enqueued_at": enqueued_at,
+				},
+				countdown=retry_after,
+			)
+
+
+@shared_task(bind=True, name="gmail.refresh_token", max_retries=3)
+def refresh_user_token(self, token_id: int) -> dict[str, Any]:
+	"""Refresh one access token ahead of expiry (scheduled by the beat job)."""
+	token = db.session.get(GmailToken, token_id)
+	if not token:
+		return {"ok": False, "error": "no_token"}
+	try:
+		refresh_token(token, ahead=refresh_ahead())
+	except TokenRefreshError as exc:
+		current_app.logger.error("Scheduled token refresh failed for user %s: %s", token.user_id, exc)
+		raise self.retry(exc=exc, countdown=5 * 2 ** self.request.retries)
+	return {"ok": True, "user_id": token.user_id}
+
+
+@shared_task(name="gmail.refresh_expiring_tokens")
+def refresh_expiring_tokens() -> dict[str, Any]:
+	"""Beat job: schedule jittered refreshes for tokens nearing expiry."""
+	due = tokens_due_for_refresh()
+	for token_id, countdown in due:
+		refresh_user_token.apply_async(args=[token_id], countdown=countdown)
+	return {"ok": True, "scheduled": len(due)}
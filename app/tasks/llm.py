@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import time
+from datetime import datetime, timedelta
+from typing import Any
+
+from celery import shared_task
+from flask import current_app
+
+from app.extensions import db
+from app.models import GmailToken, PendingTriage
+from app.services import metrics
+from app.services.classifier import classify_emails, save_classifications
+from app.services.google_oauth import fetch_message_contents
+from app.services.prefilter import email_importance
+from app.services.ratelimit import RateLimited
+from app.services.threads import attach_thread_context
+from app.services.token_manager import ensure_fresh_token
+
+# Celery priorities as AMQP reads them (9 is served first); Redis is inverted
+_PRIORITY = {"high": 9, "medium": 5, "low": 0}
+
+
+def triage_priority(importance: str, broker_url: str | None) -> int:
+	"""Message priority for an importance level on the given broker."""
+	priority = _PRIORITY.get(importance, _PRIORITY["medium"])
+	if (broker_url or "").startswith(("redis", "rediss", "sentinel")):
+		return 9 - priority
+	return priority
+
+
+def hold_for_triage(user_id: int, emails: list[dict[str, Any]]) -> list[tuple[str, str]]:
+	"""Add ``pending_triage`` rows for ``emails`` and return their ``(id, importance)``.
+
+	Does not commit: the rows go in with the caller's dedup rows and history
+	cursor, so an email is never marked processed without a record that it
+	still needs a verdict. Importance comes from headers and urgent wording,
+	since the LLM's own rating is what the task produces.
+	"""
+	held = []
+	for email in emails:
+		importance = email_importance(email)
+		db.session.add(PendingTriage(user_id=user_id, gmail_message_id=email["id"], importance=importance))
+		held.append((email["id"], importance))
+	return held
+
+
+def enqueue_triage(user_id: int, held: list[tuple[str, str]]) -> int:
+	"""Queue LLM triage for held ``(id, importance)`` pairs in batches, high importance first.
+
+	Messages carry ids only; the task refetches the emails, so broker
+	payloads stay small whatever the bodies weigh.
+	"""
+	if not held:
+		return 0
+	size = max(1, int(current_app.config.get("LLM_TRIAGE_BATCH_SIZE", 20)))
+	broker_url = triage_emails.app.conf.broker_url
+	by_importance: dict[str, list[str]] = {}
+	for message_id, importance in held:
+		by_importance.setdefault(importance, []).append(message_id)
+	for importance in ("high", "medium", "low"):
+		batch = by_importance.get(importance, [])
+		for i in range(0, len(batch), size):
+			triage_emails.apply_async(
+				args=[user_id, batch[i:i + size]],
+				priority=triage_priority(importance, broker_url),
+			)
+		metrics.incr(f"llm.triage.queued.{importance}", len(batch))
+	return len(held)
+
+
+def _triage(user_id: int, message_ids: list[str]) -> tuple[dict[str, Any], list[str], float]:
+	"""Classify and save held emails; returns the result, ids to retry and the delay."""
+	rows = {
+		row.gmail_message_id: row
+		for row in PendingTriage.query.filter(
+			PendingTriage.user_id == user_id, PendingTriage.gmail_message_id.in_(message_ids)
+		)
+	}
+	# A redelivered or swept batch skips what an earlier run already saved
+	message_ids = [mid for mid in message_ids if mid in rows]
+	if not message_ids:
+		return {"ok": True, "count": 0}, [], 0.0
+	token = GmailToken.query.filter_by(user_id=user_id).first()
+	if not token:
+		return {"ok": False, "error": "no_token"}, [], 0.0
+
+	try:
+		token = ensure_fresh_token(token)
+		emails = fetch_message_contents(token.access_token, message_ids, user_id=user_id)
+		attach_thread_context(token.access_token, emails, user_id=user_id)
+		# Rules again: emails held after a failed fetch were never checked against them
+		results = classify_emails(emails)
+		done = [(e, r) for e, r in zip(emails, results) if r["reason"] != "llm_throttled"]
+		throttled = [(e, r) for e, r in zip(emails, results) if r["reason"] == "llm_throttled"]
+		counts = save_classifications(user_id, [e for e, _ in done], [r for _, r in done])
+		for email, _ in done:
+			db.session.delete(rows[email["id"]])
+		result = {"ok": True, "count": len(done), **counts}
+		retry_ids = [e["id"] for e, _ in throttled]
+		delay = max((r["retry_after"] for _, r in throttled), default=0.0)
+	except RateLimited as exc:
+		# Over the user's Gmail quota before anything was classified
+		db.session.rollback()
+		result, retry_ids, delay = {"ok": True, "count": 0}, message_ids, exc.retry_after
+	# Touch rows being retried so the sweeper leaves them alone meanwhile
+	for mid in retry_ids:
+		rows[mid].updated_at = datetime.utcnow()
+	db.session.commit()
+	return result, retry_ids, delay
+
+
+@shared_task(bind=True, name="llm.triage", max_retries=3)
+def triage_emails(self, user_id: int, message_ids: list[str]) -> dict[str, Any]:
+	"""Fetch held emails, classify them and save the results.
+
+	Each saved verdict deletes its ``pending_triage`` row in the same commit;
+	anything left over (failed runs, exhausted retries, lost messages) is
+	re-queued by ``llm.requeue_pending``. Emails refused by a rate limiter
+	are re-queued (same priority) for when the bucket refills rather than
+	filed with a fallback verdict.
+	"""
+	totals: dict[str, Any] = {}
+	while True:
+		try:
+			result, retry_ids, delay = _triage(user_id, message_ids)
+		except Exception as exc:  # noqa: BLE001
+			db.session.rollback()
+			current_app.logger.error("LLM triage failed for user %s: %s", user_id, exc)
+			raise self.retry(exc=exc, countdown=2 ** self.request.retries)
+		for key, value in result.items():
+			# Counts add up over eager retries; flags and errors keep the latest value
+			summable = isinstance(value, int) and not isinstance(value, bool)
+			totals[key] = totals.get(key, 0) + value if summable else value
+		if not retry_ids or not self.request.is_eager:
+			break
+		# Eager mode ignores countdown; wait and go again in this call
+		time.sleep(delay)
+		message_ids = retry_ids
+	if retry_ids:
+		self.apply_async(
+			args=[user_id, retry_ids],
+			countdown=delay,
+			priority=(self.request.delivery_info or {}).get("priority"),
+		)
+		metrics.incr("llm.triage.rescheduled", len(retry_ids))
+	return {**totals, "rescheduled": len(retry_ids)}
+
+
+@shared_task(name="llm.requeue_pending")
+def requeue_pending_triage() -> dict[str, Any]:
+	"""Beat job: re-queue held emails whose triage task never saved them.
+
+	Rows untouched for ``LLM_TRIAGE_REQUEUE_AFTER`` seconds are sent again;
+	rows older than ``LLM_TRIAGE_PENDING_MAX_AGE`` (messages deleted from
+	Gmail, say) are dropped.
+	"""
+	now = datetime.utcnow()
+	max_age = timedelta(seconds=float(current_app.config.get("LLM_TRIAGE_PENDING_MAX_AGE", 86400)))
+	dropped = (
+		PendingTriage.query.filter(PendingTriage.created_at < now - max_age)
+		.delete(synchronize_session=False)
+	)
+	if dropped:
+		metrics.incr("llm.triage.abandoned", dropped)
+		current_app.logger.warning("Dropped %d emails that were never triaged", dropped)
+
+	stale = now - timedelta(seconds=float(current_app.config.get("LLM_TRIAGE_REQUEUE_AFTER", 900)))
+	rows = (
+		db.session.query(PendingTriage.id, PendingTriage.user_id, PendingTriage.gmail_message_id, PendingTriage.importance)
+		.filter(PendingTriage.updated_at < stale)
+		.order_by(PendingTriage.id)
+		.limit(int(current_app.config.get("LLM_TRIAGE_REQUEUE_LIMIT", 1000)))
+		.all()
+	)
+	if rows:
+		PendingTriage.query.filter(PendingTriage.id.in_([row[0] for row in rows])).update(
+			{PendingTriage.updated_at: now}, synchronize_session=False
+		)
+	db.session.commit()
+
+	by_user: dict[int, list[tuple[str, str]]] = {}
+	for _, user_id, message_id, importance in rows:
+		by_user.setdefault(user_id, []).append((message_id, importance))
+	for user_id, held in by_user.items():
+		enqueue_triage(user_id, held)
+	metrics.incr("llm.triage.requeued", len(rows))
+	return {"ok": True, "requeued": len(rows), "dropped": dropped}
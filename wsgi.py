@@ -1,4 +1,5 @@
 from app import create_app
+from app.celery_app import celery  # noqa: F401 - bind tasks to the configured Celery app
 
 
 app = create_app()